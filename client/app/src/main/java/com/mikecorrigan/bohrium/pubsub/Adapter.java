@@ -24,14 +24,23 @@ import org.json.JSONArray;
 import org.json.JSONException;
 import org.json.JSONObject;
 
+import java.io.UnsupportedEncodingException;
+import java.net.URLEncoder;
+import java.util.HashMap;
 import java.util.LinkedList;
 import java.util.List;
+import java.util.Map;
 
 class Adapter {
     private static final String TAG = Adapter.class.getSimpleName();
 
     private final ITransactionService mTransactionService;
 
+    // Last response body, its ETag and the cursor of the next page per URI, so an unchanged resource is not sent again.
+    private final Map<String, String> mETags = new HashMap<>();
+    private final Map<String, Object> mBodies = new HashMap<>();
+    private final Map<String, String> mNextCursors = new HashMap<>();
+
     public Adapter(final ITransactionService transactionService) {
         Log.v(TAG, "ctor: server=" + transactionService);
         mTransactionService = transactionService;
@@ -64,14 +73,42 @@ class Adapter {
         return null;
     }
 
-    public Bundle read(final String uriString) {
-        Log.v(TAG, "read: uri=" + uriString);
+    private Object get(final String uriString) {
+        Log.v(TAG, "get: uri=" + uriString);
 
         ITransaction transaction = mTransactionService.createTransaction("GET", uriString, null);
+        transaction.setIfNoneMatch(mETags.get(uriString));
         mTransactionService.completeTransaction(transaction);
 
-        if (transaction.getStatusCode() == 200) {
-            JSONObject jsonBody = (JSONObject) transaction.getResponseBody();
+        if (transaction.getStatusCode() == 304) {
+            Log.v(TAG, "not modified: uri=" + uriString);
+            return mBodies.get(uriString);
+        }
+
+        mETags.remove(uriString);
+        mBodies.remove(uriString);
+        mNextCursors.remove(uriString);
+        if (transaction.getStatusCode() != 200) {
+            return null;
+        }
+
+        if (transaction.getETag() != null) {
+            mETags.put(uriString, transaction.getETag());
+            mBodies.put(uriString, transaction.getResponseBody());
+        }
+        if (transaction.getNextCursor() != null) {
+            mNextCursors.put(uriString, transaction.getNextCursor());
+        }
+
+        return transaction.getResponseBody();
+    }
+
+    public Bundle read(final String uriString) {
+        Log.v(TAG, "read: uri=" + uriString);
+
+        Object body = get(uriString);
+        if (body != null) {
+            JSONObject jsonBody = (JSONObject) body;
             Bundle bundle = JSONCodec.fromJson(jsonBody);
             Log.v(TAG, "bundle=" + Utils.bundleToString(bundle));
             return bundle;
@@ -83,14 +120,17 @@ class Adapter {
     public List<Bundle> readAll(final String uriString) {
         Log.v(TAG, "readAll: uri=" + uriString);
 
-        ITransaction transaction = mTransactionService.createTransaction("GET", uriString, null);
-        mTransactionService.completeTransaction(transaction);
-
+        // The server returns a collection a page at a time; follow the cursors to the last page.
+        List<Bundle> bundles = new LinkedList<>();
+        String pageUriString = uriString;
         try {
-            if (transaction.getStatusCode() == 200) {
-                List<Bundle> bundles = new LinkedList<>();
+            while (pageUriString != null) {
+                Object body = get(pageUriString);
+                if (body == null) {
+                    return null;
+                }
 
-                JSONArray jsonBody = (JSONArray) transaction.getResponseBody();
+                JSONArray jsonBody = (JSONArray) body;
                 for (int i = 0; i < jsonBody.length(); i++) {
                     JSONObject jsonObj = (JSONObject) jsonBody.get(i);
 
@@ -100,17 +140,31 @@ class Adapter {
                     bundles.add(bundle);
                 }
 
-                Log.v(TAG, "bundles=" + bundles);
-                return bundles;
+                pageUriString = getNextPage(uriString, mNextCursors.get(pageUriString));
             }
+
+            Log.v(TAG, "bundles=" + bundles);
+            return bundles;
         } catch (JSONException e) {
             Log.e(TAG, "exception=" + e);
             Log.e(TAG, Log.getStackTraceString(e));
+        } catch (UnsupportedEncodingException e) {
+            Log.e(TAG, "exception=" + e);
+            Log.e(TAG, Log.getStackTraceString(e));
         }
 
         return null;
     }
 
+    private static String getNextPage(final String uriString, final String cursor) throws UnsupportedEncodingException {
+        if (cursor == null) {
+            return null;
+        }
+
+        String separator = uriString.contains("?") ? "&" : "?";
+        return uriString + separator + "cursor=" + URLEncoder.encode(cursor, "UTF-8");
+    }
+
     public void update(final String uriString, final Bundle bundle) {
         Log.v(TAG, "update: uri=" + uriString + ", bundle=" + Utils.bundleToString(bundle));
 
@@ -23,9 +23,20 @@ import android.support.v4.content.WakefulBroadcastReceiver;
 import com.mikecorrigan.bohrium.common.Log;
 import com.mikecorrigan.bohrium.common.Utils;
 
+import org.json.JSONArray;
+import org.json.JSONException;
+import org.json.JSONObject;
+
+import java.util.ArrayList;
+import java.util.Iterator;
+import java.util.List;
+
 public class GCMBroadcastReceiver extends WakefulBroadcastReceiver {
     private static final String TAG = GCMBroadcastReceiver.class.getSimpleName();
 
+    // A digest packs several messages into one push; "messages" is a JSON array of their extras.
+    public static final String TYPE_DIGEST = "digest";
+
     @Override
     public final void onReceive(Context context, Intent intent) {
         Log.d(TAG, "onReceive: context=" + context + ", intent=" + intent + ", extras: " + Utils.bundleToString(intent.getExtras()));
@@ -35,4 +46,41 @@ public class GCMBroadcastReceiver extends WakefulBroadcastReceiver {
 
         setResult(Activity.RESULT_OK, null, null); // TODO: Is this needed?
     }
+
+    // Returns the messages packed in a digest, or the intent itself if it is not a digest.
+    public static List<Intent> unpack(final Intent intent) {
+        List<Intent> intents = new ArrayList<Intent>();
+        if (!TYPE_DIGEST.equals(intent.getStringExtra("type"))) {
+            intents.add(intent);
+            return intents;
+        }
+
+        final String messagesString = intent.getStringExtra("messages");
+        if (messagesString == null) {
+            Log.e(TAG, "unpack: missing messages");
+            return intents;
+        }
+
+        try {
+            JSONArray messages = new JSONArray(messagesString);
+            for (int i = 0; i < messages.length(); i++) {
+                JSONObject message = messages.getJSONObject(i);
+
+                Intent messageIntent = new Intent(intent);
+                messageIntent.removeExtra("messages");
+                messageIntent.removeExtra("count");
+                Iterator<?> keys = message.keys();
+                while (keys.hasNext()) {
+                    String key = (String) keys.next();
+                    messageIntent.putExtra(key, message.getString(key));
+                }
+
+                intents.add(messageIntent);
+            }
+        } catch (JSONException e) {
+            Log.e(TAG, "unpack: invalid digest, " + e);
+        }
+
+        return intents;
+    }
 }
@@ -23,6 +23,8 @@ public interface ITransaction {
 
     public Object getRequestBody();
 
+    public void setIfNoneMatch(final String etag);
+
     // Response
     public int getStatusCode();
 
@@ -30,6 +32,10 @@ public interface ITransaction {
 
     public Object getResponseBody();
 
+    public String getETag();
+
+    public String getNextCursor();
+
     // Operations
     public void run();
 }
@@ -502,7 +502,9 @@ public class RegistrationClient extends android.app.Service implements ITransact
         Log.v(TAG, "notifyMessage: context=" + context + ", intent=" + intent);
 
         if (mListener != null) {
-            mListener.onMessage(context, intent);
+            for (Intent messageIntent : GCMBroadcastReceiver.unpack(intent)) {
+                mListener.onMessage(context, messageIntent);
+            }
         }
     }
 
@@ -17,6 +17,7 @@ package com.mikecorrigan.bohrium.pubsub;
 
 import com.mikecorrigan.bohrium.common.Log;
 
+import org.apache.http.Header;
 import org.apache.http.HttpEntity;
 import org.apache.http.HttpResponse;
 import org.apache.http.client.CookieStore;
@@ -55,10 +56,13 @@ public abstract class Transaction implements ITransaction {
     private final String mMethod;
     private final String mUriString;
     private final Object mRequestBody;
+    private String mIfNoneMatch;
     // Response
     private int mStatusCode;
     private String mStatusReason;
     private Object mResponseBody;
+    private String mETag;
+    private String mNextCursor;
 
     public Transaction(final String baseUriString, final Cookie authCookie, final String method, final String uriString, final Object requestBody) {
         Log.v(TAG, "ctor");
@@ -83,6 +87,10 @@ public abstract class Transaction implements ITransaction {
         return mRequestBody;
     }
 
+    public void setIfNoneMatch(final String etag) {
+        mIfNoneMatch = etag;
+    }
+
     public int getStatusCode() {
         return mStatusCode;
     }
@@ -95,6 +103,14 @@ public abstract class Transaction implements ITransaction {
         return mResponseBody;
     }
 
+    public String getETag() {
+        return mETag;
+    }
+
+    public String getNextCursor() {
+        return mNextCursor;
+    }
+
     protected abstract String getMimeType();
 
     protected abstract String encode(final Object object);
@@ -107,6 +123,8 @@ public abstract class Transaction implements ITransaction {
         mStatusCode = -1;
         mStatusReason = null;
         mResponseBody = null;
+        mETag = null;
+        mNextCursor = null;
 
         Log.v(TAG, "baseUri=" + mBaseUriString);
         Log.v(TAG, "authCookie=" + mAuthCookie);
@@ -173,10 +191,26 @@ public abstract class Transaction implements ITransaction {
             request.setParams(getParams);
 
             request.setHeader("Accept", getMimeType());
+            if (mIfNoneMatch != null) {
+                request.setHeader("If-None-Match", mIfNoneMatch);
+            }
 
             HttpResponse response = httpClient.execute(request, mHttpContext);
             Log.d(TAG, "status=" + response.getStatusLine());
 
+            // A 304 (Not Modified) has no body.
+            mStatusCode = response.getStatusLine().getStatusCode();
+            mStatusReason = response.getStatusLine().getReasonPhrase();
+            Header etag = response.getFirstHeader("ETag");
+            if (etag != null) {
+                mETag = etag.getValue();
+            }
+            // A collection read returns one page; the cursor of the next page is in X-Next-Cursor.
+            Header nextCursor = response.getFirstHeader("X-Next-Cursor");
+            if (nextCursor != null) {
+                mNextCursor = nextCursor.getValue();
+            }
+
             // Read response body.
             HttpEntity responseEntity = response.getEntity();
             if (responseEntity != null) {
@@ -10,7 +10,7 @@ class CodecHtml(object):
         self.content_type = content_type
         self.showAdminFields = showAdminFields
 
-    def encode(self, request, obj, template_name):
+    def encode(self, request, obj, template_name, next_url=None, fields=None):
         template_values = {}
 
         # Add generic template values.
@@ -22,9 +22,10 @@ class CodecHtml(object):
             template_values['url_linktext'] = 'Login'
 
         template_values['result'] = obj
+        template_values['next_url'] = next_url
 
         # Add cls template values.
-        template_values['keys'] = self.cls.KEYS
+        template_values['keys'] = fields or self.cls.KEYS
         template_values['writable'] = self.cls.KEYS_WRITABLE
         template_values['readonly'] = self.cls.KEYS_READONLY
         template_values['rows'] = self.cls.ROWS
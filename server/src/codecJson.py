@@ -6,13 +6,17 @@ from google.appengine.api import users
 from google.appengine.ext import ndb
 
 class NdbJsonEncoder(json.JSONEncoder):
+    def __init__(self, include=None, **kwargs):
+        super(NdbJsonEncoder, self).__init__(**kwargs)
+        self.include = include
+
     def default(self, o):
         # If this is a key, grab the actual model.
         if isinstance(o, ndb.Key):
             o = o.get()
 
         if isinstance(o, ndb.Model):
-            return o.to_dict()
+            return o.to_dict(include=self.include)
         elif isinstance(o, users.User):
             return o.email()
         elif isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
@@ -24,8 +28,17 @@ class CodecJson(object):
         super(CodecJson, self).__init__()
         self.content_type = content_type
 
-    def encode(self, request, obj):
-        return json.dumps(obj=obj, cls=NdbJsonEncoder)
+    def encode(self, request, obj, fields=None):
+        return json.dumps(obj=obj, cls=NdbJsonEncoder, include=fields)
+
+    def encode_stream(self, request, objs, fields=None):
+        # One JSON array, yielded an element at a time.
+        yield '['
+        separator = ''
+        for obj in objs:
+            yield separator + json.dumps(obj=obj, cls=NdbJsonEncoder, include=fields)
+            separator = ','
+        yield ']'
 
     def decode(self, request):
         if not request.body:
@@ -27,21 +27,37 @@ class CodecXml(object):
             return str(o)
         return str(o)
 
-    def encode(self, request, obj):
+    def encodeElement(self, o, fields=None):
+        e = ET.Element(o.get_link().strip('/').replace('/', '-'))
+        for key, value in o.to_dict(include=fields).items():
+            e.set(key, self.encodeAttribute(value))
+
+        return e
+
+    def encode(self, request, obj, fields=None):
         if isinstance(obj, ndb.Model):
             obj = (obj, )
 
         root = ET.Element('root')
         for o in obj:
-            e = ET.SubElement(root, o.get_link().strip('/').replace('/', '-'))
-            for key, value in o.to_dict().items():
-                e.set(key, self.encodeAttribute(value))
+            if o is None:
+                root.append(ET.Element('error'))
+                continue
+
+            root.append(self.encodeElement(o, fields))
 
         try:
             return self.prettify(root)
         except ExpatError:
             return tostring(root)
 
+    def encode_stream(self, request, objs, fields=None):
+        # The root element is opened first and each object is yielded as its own element.
+        yield '<?xml version="1.0" ?>\n<root>\n'
+        for o in objs:
+            yield '  ' + ET.tostring(self.encodeElement(o, fields), 'utf-8') + '\n'
+        yield '</root>\n'
+
     def decode(self, request):
         if not request.body:
             return None
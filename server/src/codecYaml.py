@@ -23,19 +23,28 @@ class CodecYaml(object):
             return str(o)
         return str(o)
 
-    def encode(self, request, objs):
+    def encodeObject(self, obj, fields=None):
+        kv = {}
+        for key, value in obj.to_dict(include=fields).items():
+            kv[key] = self.encodeAttribute(value)
+
+        return kv
+
+    def encode(self, request, objs, fields=None):
         if isinstance(objs, ndb.Model):
             objs = (objs, )
 
         out = []
         for obj in objs:
-            kv = {}
-            for key, value in obj.to_dict().items():
-                kv[key] = self.encodeAttribute(value)
-            out.append(kv)
+            out.append(self.encodeObject(obj, fields) if obj is not None else None)
 
         return yaml.dump(out)
 
+    def encode_stream(self, request, objs, fields=None):
+        # One YAML document per object.
+        for obj in objs:
+            yield yaml.dump(self.encodeObject(obj, fields), explicit_start=True)
+
     def decode(self, request):
         if not request.body:
             return None
@@ -2,7 +2,9 @@ import hashlib
 import json
 import logging
 import re
+import time
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import ndb
 
@@ -12,11 +14,13 @@ from codecHtml import CodecHtml
 from codecJson import CodecJson
 from contentRoute import ContentRoute
 from fields import Fields
+from generation import Generation
 from genericHandlers import GenericParentHandlerJson
 from genericHandlers import GenericHandlerJson
 from genericHandlers import GenericParentHandlerHtml
 from genericHandlers import GenericHandlerHtml
 from genericAdapter import GenericAdapter
+from migration import Migration
 
 CONFIG_KEYS = ('name', 'gcm_api_key', 'user_id', 'created', 'modified', 'revision', 'key')
 
@@ -30,6 +34,16 @@ class Config(ndb.Model):
     ROWS = {}
     COLUMNS = {}
 
+    # Properties get_link needs, see GenericAdapter.get_projection.
+    LINK_KEYS = ('name', )
+    # The property holding the natural id, see get_key.
+    ID_KEY = 'name'
+
+    # Cache of configs, in-process and in memcache, keyed by generation.
+    CACHE_TTL = 30
+    GENERATION_KEY = 'config-generation'
+    cache = {}
+
     name = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     gcm_api_key = ndb.StringProperty(default='', required=True)
     user_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
@@ -47,8 +61,20 @@ class Config(ndb.Model):
 
         logging.getLogger().debug('obj=' + str(obj))
 
+    @staticmethod
+    def get_key(id):
+        return ndb.Key(Config, id, parent=Config.ROOT_KEY)
+
     @staticmethod
     def query_by_id(id):
+        # Configs are keyed by name; older ones need a query until migrated.
+        key = Config.get_key(id)
+        if key.get():
+            return [key]
+
+        if Migration.is_done(Config):
+            return []
+
         return Config.query(Config.name == id, ancestor=Config.ROOT_KEY).order(-Config.modified).fetch(keys_only=True)
 
     def get_id(self):
@@ -78,6 +104,38 @@ class Config(ndb.Model):
 
         return obj
 
+    @classmethod
+    def get_generation(cls):
+        return Generation.get(cls.GENERATION_KEY)
+
+    @classmethod
+    def bump_generation(cls):
+        cls.cache.clear()
+        Generation.bump(cls.GENERATION_KEY)
+
+    @classmethod
+    def get_active(cls, id='active'):
+        now = time.time()
+        entry = cls.cache.get(id)
+        if entry and entry[0] > now:
+            return entry[2]
+
+        # Once the TTL expires, the cached config is kept only if no write has bumped the generation.
+        generation = cls.get_generation()
+        if entry and entry[1] == generation:
+            cls.cache[id] = (now + cls.CACHE_TTL, generation, entry[2])
+            return entry[2]
+
+        cache_key = 'config-%s-%s' % (id, generation)
+        obj = memcache.get(cache_key)
+        if obj is None:
+            obj = cls.get_master_db(id)
+            if obj:
+                memcache.set(cache_key, obj)
+
+        cls.cache[id] = (now + cls.CACHE_TTL, generation, obj)
+        return obj
+
     @staticmethod
     def get_routes(base_url=''):
         parent_url = str(base_url) + '/config/'
@@ -121,21 +179,50 @@ class Config(ndb.Model):
             methods=('POST',)),
         ]
 
+class ConfigAdapter(GenericAdapter):
+    def create(self, kv, parent=None):
+        obj = super(ConfigAdapter, self).create(kv, parent)
+        Config.bump_generation()
+        return obj
+
+    def create_multi(self, kvs, parent=None):
+        objs = super(ConfigAdapter, self).create_multi(kvs, parent)
+        Config.bump_generation()
+        return objs
+
+    def update_one(self, id, kv=None):
+        obj = super(ConfigAdapter, self).update_one(id, kv)
+        Config.bump_generation()
+        return obj
+
+    def updated(self, olds, objs):
+        Config.bump_generation()
+
+    def delete_all(self, parent=None):
+        keys = super(ConfigAdapter, self).delete_all(parent)
+        Config.bump_generation()
+        return keys
+
+    def delete_one(self, id):
+        obj = super(ConfigAdapter, self).delete_one(id)
+        Config.bump_generation()
+        return obj
+
 class ConfigsHandlerJson(GenericParentHandlerJson):
     def __init__(self, request, response):
-        super(ConfigsHandlerJson, self).__init__(request, response, adapter=GenericAdapter(Config), codec=CodecJson())
+        super(ConfigsHandlerJson, self).__init__(request, response, adapter=ConfigAdapter(Config), codec=CodecJson())
 
 class ConfigHandlerJson(GenericHandlerJson):
     def __init__(self, request, response):
-        super(ConfigHandlerJson, self).__init__(request, response, adapter=GenericAdapter(Config), codec=CodecJson())
+        super(ConfigHandlerJson, self).__init__(request, response, adapter=ConfigAdapter(Config), codec=CodecJson())
 
 class ConfigsHandlerHtml(GenericParentHandlerHtml):
     def __init__(self, request, response):
-        super(ConfigsHandlerHtml, self).__init__(request, response, adapter=GenericAdapter(Config), codec=CodecHtml(Config))
+        super(ConfigsHandlerHtml, self).__init__(request, response, adapter=ConfigAdapter(Config), codec=CodecHtml(Config))
 
 class ConfigHandlerHtml(GenericHandlerHtml):
     def __init__(self, request, response):
-        super(ConfigHandlerHtml, self).__init__(request, response, adapter=GenericAdapter(Config), codec=CodecHtml(Config))
+        super(ConfigHandlerHtml, self).__init__(request, response, adapter=ConfigAdapter(Config), codec=CodecHtml(Config))
 
 
 Config.get_master_db()
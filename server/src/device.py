@@ -19,11 +19,14 @@ from genericHandlers import GenericHandlerJson
 from genericHandlers import GenericParentHandlerHtml
 from genericHandlers import GenericHandlerHtml
 from genericAdapter import GenericAdapter
+from migration import Migration
+from topicIndex import TopicIndex
 
 DEVICE_KEYS = ('name', 'resource', 'type', 'dev_id', 'reg_id', 'user_id', 'created', 'modified', 'revision', 'key')
 
 class Device(ndb.Model):
-    ROOT_KEY = ndb.Key('Device', 'devices')
+    # No common parent, see GenericAdapter. Entities created under ndb.Key('Device', 'devices') are still found.
+    ROOT_KEY = None
 
     # HTML formatting.
     KEYS = DEVICE_KEYS
@@ -32,6 +35,11 @@ class Device(ndb.Model):
     ROWS = {}
     COLUMNS = {}
 
+    # Properties get_link needs, see GenericAdapter.get_projection.
+    LINK_KEYS = ('dev_id', )
+    # The property holding the natural id, see get_key.
+    ID_KEY = 'dev_id'
+
     name = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     dev_id = ndb.StringProperty(required=True, validator=Fields.validate_dev_id)
     reg_id = ndb.StringProperty(required=True, validator=Fields.validate_reg_id)
@@ -56,8 +64,20 @@ class Device(ndb.Model):
 
         logging.getLogger().debug('obj=' + str(obj))
 
+    @staticmethod
+    def get_key(id):
+        return ndb.Key(Device, id, parent=Device.ROOT_KEY)
+
     @staticmethod
     def query_by_id(id):
+        # Devices stored before they were keyed by dev_id are found by query until migrated.
+        key = Device.get_key(id)
+        if key.get():
+            return [key]
+
+        if Migration.is_done(Device):
+            return []
+
         return Device.query(Device.dev_id == id, ancestor=Device.ROOT_KEY).order(-Device.modified).fetch(keys_only=True)
 
     def get_id(self):
@@ -156,34 +176,72 @@ class Device(ndb.Model):
             methods=('DELETE')),
         ]
 
+class DeviceAdapter(GenericAdapter):
+    # Keep the reg_ids in the fan-out index of every publication the device subscribes to current.
+    def create(self, kv, parent=None):
+        obj = super(DeviceAdapter, self).create(kv, parent)
+        if obj:
+            TopicIndex.update_devices({obj.dev_id : obj.reg_id})
+
+        return obj
+
+    def create_multi(self, kvs, parent=None):
+        objs = super(DeviceAdapter, self).create_multi(kvs, parent)
+        if objs:
+            TopicIndex.update_devices(dict([(obj.dev_id, obj.reg_id) for obj in objs if obj]))
+
+        return objs
+
+    def update_one(self, id, kv=None):
+        obj = super(DeviceAdapter, self).update_one(id, kv)
+        if obj:
+            TopicIndex.update_devices({obj.dev_id : obj.reg_id})
+
+        return obj
+
+    def updated(self, olds, objs):
+        TopicIndex.update_devices(dict([(obj.dev_id, obj.reg_id) for obj in objs]))
+
+    def delete_all(self, parent=None):
+        keys = super(DeviceAdapter, self).delete_all(parent)
+        TopicIndex.clear()
+        return keys
+
+    def delete_one(self, id):
+        obj = super(DeviceAdapter, self).delete_one(id)
+        if obj:
+            TopicIndex.update_devices({obj.dev_id : None})
+
+        return obj
+
 class DevicesHandlerJson(GenericParentHandlerJson):
     def __init__(self, request, response):
-        super(DevicesHandlerJson, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecJson())
+        super(DevicesHandlerJson, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecJson())
 
 class DeviceHandlerJson(GenericHandlerJson):
     def __init__(self, request, response):
-        super(DeviceHandlerJson, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecJson())
+        super(DeviceHandlerJson, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecJson())
 
 class DevicesHandlerHtml(GenericParentHandlerHtml):
     def __init__(self, request, response):
-        super(DevicesHandlerHtml, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecHtml(Device))
+        super(DevicesHandlerHtml, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecHtml(Device))
 
 class DeviceHandlerHtml(GenericHandlerHtml):
     def __init__(self, request, response):
-        super(DeviceHandlerHtml, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecHtml(Device))
+        super(DeviceHandlerHtml, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecHtml(Device))
 
 class DevicesHandlerXml(GenericParentHandlerJson):
     def __init__(self, request, response):
-        super(DevicesHandlerXml, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecXml())
+        super(DevicesHandlerXml, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecXml())
 
 class DeviceHandlerXml(GenericHandlerJson):
     def __init__(self, request, response):
-        super(DeviceHandlerXml, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecXml())
+        super(DeviceHandlerXml, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecXml())
 
 class DevicesHandlerYaml(GenericParentHandlerJson):
     def __init__(self, request, response):
-        super(DevicesHandlerYaml, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecYaml())
+        super(DevicesHandlerYaml, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecYaml())
 
 class DeviceHandlerYaml(GenericHandlerJson):
     def __init__(self, request, response):
-        super(DeviceHandlerYaml, self).__init__(request, response, adapter=GenericAdapter(Device), codec=CodecYaml())
+        super(DeviceHandlerYaml, self).__init__(request, response, adapter=DeviceAdapter(Device), codec=CodecYaml())
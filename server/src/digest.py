@@ -0,0 +1,239 @@
+import json
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from webapp2 import RequestHandler
+from webapp2 import Route
+
+from gcm import PreparedMessage
+from gcmHelpers import gcm
+from subscription import Subscription
+from topicIndex import TopicIndex
+
+class DigestItem(ndb.Model):
+    # A message from a digest publication, waiting for the end of its window.
+    # Root entities, so publishing does not contend on one entity group.
+    window = ndb.IntegerProperty(required=True)
+    pub_id = ndb.StringProperty(required=True)
+    data = ndb.JsonProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, required=True)
+
+class DigestPart(ndb.Model):
+    # Up to Digest.PART_SIZE of a window's items, {pub_id, data} in order, read once by the flush and
+    # by key in every shard task. Part 0 also holds the number of parts.
+    items = ndb.JsonProperty(compressed=True)
+    parts = ndb.IntegerProperty(default=0, indexed=False)
+
+class Digest(object):
+    URL = '/task/digest/'
+    SHARD_URL = '/task/digest/shard/'
+    CLEANUP_URL = '/task/digest/cleanup/'
+    CLEANUP_QUEUE_NAME = 'default'
+    # A window's items and parts are kept until no flush or shard retry can still need them.
+    CLEANUP_DELAY = 2 * 24 * 3600
+
+    TYPE = 'digest'
+
+    # Messages to a device within one window (seconds) are packed into as few pushes as fit.
+    WINDOW = 30
+    # Extra seconds before flushing, so the window's items show up in queries.
+    FLUSH_DELAY = 5
+
+    LANE = gcm.LANE_BROADCAST
+
+    # Items per DigestPart; each item's data fits in one GCM message, so a part stays under the entity size limit.
+    PART_SIZE = 200
+
+    @staticmethod
+    def add(obj, data):
+        window = int(time.time()) / Digest.WINDOW
+        logging.getLogger().debug('add: key: %s, window: %d' % (obj.key, window))
+
+        DigestItem(window=window, pub_id=obj.pub_id, data=data).put()
+
+        # One flush per window; the task may already have been added by another message.
+        countdown = (window + 1) * Digest.WINDOW - time.time() + Digest.FLUSH_DELAY
+        try:
+            taskqueue.add(queue_name=gcm.LANES[Digest.LANE]['queue'], url=Digest.URL,
+                params={'window' : window}, name='digest-%d' % (window), countdown=countdown)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.getLogger().debug('flush already added: window: %d' % (window))
+
+    @staticmethod
+    def get_items(window):
+        return DigestItem.query(DigestItem.window == window).order(DigestItem.created).fetch()
+
+    @staticmethod
+    def get_part_key(window, part):
+        return ndb.Key(DigestPart, 'digest-%d-%d' % (window, part))
+
+    @staticmethod
+    def save_parts(window):
+        # Read the window's items once and store them in parts; returns the number of parts.
+        # A rerun uses the parts already stored.
+        first = Digest.get_part_key(window, 0).get()
+        if first:
+            return first.parts
+
+        items = [{'pub_id' : item.pub_id, 'data' : item.data} for item in Digest.get_items(window)]
+        parts = []
+        for i in range(0, len(items), Digest.PART_SIZE):
+            parts.append(DigestPart(key=Digest.get_part_key(window, len(parts)), items=items[i:i + Digest.PART_SIZE]))
+
+        if parts:
+            parts[0].parts = len(parts)
+            ndb.put_multi(parts)
+
+        return len(parts)
+
+    @staticmethod
+    def load_parts(window, parts):
+        items = []
+        for part in ndb.get_multi([Digest.get_part_key(window, part) for part in range(parts)]):
+            if part:
+                items.extend(part.items)
+
+        return items
+
+    @staticmethod
+    def enqueue_cleanup(window, countdown=CLEANUP_DELAY):
+        logging.getLogger().debug('enqueue cleanup: window: %d' % (window))
+        try:
+            taskqueue.add(queue_name=Digest.CLEANUP_QUEUE_NAME, url=Digest.CLEANUP_URL,
+                params={'window' : window}, name='digest-%d-cleanup' % (window), countdown=countdown)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.getLogger().debug('cleanup already added: window: %d' % (window))
+
+    @staticmethod
+    def delete_window(window):
+        first = Digest.get_part_key(window, 0).get()
+        keys = [Digest.get_part_key(window, part) for part in range(first.parts if first else 0)]
+        keys.extend(DigestItem.query(DigestItem.window == window).fetch(keys_only=True))
+        logging.getLogger().debug('delete: window: %d, entities (%d)' % (window, len(keys)))
+        ndb.delete_multi(keys)
+
+    @staticmethod
+    def pack(window, items):
+        # Split the items into digests whose data fits in one GCM message.
+        digests = []
+        messages = []
+        for item in items:
+            candidate = Digest.get_data(window, len(digests), messages + [item])
+            if messages and len(json.dumps(candidate)) > PreparedMessage.MAX_DATA_SIZE:
+                digests.append(Digest.get_data(window, len(digests), messages))
+                messages = []
+
+            if not messages:
+                item = Digest.fit(window, len(digests), item)
+                if item is None:
+                    continue
+
+            messages.append(item)
+
+        if messages:
+            digests.append(Digest.get_data(window, len(digests), messages))
+
+        return digests
+
+    @staticmethod
+    def fit(window, part, item):
+        # An item too big for a digest of its own has its message truncated; GCM would refuse it whole.
+        # Returns None if it still does not fit.
+        size = len(json.dumps(Digest.get_data(window, part, [item])))
+        if size <= PreparedMessage.MAX_DATA_SIZE:
+            return item
+
+        logging.getLogger().warning('digest item too big: window: %d, size: %d, truncating message' % (window, size))
+
+        item = dict(item)
+        message = item.get('message') or ''
+        while message and size > PreparedMessage.MAX_DATA_SIZE:
+            message = message[:len(message) - max(size - PreparedMessage.MAX_DATA_SIZE, 1)]
+            item['message'] = message
+            size = len(json.dumps(Digest.get_data(window, part, [item])))
+
+        if size > PreparedMessage.MAX_DATA_SIZE:
+            logging.getLogger().error('digest item dropped: window: %d, size: %d' % (window, size))
+            return None
+
+        return item
+
+    @staticmethod
+    def get_data(window, part, messages):
+        # Each part of a digest has its own context, and so its own collapse key.
+        return {'type' : Digest.TYPE, 'context' : '%d-%d' % (window, part),
+            'count' : str(len(messages)), 'messages' : json.dumps(messages)}
+
+    @staticmethod
+    def get_routes(base_url=''):
+        return [ \
+        Route(template=str(base_url) + Digest.URL, handler=DigestHandler, methods=('POST',)),
+        Route(template=str(base_url) + Digest.SHARD_URL, handler=DigestShardHandler, methods=('POST',)),
+        Route(template=str(base_url) + Digest.CLEANUP_URL, handler=DigestCleanupHandler, methods=('POST',)),
+        ]
+
+class DigestHandler(RequestHandler):
+    # Flush a window: one task per index shard, since a device is in the same shard for every publication.
+    def post(self, *args, **kwargs):
+        window = int(self.request.get('window'))
+
+        parts = Digest.save_parts(window)
+        Digest.enqueue_cleanup(window)
+        pub_ids = sorted(set([item['pub_id'] for item in Digest.load_parts(window, parts)]))
+        logging.getLogger().debug('flush: window: %d, parts: %d, publications (%d)' % (window, parts, len(pub_ids)))
+        if not pub_ids:
+            return
+
+        for pub_id in pub_ids:
+            if not TopicIndex.is_indexed(pub_id):
+                Subscription.build_index(pub_id)
+
+        tasks = []
+        for shard in range(TopicIndex.SHARDS):
+            tasks.append(taskqueue.Task(url=Digest.SHARD_URL, params={'window' : window, 'parts' : parts, 'shard' : shard},
+                name='digest-%d-shard-%d' % (window, shard)))
+
+        try:
+            taskqueue.Queue(gcm.LANES[Digest.LANE]['queue']).add(tasks)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.getLogger().debug('tasks already added')
+
+class DigestShardHandler(RequestHandler):
+    # Send each device in one shard a digest of the window's messages from its publications.
+    def post(self, *args, **kwargs):
+        window = int(self.request.get('window'))
+        parts = int(self.request.get('parts'))
+        shard = int(self.request.get('shard'))
+
+        items = Digest.load_parts(window, parts)
+        pub_ids = sorted(set([item['pub_id'] for item in items]))
+        indexes = ndb.get_multi([TopicIndex.get_key(pub_id, shard) for pub_id in pub_ids])
+
+        # reg_id -> positions of the items it receives.
+        received = {}
+        for pub_id, index in zip(pub_ids, indexes):
+            if not index:
+                continue
+
+            positions = [i for i, item in enumerate(items) if item['pub_id'] == pub_id]
+            for reg_id in TopicIndex.get_shard_reg_ids(index.key):
+                received.setdefault(reg_id, []).extend(positions)
+
+        # Devices that receive the same items share one multicast.
+        groups = {}
+        for reg_id, positions in received.items():
+            groups.setdefault(tuple(sorted(set(positions))), []).append(reg_id)
+
+        logging.getLogger().debug('digest: window: %d, shard: %d, reg_ids (%d), groups (%d)' % (window, shard, len(received), len(groups)))
+
+        for positions, reg_ids in groups.items():
+            for data in Digest.pack(window, [items[i]['data'] for i in positions]):
+                gcm.send(data=data, reg_ids=reg_ids, lane=Digest.LANE)
+
+class DigestCleanupHandler(RequestHandler):
+    # Delete a window's items and parts once its digests are sent.
+    def post(self, *args, **kwargs):
+        Digest.delete_window(int(self.request.get('window')))
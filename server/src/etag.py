@@ -0,0 +1,52 @@
+import hashlib
+
+from google.appengine.api import memcache
+
+from generation import Generation
+
+class ETag(object):
+    # Strong entity tags for conditional GETs.
+    # Every write to a kind bumps the kind's generation in memcache. A collection's tag is derived from the
+    # generation, or from the page read for kinds without a common parent, and an object's from its key,
+    # revision and modified time, cached in memcache per generation, so a tag cached before a write is never
+    # used after it.
+    GENERATION_KEY = 'etag-generation-%s'
+    VERSION_KEY = 'etag-version-%s-%s'
+    VERSION_TTL = 3600
+
+    @staticmethod
+    def get_generation(cls):
+        return Generation.get(ETag.GENERATION_KEY % (cls._get_kind()))
+
+    @staticmethod
+    def bump(cls):
+        Generation.bump(ETag.GENERATION_KEY % (cls._get_kind()))
+
+    @staticmethod
+    def get_version(generation, key):
+        return memcache.get(ETag.VERSION_KEY % (generation, key.urlsafe()))
+
+    @staticmethod
+    def set_version(generation, key, obj):
+        version = ETag.get_object_version(obj)
+        memcache.set(ETag.VERSION_KEY % (generation, key.urlsafe()), version, time=ETag.VERSION_TTL)
+        return version
+
+    @staticmethod
+    def get_object_version(obj):
+        # Projected objects may lack the revision, so their values are used instead.
+        if obj._projection:
+            return '%s-%s' % (obj.key.urlsafe(), sorted(obj.to_dict().items()))
+
+        return '%s-%d-%s' % (obj.key.urlsafe(), obj.revision, obj.modified.isoformat())
+
+    @staticmethod
+    def get_page(objs, *parts):
+        # The tag of a page of a kind whose queries may lag behind writes (see GenericAdapter), from the
+        # objects read: a page read before the index caught up with a write is not tagged as current.
+        return ETag.get(*(list(parts) + [ETag.get_object_version(obj) for obj in objs]))
+
+    @staticmethod
+    def get(*parts):
+        # The tag of a representation; parts include everything the response depends on.
+        return hashlib.md5('|'.join([str(part) for part in parts])).hexdigest()
@@ -0,0 +1,198 @@
+import json
+import logging
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from webapp2 import RequestHandler
+from webapp2 import Route
+
+from gcmHelpers import gcm
+from outbox import Outbox
+from subscription import Subscription
+from topicIndex import TopicIndex
+
+class FanOut(object):
+    URL = '/task/fanout/'
+    SHARD_URL = '/task/fanout/shard/'
+    PAGE_URL = '/task/fanout/page/'
+
+    # Subscriptions read by one page task.
+    PAGE_SIZE = 500
+
+    # Index entries read by one shard task.
+    CHECKPOINT_SIZE = 1000
+
+    @staticmethod
+    def enqueue(obj, countdown=0, transactional=False):
+        lane = getattr(obj, 'LANE', gcm.LANE_DIRECT)
+        logging.getLogger().debug('enqueue: key: %s, lane: %s, countdown: %f' % (obj.key, lane, countdown))
+
+        taskqueue.add(queue_name=gcm.LANES[lane]['queue'], url=FanOut.URL,
+            params={'key' : obj.key.urlsafe()}, countdown=countdown, transactional=transactional)
+
+    @staticmethod
+    def enqueue_multi(objs):
+        # One unnamed task per message, added in batches.
+        logging.getLogger().debug('enqueue multi: objs (%d)' % (len(objs)))
+
+        tasks = {}
+        for obj in objs:
+            lane = getattr(obj, 'LANE', gcm.LANE_DIRECT)
+            tasks.setdefault(lane, []).append(taskqueue.Task(url=FanOut.URL, params={'key' : obj.key.urlsafe()}))
+
+        for lane, lane_tasks in tasks.items():
+            for i in range(0, len(lane_tasks), taskqueue.MAX_TASKS_PER_ADD):
+                taskqueue.Queue(gcm.LANES[lane]['queue']).add(lane_tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+    @staticmethod
+    def add_tasks(lane, tasks):
+        # Tasks are named after the message, so a rerun of the task that adds them does not send twice.
+        try:
+            taskqueue.Queue(gcm.LANES[lane]['queue']).add(tasks)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.getLogger().debug('tasks already added')
+
+    @staticmethod
+    def enqueue_publication(obj, data):
+        # Split a publication's fan-out into tasks that each send to a bounded slice of its subscribers:
+        # one per index shard, or a chain of subscription pages until the publication's index is built.
+        lane = obj.LANE
+        if TopicIndex.is_indexed(obj.pub_id):
+            logging.getLogger().debug('enqueue shards: key: %s' % (obj.key))
+            tasks = []
+            for shard, key in enumerate(TopicIndex.get_keys(obj.pub_id)):
+                tasks.append(FanOut.get_shard_task(obj.key.urlsafe(), data, lane, key.urlsafe(), 'shard-%d' % (shard), 0))
+
+            FanOut.add_tasks(lane, tasks)
+        else:
+            FanOut.enqueue_page(obj.key.urlsafe(), obj.pub_id, data, lane, 0)
+
+    @staticmethod
+    def get_shard_task(id, data, lane, shard, part, page):
+        payload = json.dumps({'id' : id, 'data' : data, 'lane' : lane, 'shard' : shard, 'part' : part, 'page' : page})
+        return taskqueue.Task(url=FanOut.SHARD_URL, payload=payload, name='%s-%s-%d' % (id, part, page))
+
+    @staticmethod
+    def enqueue_shard_page(id, data, lane, shard, part, page):
+        logging.getLogger().debug('enqueue shard page: id: %s, part: %s, page: %d' % (id, part, page))
+
+        FanOut.add_tasks(lane, [FanOut.get_shard_task(id, data, lane, shard, part, page)])
+
+    @staticmethod
+    def enqueue_page(id, pub_id, data, lane, page):
+        logging.getLogger().debug('enqueue page: id: %s, page: %d' % (id, page))
+
+        payload = json.dumps({'id' : id, 'pub_id' : pub_id, 'data' : data, 'lane' : lane, 'page' : page})
+        FanOut.add_tasks(lane, [taskqueue.Task(url=FanOut.PAGE_URL, payload=payload, name='%s-page-%d' % (id, page))])
+
+    @staticmethod
+    def get_routes(base_url=''):
+        return [ \
+        Route(template=str(base_url) + FanOut.URL, handler=FanOutHandler, methods=('POST',)),
+        Route(template=str(base_url) + FanOut.SHARD_URL, handler=FanOutShardHandler, methods=('POST',)),
+        Route(template=str(base_url) + FanOut.PAGE_URL, handler=FanOutPageHandler, methods=('POST',)),
+        ]
+
+class FanOutHandler(RequestHandler):
+    # Send a persisted message.
+    def post(self, *args, **kwargs):
+        logging.getLogger().debug('post: args: %s, kwargs: %s' % (args, kwargs))
+
+        key = ndb.Key(urlsafe=self.request.get('key'))
+        obj = key.get()
+        if not obj:
+            # The message was deleted before it was sent; do not retry.
+            logging.getLogger().error('object not read')
+            return
+
+        obj.send()
+
+        # Compare the time since the task was due against the lane's latency target.
+        lane = getattr(obj, 'LANE', gcm.LANE_DIRECT)
+        eta = self.request.headers.get('X-AppEngine-TaskETA')
+        if eta:
+            latency = time.time() - float(eta)
+            logging.getLogger().debug('lane: %s, latency: %f' % (lane, latency))
+            if latency > gcm.LANES[lane]['latency']:
+                logging.getLogger().warning('lane %s over latency target: %f > %d' % (lane, latency, gcm.LANES[lane]['latency']))
+
+class FanOutShardHandler(RequestHandler):
+    # Send to the devices in one page of a shard of a publication's index, then queue the next page.
+    def post(self, *args, **kwargs):
+        try:
+            j = json.loads(self.request.body)
+        except ValueError:
+            # A malformed task will never succeed; do not retry.
+            logging.getLogger().error('decoding error')
+            return
+
+        outbox = Outbox.get_part(j['id'], j['part'])
+        if outbox.state == Outbox.STATE_DONE:
+            logging.getLogger().debug('shard already sent: %s' % (j['part']))
+            return
+
+        page = j.get('page', 0)
+        if outbox.page > page:
+            # The page was sent before this task was rerun; make sure the chain goes on.
+            FanOut.enqueue_shard_page(j['id'], j['data'], j['lane'], j['shard'], j['part'], outbox.page)
+            return
+
+        cursor = Cursor(urlsafe=outbox.cursor) if outbox.cursor else None
+        query = TopicIndex.query_entries(ndb.Key(urlsafe=j['shard']))
+        entries, cursor, more = query.fetch_page(FanOut.CHECKPOINT_SIZE, start_cursor=cursor)
+
+        reg_ids = sorted(set([entry.reg_id for entry in entries if entry.reg_id]))
+        logging.getLogger().debug('shard: %s, page: %d, reg_ids (%d)' % (j['part'], page, len(reg_ids)))
+
+        response = {}
+        if reg_ids:
+            response = gcm.send(data=j['data'], reg_ids=reg_ids, lane=j['lane'], outbox=outbox.key.urlsafe())
+
+        if more and cursor:
+            Outbox.checkpoint(outbox.key, reg_ids, response, page=page + 1, cursor=cursor.urlsafe())
+            FanOut.enqueue_shard_page(j['id'], j['data'], j['lane'], j['shard'], j['part'], page + 1)
+        else:
+            Outbox.checkpoint(outbox.key, reg_ids, response, page=page + 1, cursor=None, state=Outbox.STATE_DONE)
+            Outbox.enqueue_cleanup(j['id'])
+
+class FanOutPageHandler(RequestHandler):
+    # Send to the devices in one page of a publication's subscriptions, copying them into its index, then
+    # queue the next page. The last page marks the index built, so later publishes use the shards.
+    def post(self, *args, **kwargs):
+        try:
+            j = json.loads(self.request.body)
+        except ValueError:
+            # A malformed task will never succeed; do not retry.
+            logging.getLogger().error('decoding error')
+            return
+
+        outbox = Outbox.get_part(j['id'], Outbox.PART_PAGES)
+        if outbox.state == Outbox.STATE_DONE:
+            logging.getLogger().debug('pages already sent')
+            return
+
+        if outbox.page > j['page']:
+            # The page was sent before this task was rerun; make sure the chain goes on.
+            FanOut.enqueue_page(j['id'], j['pub_id'], j['data'], j['lane'], outbox.page)
+            return
+
+        cursor = Cursor(urlsafe=outbox.cursor) if outbox.cursor else None
+        entries, cursor, more = Subscription.index_page(j['pub_id'], cursor, FanOut.PAGE_SIZE)
+
+        reg_ids = sorted(set([reg_id for reg_id in entries.values() if reg_id]))
+        logging.getLogger().debug('page: %d, dev_ids (%d), reg_ids (%d)' % (j['page'], len(entries), len(reg_ids)))
+
+        response = {}
+        if reg_ids:
+            response = gcm.send(data=j['data'], reg_ids=reg_ids, lane=j['lane'], outbox=outbox.key.urlsafe())
+
+        if more and cursor:
+            Outbox.checkpoint(outbox.key, reg_ids, response, page=j['page'] + 1, cursor=cursor.urlsafe())
+            FanOut.enqueue_page(j['id'], j['pub_id'], j['data'], j['lane'], j['page'] + 1)
+        else:
+            Outbox.checkpoint(outbox.key, reg_ids, response, page=j['page'] + 1, cursor=None, state=Outbox.STATE_DONE)
+            Outbox.enqueue_cleanup(j['id'])
+            TopicIndex.set_built(j['pub_id'])
@@ -76,3 +76,20 @@ class Fields(object):
             return value
         else:
             return default
+
+    @staticmethod
+    def get_int(kv, key, default=0):
+        try:
+            return int(Fields.get(kv, key, default))
+        except (TypeError, ValueError):
+            return default
+
+    @staticmethod
+    def get_list(kv, key, default=None):
+        # Comma-separated values, e.g. fields=dev_id,reg_id.
+        value = Fields.get(kv, key)
+        if not value:
+            return default
+
+        values = [v.strip() for v in value.split(',') if v.strip()]
+        return values or default
@@ -2,3 +2,8 @@
 import gcm
 
 GCM = gcm.GCM
+GCM_URL = gcm.GCM_URL
+PreparedMessage = gcm.PreparedMessage
+GCMException = gcm.GCMException
+GCMConnectionException = gcm.GCMConnectionException
+GCMUnavailableException = gcm.GCMUnavailableException
@@ -1,10 +1,18 @@
+import httplib
 import urllib
-import urllib2
 import json
 from collections import defaultdict
+from email.utils import mktime_tz
+from email.utils import parsedate_tz
+import Queue
+import socket
+import threading
 import time
 import random
 
+from pool import HTTPConnectionPool
+from pool import ResponseLostError
+
 GCM_URL = 'https://android.googleapis.com/gcm/send'
 
 
@@ -15,6 +23,8 @@ class GCMAuthenticationException(GCMException): pass
 class GCMTooManyRegIdsException(GCMException): pass
 class GCMNoCollapseKeyException(GCMException): pass
 class GCMInvalidTtlException(GCMException): pass
+# The request was sent, but no response was read; GCM may have sent the message.
+class GCMResponseLostException(GCMException): pass
 
 # Exceptions from Google responses
 class GCMMissingRegistrationException(GCMException): pass
@@ -24,6 +34,10 @@ class GCMMessageTooBigException(GCMException): pass
 class GCMInvalidRegistrationException(GCMException): pass
 class GCMUnavailableException(GCMException): pass
 
+# Requests refused locally; the service was not contacted.
+class GCMCircuitOpenException(GCMUnavailableException): pass
+class GCMRateLimitedException(GCMUnavailableException): pass
+
 
 # TODO: Refactor this to be more human-readable
 def group_response(response, registration_ids, key):
@@ -48,6 +62,46 @@ def group_response(response, registration_ids, key):
     return grouping
 
 
+def merge_responses(infos):
+    """
+    Merges the results of handle_json_response for several requests into one.
+    """
+
+    errors = defaultdict(list)
+    canonical = {}
+    for info in infos:
+        for error, reg_ids in info.get('errors', {}).items():
+            errors[error].extend(reg_ids)
+        canonical.update(info.get('canonical', {}))
+
+    merged = {}
+    if errors:
+        merged.update({'errors': errors})
+    if canonical:
+        merged.update({'canonical': canonical})
+
+    return merged
+
+
+def parse_retry_after(value):
+    """
+    Seconds to wait from a Retry-After header, which is either seconds or an HTTP date.
+    """
+
+    if not value:
+        return None
+
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    date = parsedate_tz(value)
+    if not date:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
 def urlencode_utf8(params):
     """
     UTF-8 safe variant of urllib.urlencode.
@@ -67,28 +121,90 @@ def urlencode_utf8(params):
     return '&'.join(params)
 
 
+class PreparedMessage(object):
+    """
+    The part of a JSON request that is the same for every batch of registration ids,
+    validated and serialized once.  payload() splices in each batch's ids.
+    """
+
+    # Limit on the size of the data payload, in bytes.
+    MAX_DATA_SIZE = 4096
+
+    def __init__(self, data=None, collapse_key=None, delay_while_idle=False, time_to_live=None):
+        """
+        :raises GCMInvalidTtlException: if time_to_live is invalid
+        :raises GCMNoCollapseKeyException: if collapse_key is missing when time_to_live is used
+        :raises GCMMessageTooBigException: if data is over MAX_DATA_SIZE bytes
+        """
+
+        if time_to_live:
+            if time_to_live > 2419200 or time_to_live < 0:
+                raise GCMInvalidTtlException("Invalid time to live value")
+
+        common = {}
+        if data:
+            encoded = json.dumps(data)
+            if len(encoded) > self.MAX_DATA_SIZE:
+                raise GCMMessageTooBigException("Data is %d bytes, over the %d byte limit" % (len(encoded), self.MAX_DATA_SIZE))
+            common['data'] = data
+
+        if delay_while_idle:
+            common['delay_while_idle'] = delay_while_idle
+
+        if time_to_live >= 0:
+            common['time_to_live'] = time_to_live
+            if collapse_key is None:
+                raise GCMNoCollapseKeyException("collapse_key is required when time_to_live is provided")
+
+        if collapse_key:
+            common['collapse_key'] = collapse_key
+
+        # '{"registration_ids": [...], <common>}'
+        self.prefix = '{"registration_ids": '
+        self.suffix = (', ' + json.dumps(common)[1:]) if common else '}'
+
+    def payload(self, registration_ids):
+        return self.prefix + json.dumps(registration_ids) + self.suffix
+
+
 class GCM(object):
 
     # Timeunit is milliseconds.
     BACKOFF_INITIAL_DELAY = 1000;
     MAX_BACKOFF_DELAY = 1024000;
 
-    def __init__(self, api_key, url=GCM_URL, proxy=None):
+    # Maximum number of registration ids in a single JSON request.
+    MAX_REG_IDS = 1000
+    # Default number of JSON requests in flight for a multicast.
+    MAX_WORKERS = 4
+
+    # Timeunit is seconds.
+    TIMEOUT = 10
+
+    def __init__(self, api_key, url=GCM_URL, proxy=None, retry_scheduler=None,
+                    pool_size=MAX_WORKERS, timeout=TIMEOUT, rate_limiter=None, circuit_breaker=None,
+                    tuner=None):
         """ api_key : google api key
             url: url of gcm service.
             proxy: can be string "http://host:port" or dict {'https':'host:port'}
+            retry_scheduler: optional callable(registration_ids, attempt, delay) that
+                schedules unsent ids to be retried after delay seconds instead of
+                sleeping in-process.  attempt is the attempt number of the retry.
+            pool_size: number of keep-alive connections to gcm kept open.
+            timeout: socket timeout in seconds.
+            rate_limiter: optional throttle.RateLimiter applied to every request.
+            circuit_breaker: optional throttle.CircuitBreaker that stops requests while gcm is failing.
+            tuner: optional throttle.BatchTuner that sets the chunk size, concurrency and backoff of multicasts.
         """
         self.api_key = api_key
         self.url = url
-        if proxy:
-            if isinstance(proxy,basestring):
-                protocol = url.split(':')[0]
-                proxy={protocol:proxy}
-
-            auth = urllib2.HTTPBasicAuthHandler()
-            opener = urllib2.build_opener(urllib2.ProxyHandler(proxy), auth, urllib2.HTTPHandler)
-            urllib2.install_opener(opener)
-
+        self.retry_scheduler = retry_scheduler
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+        self.tuner = tuner
+        # Latency of the last request made by each thread, excluding time spent rate limited.
+        self.latency = threading.local()
+        self.pool = HTTPConnectionPool(url, size=pool_size, timeout=timeout, proxy=proxy)
 
     def construct_payload(self, registration_ids, data=None, collapse_key=None,
                             delay_while_idle=False, time_to_live=None, is_json=True):
@@ -100,23 +216,23 @@ class GCM(object):
         :return constructed dict or JSON payload
         :raises GCMInvalidTtlException: if time_to_live is invalid
         :raises GCMNoCollapseKeyException: if collapse_key is missing when time_to_live is used
+        :raises GCMMessageTooBigException: if the JSON data is too big
         """
 
+        if is_json:
+            message = PreparedMessage(data, collapse_key, delay_while_idle, time_to_live)
+            return message.payload(registration_ids)
+
         if time_to_live:
             if time_to_live > 2419200 or time_to_live < 0:
                 raise GCMInvalidTtlException("Invalid time to live value")
 
-        if is_json:
-            payload = {'registration_ids': registration_ids}
-            if data:
-                payload['data'] = data
-        else:
-            payload = {'registration_id': registration_ids}
-            if data:
-                plaintext_data = data.copy()
-                for k in plaintext_data.keys():
-                    plaintext_data['data.%s' % k] = plaintext_data.pop(k)
-                payload.update(plaintext_data)
+        payload = {'registration_id': registration_ids}
+        if data:
+            plaintext_data = data.copy()
+            for k in plaintext_data.keys():
+                plaintext_data['data.%s' % k] = plaintext_data.pop(k)
+            payload.update(plaintext_data)
 
         if delay_while_idle:
             payload['delay_while_idle'] = delay_while_idle
@@ -129,46 +245,72 @@ class GCM(object):
         if collapse_key:
             payload['collapse_key'] = collapse_key
 
-        if is_json:
-            payload = json.dumps(payload)
-
         return payload
 
-    def make_request(self, data, is_json=True):
+    def make_request(self, data, is_json=True, count=1):
         """
         Makes a HTTP request to GCM servers with the constructed payload
 
         :param data: return value from construct_payload method
+        :param count: number of registration ids in the payload, for rate limiting
         :raises GCMMalformedJsonException: if malformed JSON request found
         :raises GCMAuthenticationException: if there was a problem with authentication, invalid api key
         :raises GCMConnectionException: if GCM is screwed
+        :raises GCMResponseLostException: if the request was sent but no response was read
+        :raises GCMCircuitOpenException: if the circuit breaker is refusing requests
+        :raises GCMRateLimitedException: if the rate limiter would wait too long
         """
 
+        if self.circuit_breaker and not self.circuit_breaker.allow():
+            raise GCMCircuitOpenException("GCM circuit is open")
+        if self.rate_limiter and not self.rate_limiter.acquire(count):
+            raise GCMRateLimitedException("GCM rate limit exceeded")
+
         headers = {
             'Authorization': 'key=%s' % self.api_key,
         }
-        # Default Content-Type is defaulted to application/x-www-form-urlencoded;charset=UTF-8
         if is_json:
             headers['Content-Type'] = 'application/json'
+        else:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded;charset=UTF-8'
 
         if not is_json:
             data = urlencode_utf8(data)
-        req = urllib2.Request(self.url, data, headers)
 
+        self.latency.value = 0.0
+        start = time.time()
         try:
-            response = urllib2.urlopen(req).read()
-        except urllib2.HTTPError as e:
-            if e.code == 400:
-                raise GCMMalformedJsonException("The request could not be parsed as JSON")
-            elif e.code == 401:
-                raise GCMAuthenticationException("There was an error authenticating the sender account")
-            elif e.code == 503:
-                raise GCMUnavailableException("GCM service is unavailable")
-            else:
-                error = "GCM service error: %d" % e.code
-                raise GCMUnavailableException(error)
-        except urllib2.URLError as e:
+            status, response_headers, response = self.pool.request(data, headers)
+            self.latency.value = time.time() - start
+        except (httplib.HTTPException, socket.error) as e:
+            self.latency.value = time.time() - start
+            if self.circuit_breaker:
+                self.circuit_breaker.failure()
             raise GCMConnectionException("There was an internal error in the GCM server while trying to process the request")
+        except ResponseLostError as e:
+            self.latency.value = time.time() - start
+            if self.circuit_breaker:
+                self.circuit_breaker.failure()
+            raise GCMResponseLostException("The request was sent to GCM but no response was read")
+
+        if self.circuit_breaker:
+            retry_after = parse_retry_after(response_headers.get('retry-after'))
+            if status >= 500:
+                self.circuit_breaker.failure(retry_after)
+            else:
+                self.circuit_breaker.success()
+                if retry_after:
+                    self.circuit_breaker.hold(retry_after)
+
+        if status == 400:
+            raise GCMMalformedJsonException("The request could not be parsed as JSON")
+        elif status == 401:
+            raise GCMAuthenticationException("There was an error authenticating the sender account")
+        elif status == 503:
+            raise GCMUnavailableException("GCM service is unavailable")
+        elif status != 200:
+            error = "GCM service error: %d" % status
+            raise GCMUnavailableException(error)
 
         if is_json:
             response = json.loads(response)
@@ -213,18 +355,77 @@ class GCM(object):
 
         return info
 
+    def backoff_delay(self, attempt):
+        """
+        Randomized exponential backoff, in milliseconds, before retrying after attempt.
+        """
+
+        backoff = self.BACKOFF_INITIAL_DELAY
+        if self.tuner:
+            backoff *= self.tuner.backoff_scale
+        for i in range(attempt):
+            if 2 * backoff < self.MAX_BACKOFF_DELAY:
+                backoff *= 2
+
+        return backoff / 2 + random.randrange(backoff)
+
+    def retry(self, registration_ids, attempt, retries, retry_scheduler=None):
+        """
+        Waits before the next attempt, or hands the ids to the retry scheduler.
+
+        :return True if the caller should retry in-process
+        """
+
+        if attempt + 1 >= retries:
+            return False
+
+        delay = float(self.backoff_delay(attempt)) / 1000
+        if self.circuit_breaker:
+            delay = max(delay, self.circuit_breaker.retry_after())
+        retry_scheduler = retry_scheduler or self.retry_scheduler
+        if retry_scheduler:
+            retry_scheduler(registration_ids, attempt + 1, delay)
+            return False
+
+        time.sleep(delay)
+        return True
+
+    def failure_info(self, registration_ids, e, attempt, retries, retry_scheduler=None):
+        """
+        Reports the registration ids of a request that raised e, in the form of handle_json_response:
+        Unavailable, and scheduled if the caller asked for that, if the request did not get through;
+        Error if GCM refused it; Unknown if it failed once sent, since GCM may have sent the message
+        and a retry could deliver it twice.
+        """
+
+        if isinstance(e, GCMResponseLostException):
+            error = 'Unknown'
+        elif isinstance(e, (GCMUnavailableException, GCMConnectionException)):
+            if retry_scheduler or self.retry_scheduler:
+                self.retry(registration_ids, attempt, retries, retry_scheduler)
+            error = 'Unavailable'
+        elif isinstance(e, GCMException):
+            error = 'Error'
+        else:
+            error = 'Unknown'
+
+        return {'errors': {error: list(registration_ids)}}
+
     def extract_unsent_reg_ids(self, info):
         if 'errors' in info and 'Unavailable' in info['errors']:
             return info['errors']['Unavailable']
         return []
 
     def plaintext_request(self, registration_id, data=None, collapse_key=None,
-                            delay_while_idle=False, time_to_live=None, retries=5):
+                            delay_while_idle=False, time_to_live=None, retries=5, attempt=0,
+                            retry_scheduler=None):
         """
         Makes a plaintext request to GCM servers
 
         :param registration_id: string of the registration id
         :param data: dict mapping of key-value pairs of messages
+        :param attempt: number of attempts already made, when resuming a scheduled retry
+        :param retry_scheduler: overrides the scheduler given to the constructor
         :return dict of response body from Google including multicast_id, success, failure, canonical_ids, etc
         :raises GCMMissingRegistrationException: if registration_id is not provided
         """
@@ -237,54 +438,146 @@ class GCM(object):
             delay_while_idle, time_to_live, False
         )
 
-        attempt = 0
-        backoff = self.BACKOFF_INITIAL_DELAY
-        for attempt in range(retries):
+        for attempt in range(attempt, retries):
             try:
-                response = self.make_request(payload, is_json=False)
+                response = self.make_request(payload, is_json=False, count=1)
                 return self.handle_plaintext_response(response)
             except GCMUnavailableException:
-                sleep_time = backoff / 2 + random.randrange(backoff)
-                time.sleep(float(sleep_time) / 1000)
-                if 2 * backoff < self.MAX_BACKOFF_DELAY:
-                    backoff *= 2
+                if not self.retry([registration_id], attempt, retries, retry_scheduler):
+                    break
+
+        if (retry_scheduler or self.retry_scheduler) and attempt + 1 < retries:
+            # The retry has been scheduled.
+            return
 
         raise IOError("Could not make request after %d attempts" % attempt)
 
     def json_request(self, registration_ids, data=None, collapse_key=None,
-                        delay_while_idle=False, time_to_live=None, retries=5):
+                        delay_while_idle=False, time_to_live=None, retries=5, attempt=0,
+                        retry_scheduler=None, message=None):
         """
         Makes a JSON request to GCM servers
 
         :param registration_ids: list of the registration ids
         :param data: dict mapping of key-value pairs of messages
+        :param attempt: number of attempts already made, when resuming a scheduled retry
+        :param retry_scheduler: overrides the scheduler given to the constructor
+        :param message: PreparedMessage to send instead of data, collapse_key, delay_while_idle and time_to_live
         :return dict of response body from Google including multicast_id, success, failure, canonical_ids, etc
         :raises GCMMissingRegistrationException: if the list of registration_ids exceeds 1000 items
         """
 
         if not registration_ids:
             raise GCMMissingRegistrationException("Missing registration_ids")
-        if len(registration_ids) > 1000:
+        if len(registration_ids) > self.MAX_REG_IDS:
             raise GCMTooManyRegIdsException("Exceded number of registration_ids")
 
-        attempt = 0
-        backoff = self.BACKOFF_INITIAL_DELAY
-        for attempt in range(retries):
-            payload = self.construct_payload(
-                registration_ids, data, collapse_key,
-                delay_while_idle, time_to_live
-            )
-            response = self.make_request(payload, is_json=True)
-            info = self.handle_json_response(response, registration_ids)
+        if not message:
+            message = PreparedMessage(data, collapse_key, delay_while_idle, time_to_live)
+
+        infos = []
+        for attempt in range(attempt, retries):
+            payload = message.payload(registration_ids)
+            try:
+                try:
+                    response = self.make_request(payload, is_json=True, count=len(registration_ids))
+                except (GCMCircuitOpenException, GCMRateLimitedException):
+                    raise
+                except (GCMUnavailableException, GCMConnectionException, GCMResponseLostException):
+                    if self.tuner:
+                        self.tuner.record(len(registration_ids), self.latency.value, len(registration_ids))
+                    raise
+                info = self.handle_json_response(response, registration_ids)
+            except Exception as e:
+                if not infos:
+                    raise
+
+                # The ids retried are the only ones still unsent; keep the results of earlier attempts.
+                infos.append(self.failure_info(registration_ids, e, attempt, retries, retry_scheduler))
+                break
+            infos.append(info)
 
             unsent_reg_ids = self.extract_unsent_reg_ids(info)
-            if unsent_reg_ids:
-                registration_ids = unsent_reg_ids
-                sleep_time = backoff / 2 + random.randrange(backoff)
-                time.sleep(float(sleep_time) / 1000)
-                if 2 * backoff < self.MAX_BACKOFF_DELAY:
-                    backoff *= 2
-            else:
+            if self.tuner:
+                self.tuner.record(len(registration_ids), self.latency.value, len(unsent_reg_ids))
+            if not unsent_reg_ids or not self.retry(unsent_reg_ids, attempt, retries, retry_scheduler):
                 break
 
-        return info
+            # Only the last attempt decides which ids are still unsent.
+            del info['errors']['Unavailable']
+            registration_ids = unsent_reg_ids
+
+        return merge_responses(infos)
+
+    def json_multicast(self, registration_ids, data=None, collapse_key=None,
+                        delay_while_idle=False, time_to_live=None, retries=5, attempt=0,
+                        retry_scheduler=None, max_workers=MAX_WORKERS):
+        """
+        Makes JSON requests to GCM servers for any number of registration ids.
+        The ids are split into chunks of MAX_REG_IDS that are sent concurrently,
+        or of the tuner's batch size with up to its number of workers.
+
+        :param registration_ids: list of the registration ids
+        :param data: dict mapping of key-value pairs of messages
+        :param attempt: number of attempts already made, when resuming a scheduled retry
+        :param retry_scheduler: overrides the scheduler given to the constructor
+        :param max_workers: maximum number of requests in flight
+        :return dict of merged errors and canonical ids, as from handle_json_response; the ids of
+            a chunk whose request raised are reported as described in failure_info
+        :raises GCMMissingRegistrationException: if registration_ids is empty
+        :raises GCMMessageTooBigException: if the JSON data is too big, before any request is made
+        """
+
+        if not registration_ids:
+            raise GCMMissingRegistrationException("Missing registration_ids")
+
+        # Every chunk shares one serialized copy of the message.
+        message = PreparedMessage(data, collapse_key, delay_while_idle, time_to_live)
+
+        batch_size = self.MAX_REG_IDS
+        if self.tuner:
+            batch_size = min(batch_size, self.tuner.batch_size)
+            max_workers = min(max_workers, self.tuner.workers)
+
+        chunks = [registration_ids[i:i + batch_size]
+                    for i in range(0, len(registration_ids), batch_size)]
+        results = [None] * len(chunks)
+
+        pending = Queue.Queue()
+        for i in range(len(chunks)):
+            pending.put(i)
+
+        def worker():
+            while True:
+                try:
+                    i = pending.get_nowait()
+                except Queue.Empty:
+                    return
+
+                try:
+                    results[i] = self.json_request(
+                        chunks[i], retries=retries, attempt=attempt,
+                        retry_scheduler=retry_scheduler, message=message
+                    )
+                except Exception as e:
+                    # A failed chunk does not lose the results of the others.
+                    results[i] = e
+
+        workers = min(max(1, max_workers), len(chunks))
+        if workers == 1:
+            worker()
+        else:
+            threads = [threading.Thread(target=worker) for i in range(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        infos = []
+        for chunk, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                infos.append(self.failure_info(chunk, result, attempt, retries, retry_scheduler))
+            else:
+                infos.append(result)
+
+        return merge_responses(infos)
@@ -0,0 +1,142 @@
+import httplib
+import Queue
+import select
+import socket
+import urlparse
+
+
+class ResponseLostError(Exception):
+    """
+    The request was sent but its response could not be read, so the server
+    may have acted on it.
+    """
+
+
+class HTTPConnectionPool(object):
+    """
+    Pool of keep-alive HTTP(S) connections to a single URL.
+    Connections are reused across requests and threads so each request does
+    not pay for a new TCP and TLS handshake.
+
+    On App Engine, httplib is backed by urlfetch unless the sockets API is
+    enabled (GAE_USE_SOCKETS_HTTPLIB, see app.yaml.example); there every
+    request is a separate fetch and the pool reuses nothing.
+    """
+
+    def __init__(self, url, size=4, timeout=10, proxy=None):
+        """ url: url that requests are posted to.
+            size: maximum number of idle connections kept open.
+            timeout: socket timeout in seconds.
+            proxy: can be string "host:port" or dict {'https':'host:port'}
+        """
+        parts = urlparse.urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+
+        if isinstance(proxy, dict):
+            proxy = proxy.get(self.scheme)
+        if proxy:
+            proxy = urlparse.urlsplit(proxy if '//' in proxy else '//' + proxy)
+        self.proxy = proxy
+
+        self.size = size
+        self.timeout = timeout
+        self.idle = Queue.LifoQueue(size)
+
+    def connect(self):
+        if self.scheme == 'https':
+            cls = httplib.HTTPSConnection
+        else:
+            cls = httplib.HTTPConnection
+
+        if not self.proxy:
+            return cls(self.host, self.port, timeout=self.timeout)
+
+        connection = cls(self.proxy.hostname, self.proxy.port, timeout=self.timeout)
+        connection.set_tunnel(self.host, self.port)
+        return connection
+
+    @staticmethod
+    def is_dropped(connection):
+        """ True if the server closed an idle connection: an idle keep-alive
+            connection has nothing to read until a request is sent on it.
+        """
+        sock = getattr(connection, 'sock', None)
+        if sock is None:
+            return False
+
+        try:
+            readable, writable, errors = select.select([sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return True
+
+        return bool(readable)
+
+    def acquire(self):
+        while True:
+            try:
+                connection = self.idle.get_nowait()
+            except Queue.Empty:
+                return self.connect(), False
+
+            if not self.is_dropped(connection):
+                return connection, True
+
+            connection.close()
+
+    def release(self, connection):
+        try:
+            self.idle.put_nowait(connection)
+        except Queue.Full:
+            connection.close()
+
+    def request(self, body, headers):
+        """
+        Posts body to the pool's url.
+
+        :return tuple of status, dict of response headers and response body
+        :raises httplib.HTTPException, socket.error: if the request could not be sent
+        :raises ResponseLostError: if the request was sent but no response was read
+        """
+
+        connection, reused = self.acquire()
+        while True:
+            try:
+                connection.request('POST', self.path, body, headers)
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if not reused:
+                    raise
+
+                # The server may have closed an idle connection. The request was not sent
+                # whole, so GCM did not act on it; retry once on a new connection.
+                connection, reused = self.connect(), False
+                continue
+
+            # Once the request is sent, GCM may have acted on it, so a failure here is
+            # not retried: a retry could deliver the message twice.
+            try:
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                raise ResponseLostError(str(e))
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(connection)
+
+        return response.status, dict(response.getheaders()), data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Queue.Empty:
+                return
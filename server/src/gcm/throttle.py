@@ -0,0 +1,334 @@
+import math
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled at rate tokens per second, holding up to capacity tokens.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, tokens, max_wait):
+        """
+        Takes tokens from the bucket, going into debt if needed.
+
+        :return seconds to wait before using the tokens, or None if that exceeds max_wait
+        """
+
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+
+            wait = max(0.0, (tokens - self.tokens) / self.rate)
+            if wait > max_wait:
+                return None
+
+            self.tokens -= tokens
+            return wait
+
+    def refund(self, tokens):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + tokens)
+
+
+class SharedBucket(object):
+    """
+    Allows rate tokens per one-second window, counted in a store shared by every process
+    that uses the same key, so the rate is a limit on all of them together.
+    A burst can reach twice the rate across the boundary of two windows.
+
+    The store has the interface of App Engine's memcache: incr(key, delta) returns the new
+    value, or None if the key is missing or the store is unavailable; decr(key, delta) and
+    add(key, value, time) as memcache.  If the store is unavailable, tokens are not limited.
+    """
+
+    # Seconds a window's counter is kept.
+    WINDOW_TTL = 10
+
+    def __init__(self, rate, store, key):
+        self.rate = rate
+        self.store = store
+        self.key = key
+        # The window of the last reservation made by each thread, for refund.
+        self.reserved = threading.local()
+
+    def count(self, window, tokens):
+        key = '%s-%d' % (self.key, window)
+        count = self.store.incr(key, delta=tokens)
+        if count is None:
+            self.store.add(key, 0, time=self.WINDOW_TTL)
+            count = self.store.incr(key, delta=tokens)
+        return count
+
+    def reserve(self, tokens, max_wait):
+        """
+        Takes tokens from the first window with room for them, this one or a later one.
+
+        :return seconds to wait for that window, or None if that exceeds max_wait
+        """
+
+        now = time.time()
+        window = int(now)
+        while window - now <= max_wait:
+            count = self.count(window, tokens)
+            # A request for more than the rate has a window of its own.
+            if count is None or count <= self.rate or count == tokens:
+                self.reserved.window = window
+                return max(0.0, window - now)
+
+            self.store.decr('%s-%d' % (self.key, window), delta=tokens)
+            window += 1
+
+        self.reserved.window = None
+        return None
+
+    def refund(self, tokens):
+        window = getattr(self.reserved, 'window', None)
+        if window is not None:
+            self.store.decr('%s-%d' % (self.key, window), delta=tokens)
+            self.reserved.window = None
+
+
+class RateLimiter(object):
+    """
+    Limits requests per second and registration ids per second.
+    Shared by every thread sending through the same GCM object, and with a store,
+    by every process using the same key.
+    """
+
+    def __init__(self, requests_per_second=None, reg_ids_per_second=None, max_wait=1.0, store=None, key='gcm-rate'):
+        """ requests_per_second: maximum rate of requests, or None for no limit.
+            reg_ids_per_second: maximum rate of registration ids, or None for no limit.
+            max_wait: longest a caller is made to wait, in seconds.
+            store: optional memcache-like store that holds the counts, see SharedBucket;
+                without one, the rates limit this process alone.
+            key: prefix of the store's keys.
+        """
+        def bucket(rate, name):
+            if not rate:
+                return None
+            if store:
+                return SharedBucket(rate, store, '%s-%s' % (key, name))
+            return TokenBucket(rate)
+
+        self.requests = bucket(requests_per_second, 'requests')
+        self.reg_ids = bucket(reg_ids_per_second, 'reg_ids')
+        self.max_wait = max_wait
+
+    def acquire(self, reg_ids=1):
+        """
+        Waits until a request for reg_ids registration ids may be sent.
+
+        :return False, without waiting, if the wait would be longer than max_wait
+        """
+
+        buckets = [(self.requests, 1), (self.reg_ids, reg_ids)]
+        buckets = [(bucket, tokens) for bucket, tokens in buckets if bucket]
+
+        waits = []
+        for bucket, tokens in buckets:
+            wait = bucket.reserve(tokens, self.max_wait)
+            if wait is None:
+                for reserved, tokens in buckets[:len(waits)]:
+                    reserved.refund(tokens)
+                return False
+            waits.append(wait)
+
+        if waits and max(waits):
+            time.sleep(max(waits))
+        return True
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to a failing service.
+    The circuit opens after threshold consecutive failures, or when the service
+    sends Retry-After. Once reset_timeout (or Retry-After) passes, a single probe
+    request is let through; its success closes the circuit again.
+
+    With a store, the circuit is shared by every process using the same key: one
+    that opens it stops the others within SYNC_INTERVAL, and only one of them
+    probes.  The store has the interface of App Engine's memcache (get, set, add
+    and delete); failures are counted by each process.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    # Seconds between reads of the shared circuit.
+    SYNC_INTERVAL = 1.0
+
+    def __init__(self, threshold=5, reset_timeout=30, store=None, key='gcm-circuit'):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.store = store
+        self.key = key
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_until = 0
+        self.synced = 0
+        self.lock = threading.Lock()
+
+    def sync(self, now):
+        # Adopt a circuit opened by another process.
+        if not self.store or now - self.synced < self.SYNC_INTERVAL:
+            return
+
+        self.synced = now
+        opened_until = self.store.get(self.key)
+        if opened_until and opened_until > max(now, self.opened_until):
+            self.state = self.OPEN
+            self.opened_until = opened_until
+
+    def allow(self):
+        with self.lock:
+            now = time.time()
+            self.sync(now)
+            if self.state == self.CLOSED:
+                return True
+
+            if now < self.opened_until:
+                return False
+
+            # Let one probe through; everyone else waits for another reset_timeout.
+            self.opened_until = now + self.reset_timeout
+            if self.store and not self.store.add(self.key + '-probe', 1, time=int(math.ceil(self.reset_timeout))):
+                # Another process is probing; check again soon, since its success closes the circuit.
+                self.state = self.OPEN
+                self.opened_until = now + self.SYNC_INTERVAL
+                return False
+
+            self.state = self.HALF_OPEN
+            return True
+
+    def retry_after(self):
+        """
+        Seconds until requests will be let through again.
+        """
+
+        with self.lock:
+            if self.state == self.CLOSED:
+                return 0
+            return max(0, self.opened_until - time.time())
+
+    def success(self):
+        with self.lock:
+            if self.state != self.CLOSED and self.store:
+                self.store.delete(self.key)
+                self.store.delete(self.key + '-probe')
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self, retry_after=None):
+        with self.lock:
+            if self.state == self.HALF_OPEN and self.store:
+                self.store.delete(self.key + '-probe')
+            self.failures += 1
+            if retry_after or self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                self.open(retry_after or self.reset_timeout)
+
+    def hold(self, retry_after):
+        # The service asked for no requests for retry_after seconds.
+        with self.lock:
+            self.open(retry_after)
+
+    def open(self, timeout):
+        self.state = self.OPEN
+        self.opened_until = max(self.opened_until, time.time() + timeout)
+        if self.store:
+            self.store.set(self.key, self.opened_until, time=int(math.ceil(timeout)) + 1)
+
+
+class BatchTuner(object):
+    """
+    Adjusts the number of registration ids per request and the number of requests
+    in flight from the latency and Unavailable rate of recent requests.
+    Every window requests, it halves the batch and drops a worker if requests were
+    slow or failing, or grows the batch and adds a worker if they were fast and healthy.
+    """
+
+    def __init__(self, min_batch_size=100, max_batch_size=1000, min_workers=1, max_workers=4,
+                    target_latency=2.0, max_error_rate=0.05, window=20, max_backoff_scale=16):
+        """ min_batch_size, max_batch_size: bounds on registration ids per request.
+            min_workers, max_workers: bounds on requests in flight.
+            target_latency: request latency, in seconds, above which the tuner backs off.
+            max_error_rate: fraction of Unavailable ids above which the tuner backs off.
+            window: number of requests between adjustments.
+            max_backoff_scale: bound on the factor applied to the retry backoff.
+        """
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.target_latency = target_latency
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.max_backoff_scale = max_backoff_scale
+
+        self.batch_size = max_batch_size
+        self.workers = max_workers
+        self.backoff_scale = 1
+        self.latency = 0.0
+        self.error_rate = 0.0
+        # batch size -> [requests, mean latency, mean error rate], for inspection.
+        self.history = {}
+
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def record(self, reg_ids, latency, unavailable):
+        """
+        Records a request for reg_ids registration ids that took latency seconds,
+        of which unavailable ids were not sent.
+        """
+
+        with self.lock:
+            self.samples.append((reg_ids, latency, unavailable))
+
+            stats = self.history.setdefault(self.batch_size, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += (latency - stats[1]) / stats[0]
+            stats[2] += (float(unavailable) / max(reg_ids, 1) - stats[2]) / stats[0]
+
+            if len(self.samples) >= self.window:
+                self.adjust()
+
+    def adjust(self):
+        total = sum([sample[0] for sample in self.samples])
+        self.latency = sum([sample[1] for sample in self.samples]) / len(self.samples)
+        self.error_rate = float(sum([sample[2] for sample in self.samples])) / max(total, 1)
+        self.samples = []
+
+        if self.error_rate > self.max_error_rate or self.latency > self.target_latency:
+            self.batch_size = max(self.min_batch_size, self.batch_size / 2)
+            self.workers = max(self.min_workers, self.workers - 1)
+            self.backoff_scale = min(self.max_backoff_scale, self.backoff_scale * 2)
+        elif self.error_rate < self.max_error_rate / 2 and self.latency < self.target_latency / 2:
+            self.batch_size = min(self.max_batch_size, self.batch_size * 2)
+            self.workers = min(self.max_workers, self.workers + 1)
+            self.backoff_scale = max(1, self.backoff_scale / 2)
+
+    def settings(self):
+        """
+        :return dict of the current batch size, workers and backoff scale, and the measurements behind them
+        """
+
+        with self.lock:
+            return {
+                'batch_size': self.batch_size,
+                'workers': self.workers,
+                'backoff_scale': self.backoff_scale,
+                'latency': self.latency,
+                'error_rate': self.error_rate,
+                'history': dict((size, {'requests': stats[0], 'latency': stats[1], 'error_rate': stats[2]})
+                                    for size, stats in self.history.items()),
+            }
@@ -1,35 +1,280 @@
+import hashlib
+import json
 import logging
 
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from webapp2 import RequestHandler
+from webapp2 import Route
+
 from gcm import GCM
+from gcm import GCM_URL
+from gcm import GCMConnectionException
+from gcm import GCMException
+from gcm import GCMUnavailableException
+from gcm.throttle import BatchTuner
+from gcm.throttle import CircuitBreaker
+from gcm.throttle import RateLimiter
 
 from config import Config
 from device import Device
+from etag import ETag
+from migration import Migration
+from outbox import Outbox
+from topicIndex import TopicIndex
 from user import User
 
+class RegIdResolver(object):
+    # Maximum number of values in a single IN filter.
+    BATCH_SIZE = 30
+
+    def __init__(self):
+        self.rpcs = 0
+
+    @staticmethod
+    def batches(values, size):
+        values = sorted(set(values))
+        return [values[i:i + size] for i in range(0, len(values), size)]
+
+    def query_async(self, prop, values):
+        # Projection queries return the reg_id straight from the index, so no get() per key is needed.
+        futures = []
+        for batch in self.batches(values, self.BATCH_SIZE):
+            query = Device.query(prop.IN(batch), ancestor=Device.ROOT_KEY)
+            futures.append(query.fetch_async(projection=[Device.reg_id]))
+            # An IN filter is issued as one sub-query per value.
+            self.rpcs += len(batch)
+
+        return futures
+
+    def get_async(self, dev_ids):
+        # Devices are keyed by dev_id, so they are read by key in one batch.
+        if not dev_ids:
+            return []
+
+        self.rpcs += 1
+        return ndb.get_multi_async([Device.get_key(dev_id) for dev_id in dev_ids])
+
+    def resolve(self, reg_ids=[], dev_ids=[], user_ids=[]):
+        # Issue every request before waiting on any of them so the round trips overlap.
+        dev_ids = sorted(set(dev_ids))
+        futures = []
+        futures.extend(self.query_async(Device.user_id, user_ids))
+        device_futures = self.get_async(dev_ids)
+
+        results = set(reg_ids)
+        missing = []
+        for dev_id, future in zip(dev_ids, device_futures):
+            device = future.get_result()
+            if device:
+                results.add(device.reg_id)
+            else:
+                missing.append(dev_id)
+
+        # Devices stored before they were keyed by dev_id.
+        if missing and not Migration.is_done(Device):
+            futures.extend(self.query_async(Device.dev_id, missing))
+
+        for future in futures:
+            results.update([device.reg_id for device in future.get_result()])
+
+        logging.getLogger().debug('resolved reg_ids (' + str(len(results)) + ') with ' + str(self.rpcs) + ' rpcs')
+        return sorted(results)
+
+class RegIdFeedback(object):
+    # Errors that mean a reg_id will never be deliverable again.
+    DEAD_ERRORS = ('NotRegistered', 'InvalidRegistration')
+
+    def __init__(self):
+        self.rpcs = 0
+
+    def query_async(self, reg_ids, keys_only):
+        futures = []
+        for batch in RegIdResolver.batches(reg_ids, RegIdResolver.BATCH_SIZE):
+            query = Device.query(Device.reg_id.IN(batch), ancestor=Device.ROOT_KEY)
+            futures.append(query.fetch_async(keys_only=keys_only))
+            self.rpcs += len(batch)
+
+        return futures
+
+    def apply(self, response):
+        dead_reg_ids = []
+        for error in self.DEAD_ERRORS:
+            dead_reg_ids.extend(response.get('errors', {}).get(error, []))
+        canonical = response.get('canonical', {})
+
+        # Look up every affected device before waiting on any of the queries.
+        dead_futures = self.query_async(dead_reg_ids, keys_only=False)
+        canonical_futures = self.query_async(canonical.keys(), keys_only=False)
+
+        # Changes to apply to the fan-out indexes, dev_id -> reg_id.
+        updates = {}
+
+        dead_keys = []
+        for future in dead_futures:
+            for device in future.get_result():
+                dead_keys.append(device.key)
+                updates[device.dev_id] = None
+
+        devices = []
+        dead = set(dead_keys)
+        for future in canonical_futures:
+            for device in future.get_result():
+                if device.key in dead:
+                    continue
+                device.reg_id = canonical[device.reg_id]
+                device.revision += 1
+                devices.append(device)
+                updates[device.dev_id] = device.reg_id
+
+        logging.getLogger().debug('remove devices (' + str(len(dead_keys)) + ')=' + str(dead_keys))
+        logging.getLogger().debug('replace reg_ids (' + str(len(devices)) + ')')
+
+        futures = []
+        if dead_keys:
+            futures.extend(ndb.delete_multi_async(dead_keys))
+            self.rpcs += 1
+        if devices:
+            futures.extend(ndb.put_multi_async(devices))
+            self.rpcs += 1
+        ndb.Future.wait_all(futures)
+        if futures:
+            ETag.bump(Device)
+
+        if updates:
+            TopicIndex.update_devices(updates)
+
+        return dead_keys, devices
+
 class gcm(object):
+    RETRY_URL = '/task/gcm/retry/'
+    SETTINGS_URL = '/task/gcm/settings/'
+
+    # Maximum number of reg_ids per retry task, to stay under the task size limit.
+    RETRY_BATCH_SIZE = 250
+    # Attempts at a send that raised, and the delay (seconds) before the first retry, doubled for each one after.
+    RETRIES = 5
+    RETRY_DELAY = 2
+
+    # Outbound connections to GCM.
+    URL = GCM_URL
+    TIMEOUT = 10
+
+    # Delivery lanes. Each has its own queue, senders and outbound rate limits so that large
+    # broadcasts drain in the background without delaying direct messages.
+    # latency is the target (seconds) from enqueue to send; workers is the number of concurrent GCM requests
+    # per instance. The rates are limits on all instances together, counted in memcache.
+    LANE_DIRECT = 'direct'
+    LANE_BROADCAST = 'broadcast'
+    LANES = {
+        LANE_DIRECT : {'queue' : 'gcm-direct', 'latency' : 5,
+            'requests_per_second' : 50, 'reg_ids_per_second' : 1000, 'workers' : 2},
+        LANE_BROADCAST : {'queue' : 'gcm-broadcast', 'latency' : 300,
+            'requests_per_second' : 50, 'reg_ids_per_second' : 19000, 'workers' : 4},
+    }
+
+    # Bounds on the registration ids per request, which adapt to GCM's latency and Unavailable rate.
+    MIN_BATCH_SIZE = 100
+    MAX_BATCH_SIZE = 1000
+
+    # Stop sending after this many consecutive failures, and probe again after the timeout (seconds).
+    # The open circuit is shared through memcache, so one instance tripping stops the others.
+    BREAKER_THRESHOLD = 5
+    BREAKER_RESET_TIMEOUT = 30
+
+    # Seconds GCM holds a message for an offline device.
+    TIME_TO_LIVE = 3600
+
+    # Longer contexts are hashed to keep collapse keys short.
+    MAX_COLLAPSE_KEY = 64
+
+    # Senders are kept for the life of the instance so their connections are reused, until the api_key changes.
+    # Each lane has its own circuit breaker, so failing broadcasts do not stop direct messages.
+    senders = {}
+
     @staticmethod
-    def send(data, reg_ids=[], dev_ids=[], user_ids=[]):
+    def get_sender(api_key, lane=LANE_DIRECT):
+        sender = gcm.senders.get((api_key, gcm.URL, lane))
+        if not sender:
+            gcm.evict(api_key)
+
+            settings = gcm.LANES[lane]
+            sender = GCM(api_key, url=gcm.URL, pool_size=settings['workers'], timeout=gcm.TIMEOUT,
+                rate_limiter=RateLimiter(settings['requests_per_second'], settings['reg_ids_per_second'],
+                    store=memcache, key='gcm-rate-%s' % (lane)),
+                circuit_breaker=CircuitBreaker(gcm.BREAKER_THRESHOLD, gcm.BREAKER_RESET_TIMEOUT,
+                    store=memcache, key='gcm-circuit-%s' % (lane)),
+                tuner=BatchTuner(gcm.MIN_BATCH_SIZE, gcm.MAX_BATCH_SIZE, 1, settings['workers']))
+            gcm.senders[(api_key, gcm.URL, lane)] = sender
+
+        return sender
+
+    @staticmethod
+    def evict(api_key):
+        # Close the senders of any other api_key, such as one replaced in the Config.
+        for key in [key for key in gcm.senders.keys() if key[0] != api_key or key[1] != gcm.URL]:
+            logging.getLogger().debug('evict sender: lane: %s' % (key[2]))
+            gcm.senders.pop(key).pool.close()
+
+    @staticmethod
+    def get_settings():
+        # Current tuning of this instance's senders, by lane.
+        settings = {}
+        for (api_key, url, lane), sender in gcm.senders.items():
+            settings[lane] = sender.tuner.settings()
+            settings[lane]['circuit'] = sender.circuit_breaker.state
+
+        return settings
+
+    @staticmethod
+    def get_collapse_key(data):
+        # A newer message of the same type and context replaces an undelivered older one.
+        key = str(data.get('type', 'message')) + ':' + str(data.get('context', ''))
+        if len(key) > gcm.MAX_COLLAPSE_KEY:
+            key = str(data.get('type', 'message')) + ':' + hashlib.md5(key).hexdigest()
+
+        return key
+
+    @staticmethod
+    def enqueue_retry(data, reg_ids, attempt, delay, collapse_key=None, time_to_live=TIME_TO_LIVE, lane=LANE_DIRECT, outbox=None):
+        logging.getLogger().debug('retry: lane: %s, attempt: %d, delay: %f, reg_ids (%d)' % (lane, attempt, delay, len(reg_ids)))
+
+        for batch in RegIdResolver.batches(reg_ids, gcm.RETRY_BATCH_SIZE):
+            payload = json.dumps({'data' : data, 'reg_ids' : batch, 'attempt' : attempt,
+                'collapse_key' : collapse_key, 'time_to_live' : time_to_live, 'lane' : lane, 'outbox' : outbox})
+            taskqueue.add(queue_name=gcm.LANES[lane]['queue'], url=gcm.RETRY_URL,
+                payload=payload, countdown=delay)
+
+    @staticmethod
+    def requeue(data, reg_ids, attempt, collapse_key, time_to_live, lane, outbox):
+        # reg_ids whose send raised, e.g. while the circuit is open, are retried from the task queue
+        # and reported as Unavailable, so a fan-out keeps them pending instead of counting them as failed.
+        if attempt + 1 >= gcm.RETRIES:
+            logging.getLogger().error('giving up: attempt: %d, reg_ids (%d)' % (attempt, len(reg_ids)))
+            return
+
+        gcm.enqueue_retry(data, reg_ids, attempt + 1, gcm.RETRY_DELAY * 2 ** attempt,
+            collapse_key=collapse_key, time_to_live=time_to_live, lane=lane, outbox=outbox)
+        return {'errors' : {'Unavailable' : list(reg_ids)}}
+
+    @staticmethod
+    def get_routes(base_url=''):
+        return [ \
+        Route(template=str(base_url) + gcm.RETRY_URL, handler=GcmRetryHandler, methods=('POST',)),
+        Route(template=str(base_url) + gcm.SETTINGS_URL, handler=GcmSettingsHandler, methods=('GET',)),
+        ]
+
+    @staticmethod
+    def send(data, reg_ids=[], dev_ids=[], user_ids=[], attempt=0, collapse_key=None, time_to_live=TIME_TO_LIVE, lane=LANE_DIRECT, outbox=None):
         logging.getLogger().debug('data=' + str(data));
         logging.getLogger().debug('reg_ids (' + str(len(reg_ids)) + ')=' + str(reg_ids))
         logging.getLogger().debug('dev_ids (' + str(len(dev_ids)) + ')=' + str(dev_ids))
         logging.getLogger().debug('user_ids (' + str(len(user_ids)) + ')=' + str(user_ids))
 
-        # Add user_ids.
-        user_keys = []
-        for user_id in user_ids:
-            user_keys.extend(Device.query(Device.user_id == user_id, ancestor=Device.ROOT_KEY).fetch(keys_only=True))
-        logging.getLogger().debug('user_keys (' + str(len(user_keys)) + ')=' + str(user_keys))
-
-        dev_ids.extend([user_key.get().dev_id for user_key in user_keys])
-        logging.getLogger().debug('dev_ids (' + str(len(dev_ids)) + ')=' + str(dev_ids))
-
-        # Add dev_ids.
-        device_keys = []
-        for dev_id in dev_ids:
-            device_keys.extend(Device.query(Device.dev_id == dev_id, ancestor=Device.ROOT_KEY).fetch(keys_only=True))
-        logging.getLogger().debug('device_keys (' + str(len(device_keys)) + ')=' + str(device_keys))
-
-        reg_ids.extend([device_key.get().reg_id for device_key in device_keys])
+        # Resolve user_ids and dev_ids.
+        reg_ids = RegIdResolver().resolve(reg_ids=reg_ids, dev_ids=dev_ids, user_ids=user_ids)
         logging.getLogger().debug('reg_ids (' + str(len(reg_ids)) + ')=' + str(reg_ids))
 
         if not reg_ids:
@@ -37,33 +282,65 @@ class gcm(object):
             return
 
         # Get API key.
-        config = Config.get_master_db()
+        config = Config.get_active()
         if not config or not config.gcm_api_key:
             logging.getLogger().error('no GCM API key')
             return
 
+        if not collapse_key:
+            collapse_key = gcm.get_collapse_key(data)
+
         # Send message.
         try:
-            gcm = GCM(config.gcm_api_key)
-            response = gcm.json_request(
+            # Unavailable reg_ids are retried from the task queue rather than by sleeping here.
+            scheduler = lambda unsent_reg_ids, attempt, delay: gcm.enqueue_retry(data, unsent_reg_ids, attempt, delay,
+                collapse_key=collapse_key, time_to_live=time_to_live, lane=lane, outbox=outbox)
+            sender = gcm.get_sender(config.gcm_api_key, lane)
+            response = sender.json_multicast(
                 registration_ids=reg_ids, data=data,
-                collapse_key='uptoyou', delay_while_idle=True, time_to_live=3600
+                collapse_key=collapse_key, delay_while_idle=True, time_to_live=time_to_live,
+                attempt=attempt, retry_scheduler=scheduler, max_workers=gcm.LANES[lane]['workers']
             )
         except Exception as e:
                 logging.getLogger().error('exception=' + str(e))
-                return
+                if isinstance(e, GCMException) and not isinstance(e, (GCMUnavailableException, GCMConnectionException)):
+                    return
+
+                return gcm.requeue(data, reg_ids, attempt, collapse_key, time_to_live, lane, outbox)
 
         # Handling errors
         if 'errors' in response:
             for error, reg_ids in response['errors'].items():
-                logging.getLogger().error('error ' + error)
-                # Check for errors and act accordingly
-                if error is 'NotRegistered':
-                    # Remove reg_ids from database
-                    for reg_id in reg_ids:
-                        logging.getLogger().debug('remove ' + reg_id)
-
-        if 'canonical' in response:
-            for reg_id, canonical_id in response['canonical'].items():
-                # Replace reg_id with canonical_id in your database
-                logging.getLogger().debug('replace ' + reg_id + ' with ' + canonical_id)
+                logging.getLogger().error('error ' + error + ' (' + str(len(reg_ids)) + ')')
+
+        # Remove dead reg_ids and replace reg_ids with canonical ids.
+        if 'errors' in response or 'canonical' in response:
+            RegIdFeedback().apply(response)
+
+        return response
+
+class GcmRetryHandler(RequestHandler):
+    # Resend to the reg_ids of a scheduled retry.
+    def post(self, *args, **kwargs):
+        logging.getLogger().debug('post: args: %s, kwargs: %s' % (args, kwargs))
+
+        try:
+            j = json.loads(self.request.body)
+        except ValueError:
+            # A malformed task will never succeed; do not retry.
+            logging.getLogger().error('decoding error')
+            return
+
+        response = gcm.send(data=j['data'], reg_ids=j['reg_ids'], attempt=j['attempt'],
+            collapse_key=j.get('collapse_key'), time_to_live=j.get('time_to_live', gcm.TIME_TO_LIVE),
+            lane=j.get('lane', gcm.LANE_DIRECT), outbox=j.get('outbox'))
+
+        # Take the resent reg_ids off the fan-out's pending list.
+        if j.get('outbox'):
+            Outbox.checkpoint(ndb.Key(urlsafe=j['outbox']), j['reg_ids'], response)
+
+class GcmSettingsHandler(RequestHandler):
+    # Show the adaptive settings of this instance's senders.
+    def get(self, *args, **kwargs):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(gcm.get_settings(), indent=2, sort_keys=True))
@@ -0,0 +1,29 @@
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+
+class Generation(object):
+    # A counter in memcache that every write to what it covers bumps, so values cached under one generation
+    # are not used after a write. An evicted counter is seeded again from the clock in milliseconds, scaled so
+    # the bumps made since the last seed cannot catch up with it, plus a random part, so no generation is reused.
+    SCALE = 1000
+
+    @staticmethod
+    def seed():
+        return int(time.time() * 1000) * Generation.SCALE + random.randint(0, Generation.SCALE - 1)
+
+    @staticmethod
+    def get(key):
+        generation = memcache.get(key)
+        if generation is None:
+            memcache.add(key, Generation.seed())
+            generation = memcache.get(key)
+
+        return generation
+
+    @staticmethod
+    def bump(key):
+        logging.getLogger().debug('bump: key: %s' % (key))
+        memcache.incr(key, initial_value=Generation.seed())
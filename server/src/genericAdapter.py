@@ -1,14 +1,73 @@
 import logging
 
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 from google.appengine.ext.db import BadValueError
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
+
+from etag import ETag
+from fields import Fields
+from migration import Migration
 
 class GenericAdapter(object):
-    def __init__(self, cls, allowDuplicates=False, createIfMissing=True, updateIfExists=True):
+    # A kind whose ROOT_KEY is None has no common parent: every entity is its own entity group,
+    # so writes do not contend, but queries on the kind are eventually consistent.
+    # With consistent set, query results are read again by key, so entities that were
+    # changed or deleted since the index was updated are returned as they are now.
+    # Collection reads are paged, see read_page.
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+    # Objects per datastore read when iterating over a whole collection, see iter_all.
+    BATCH_SIZE = 200
+    # Maximum number of values in a single IN filter.
+    IN_SIZE = 30
+
+    def __init__(self, cls, allowDuplicates=False, createIfMissing=True, updateIfExists=True, consistent=True):
         self.cls = cls
         self.allowDuplicates = allowDuplicates
         self.createIfMissing = createIfMissing
         self.updateIfExists = updateIfExists
+        self.consistent = consistent
+
+    def fetch(self, query):
+        if query.ancestor or not self.consistent:
+            return query.fetch()
+
+        return [obj for obj in ndb.get_multi(query.fetch(keys_only=True)) if obj]
+
+    def fetch_page(self, query, limit, cursor=None):
+        if query.ancestor or not self.consistent:
+            return query.fetch_page(limit, start_cursor=cursor)
+
+        keys, cursor, more = query.fetch_page(limit, start_cursor=cursor, keys_only=True)
+        return [obj for obj in ndb.get_multi(keys) if obj], cursor, more
+
+    def get_projection(self, fields):
+        # The properties to project for fields, if a projection query can serve them: every one an indexed,
+        # single-valued property. The properties in the class's LINK_KEYS are added, so objects can still be linked.
+        if not fields:
+            return None
+
+        projection = list(fields) + [name for name in getattr(self.cls, 'LINK_KEYS', ()) if name not in fields]
+        for name in projection:
+            prop = self.cls._properties.get(name)
+            if not prop or not prop._indexed or prop._repeated:
+                return None
+
+        return tuple(projection)
+
+    def fetch_projection(self, query, limit, cursor, fields):
+        # Projected values come straight from the index, so they are not read again by key even when
+        # consistent is set, and may briefly lag behind writes to ancestor-free kinds.
+        projection = self.get_projection(fields)
+        if projection:
+            try:
+                return query.fetch_page(limit, start_cursor=cursor, projection=projection)
+            except datastore_errors.NeedIndexError:
+                logging.getLogger().warning('no index for projection: %s' % (projection, ))
+
+        return self.fetch_page(query, limit, cursor)
 
     # Create
     def create(self, kv, parent=None):
@@ -19,25 +78,91 @@ class GenericAdapter(object):
         obj = self.cls(parent=parent)
         self.cls.load(obj, kv)
 
+        # Kinds keyed by their natural id cannot store a duplicate.
+        key = self.get_natural_key(obj)
+        if key:
+            obj.key = key
+
         id = obj.get_id()
-        if id:
-            keys = self.cls.query_by_id(id)
-            if keys and not self.allowDuplicates:
-                if self.updateIfExists:
-                    logging.getLogger().debug('update existing object for create')
-                    obj = self.update_one(obj.get_id(), kv)
-                    return obj
-                else:
-                    logging.getLogger().error('duplicate object')
-                    return None
+        if id and not self.allowDuplicates and self.read_multi([id])[0]:
+            if self.updateIfExists:
+                logging.getLogger().debug('update existing object for create')
+                obj = self.update_one(obj.get_id(), kv)
+                return obj
+            else:
+                logging.getLogger().error('duplicate object')
+                return None
 
         try:
             obj.put()
         except BadValueError:
             return None
 
+        ETag.bump(self.cls)
         return obj
 
+    def create_multi(self, kvs, parent=None):
+        # One result per kv, in order: the created (or, with updateIfExists, updated) object, or None if
+        # the kv is not valid or is a refused duplicate. Objects already stored under their natural key are
+        # found with one batched get, and everything is written with one put_multi.
+        logging.getLogger().debug('create multi: kvs (%d), parent: %s' % (len(kvs), parent))
+        if not parent:
+            parent=self.cls.ROOT_KEY
+
+        results = []
+        for kv in kvs:
+            obj = self.cls(parent=parent)
+            try:
+                self.cls.load(obj, kv)
+                obj._check_initialized()
+            except (BadValueError, TypeError):
+                logging.getLogger().error('invalid object: %s' % (kv, ))
+                obj = None
+
+            results.append(obj)
+
+        puts = [obj for obj in results if obj]
+        keys = [self.get_natural_key(obj) for obj in puts]
+        if puts and all(keys):
+            for obj, key in zip(puts, keys):
+                obj.key = key
+
+            ids = [obj.get_id() for obj in puts]
+            stored = dict(zip(ids, self.read_multi(ids)))
+
+            # id -> object it is written to, so an id given twice updates the object created for it.
+            objs = {}
+            for i, obj in enumerate(results):
+                if not obj:
+                    continue
+
+                id = obj.get_id()
+                existing = objs.get(id) or stored.get(id)
+                if existing and not self.allowDuplicates:
+                    if not self.updateIfExists:
+                        logging.getLogger().error('duplicate object: %s' % (id))
+                        results[i] = None
+                        continue
+
+                    self.cls.load(existing, kvs[i])
+                    existing.revision += 1
+                    obj = existing
+
+                objs[id] = obj
+                results[i] = obj
+
+            puts = objs.values()
+
+        try:
+            ndb.put_multi(puts)
+        except BadValueError:
+            return None
+        finally:
+            if puts:
+                ETag.bump(self.cls)
+
+        return results
+
     def create_child(self, id, request, body=None):
         keys = self.cls.query_by_id(id)
         if not keys:
@@ -56,7 +181,68 @@ class GenericAdapter(object):
         if not parent:
             parent=self.cls.ROOT_KEY
 
-        return self.cls.query(ancestor=parent).order(-self.cls.modified).fetch()
+        return self.fetch(self.cls.query(ancestor=parent).order(-self.cls.modified))
+
+    def read_page(self, limit=None, cursor=None, parent=None, fields=None):
+        # Up to limit objects, newest first, starting where the urlsafe cursor of the previous page left off.
+        # Returns the objects and the urlsafe cursor of the next page (None on the last page),
+        # or None for both if the cursor is not valid.
+        # With fields, the objects may only have those properties set, see fetch_projection.
+        if not parent:
+            parent=self.cls.ROOT_KEY
+
+        limit = max(1, min(limit or self.DEFAULT_LIMIT, self.MAX_LIMIT))
+        query = self.cls.query(ancestor=parent).order(-self.cls.modified)
+
+        try:
+            objs, cursor, more = self.fetch_projection(query, limit, Cursor(urlsafe=cursor) if cursor else None, fields)
+        except (datastore_errors.BadValueError, datastore_errors.BadRequestError):
+            logging.getLogger().error('invalid cursor: %s' % (cursor))
+            return None, None
+
+        if not more or not cursor:
+            return objs, None
+
+        return objs, cursor.urlsafe()
+
+    def iter_all(self, parent=None, fields=None):
+        # Every object, newest first, read BATCH_SIZE at a time so only one batch is held in memory.
+        if not parent:
+            parent=self.cls.ROOT_KEY
+
+        query = self.cls.query(ancestor=parent).order(-self.cls.modified)
+
+        cursor = None
+        more = True
+        while more:
+            objs, cursor, more = self.fetch_projection(query, self.BATCH_SIZE, cursor, fields)
+            for obj in objs:
+                yield obj
+
+            more = more and cursor
+
+    def get_key(self, id):
+        # The key of the object with id, without reading it.
+        if hasattr(self.cls, 'get_key'):
+            return self.cls.get_key(id)
+
+        return self.cls.query_by_id(id)[0]
+
+    def get_version(self, id):
+        # The version of the object with id for its ETag, and the object if it had to be read to get it.
+        # None for both if there is no such object.
+        generation = ETag.get_generation(self.cls)
+        key = self.get_key(id)
+
+        version = ETag.get_version(generation, key)
+        if version:
+            return version, None
+
+        obj = self.read_one(id)
+        if not obj:
+            return None, None
+
+        return ETag.set_version(generation, key, obj), obj
 
     def read_one(self, id):
         keys = self.cls.query_by_id(id)
@@ -75,10 +261,152 @@ class GenericAdapter(object):
 
         return obj
 
+    def read_multi(self, ids):
+        # One object per id, or None if there is none, read with one get_multi.
+        if hasattr(self.cls, 'get_key'):
+            keys = [self.cls.get_key(id) for id in ids]
+        else:
+            keys = [self.cls.query_by_id(id)[0] for id in ids]
+
+        objs = ndb.get_multi(keys)
+
+        # Objects stored before the kind was keyed by its natural id, found with batched IN queries
+        # until the kind is migrated; the newest one wins, as in query_by_id.
+        missing = sorted(set([id for id, obj in zip(ids, objs) if not obj]))
+        if missing and hasattr(self.cls, 'get_key') and not Migration.is_done(self.cls):
+            prop = self.cls._properties[self.cls.ID_KEY]
+            futures = []
+            for i in range(0, len(missing), self.IN_SIZE):
+                futures.append(self.cls.query(prop.IN(missing[i:i + self.IN_SIZE]), ancestor=self.cls.ROOT_KEY).fetch_async())
+
+            found = {}
+            for future in futures:
+                for obj in future.get_result():
+                    newest = found.get(obj.get_id())
+                    if not newest or newest.modified < obj.modified:
+                        found[obj.get_id()] = obj
+
+            objs = [obj or found.get(id) for id, obj in zip(ids, objs)]
+
+        return objs
+
     # Update
-    def update_all(self):
-        logging.getLogger().error('not implemented')
-        return None
+    def update_all(self, kv, limit=None, cursor=None):
+        # Patch many objects. kv is either a list of {id, fields} patches, or {filter, fields} to patch
+        # every object whose properties equal those in filter, limit objects per call from the urlsafe cursor on.
+        # Returns one result per patch (None for those that failed) or the patched objects, and the urlsafe
+        # cursor of the next objects to patch (None when done); None for both if kv is not valid.
+        logging.getLogger().debug('update all: kv: %s, limit: %s, cursor: %s' % (kv, limit, cursor))
+
+        if isinstance(kv, list):
+            ids = [Fields.get(patch, 'id') if isinstance(patch, dict) else None for patch in kv]
+            if not all([isinstance(id, basestring) for id in ids if id]):
+                logging.getLogger().error('invalid ids: %s' % (ids, ))
+                return None, None
+
+            # A malformed urlsafe id, or the key of another app, fails the request rather than just its patch.
+            try:
+                found = dict(zip([id for id in ids if id], self.read_multi([id for id in ids if id])))
+            except (TypeError, ProtocolBufferDecodeError, datastore_errors.BadArgumentError,
+                    datastore_errors.BadKeyError, datastore_errors.BadRequestError, datastore_errors.BadValueError):
+                logging.getLogger().error('invalid ids: %s' % (ids, ))
+                return None, None
+
+            objs = [found.get(id) if id else None for id in ids]
+            patches = [self.get_patch(patch) for patch in kv]
+            cursor = None
+        elif isinstance(kv, dict) and isinstance(kv.get('filter'), dict):
+            limit = max(1, min(limit or self.DEFAULT_LIMIT, self.MAX_LIMIT))
+            try:
+                query = self.cls.query(ancestor=self.cls.ROOT_KEY)
+                for name, value in kv['filter'].items():
+                    query = query.filter(self.cls._properties[name] == value)
+
+                keys, cursor, more = query.fetch_page(limit, start_cursor=Cursor(urlsafe=cursor) if cursor else None, keys_only=True)
+            except (KeyError, TypeError, datastore_errors.BadValueError, datastore_errors.BadRequestError):
+                logging.getLogger().error('invalid filter or cursor: %s, %s' % (kv['filter'], cursor))
+                return None, None
+
+            # The query may lag behind writes, so objects are checked against the filter as they are now.
+            objs = [obj for obj in ndb.get_multi(keys)
+                if obj and all([getattr(obj, name) == value for name, value in kv['filter'].items()])]
+            patches = [self.get_patch(kv)] * len(objs)
+            cursor = cursor.urlsafe() if more and cursor else None
+        else:
+            logging.getLogger().error('expected a list of patches or a filter')
+            return None, None
+
+        results = []
+        olds = {}
+        puts = {}
+        for obj, patch in zip(objs, patches):
+            if not obj or patch is None:
+                results.append(None)
+                continue
+
+            before = obj.to_dict()
+            values = dict(before)
+            values.update(patch)
+            try:
+                self.cls.load(obj, values)
+            except (BadValueError, TypeError):
+                logging.getLogger().error('invalid patch: %s' % (patch, ))
+                obj.populate(**before)
+                results.append(None)
+                continue
+
+            # The natural id is the key, so it cannot be patched.
+            old = olds.get(obj.key) or self.cls(**before)
+            if self.get_natural_key(obj) != self.get_natural_key(old):
+                logging.getLogger().error('cannot change id: %s' % (old.get_id()))
+                obj.populate(**before)
+                results.append(None)
+                continue
+
+            obj.revision += 1
+            olds[obj.key] = old
+            puts[obj.key] = obj
+            results.append(obj)
+
+        puts = puts.values()
+        try:
+            for i in range(0, len(puts), self.BATCH_SIZE):
+                ndb.put_multi(puts[i:i + self.BATCH_SIZE])
+        except BadValueError:
+            return None, None
+        finally:
+            if puts:
+                ETag.bump(self.cls)
+
+        self.updated([olds[obj.key] for obj in puts], puts)
+        return results, cursor
+
+    @staticmethod
+    def get_patch(kv):
+        # The fields of a patch, given either as {fields} or as the patch itself.
+        if not isinstance(kv, dict):
+            return None
+
+        patch = kv.get('fields')
+        if patch is None:
+            patch = dict([(name, value) for name, value in kv.items() if name not in ('id', 'filter')])
+
+        return patch if isinstance(patch, dict) else None
+
+    def get_natural_key(self, obj):
+        # The key obj's values give it, for kinds keyed by their natural id (get_key) or by several of their
+        # values (get_natural_key); None for other kinds, or if obj lacks the values.
+        if hasattr(self.cls, 'get_natural_key'):
+            return self.cls.get_natural_key(obj)
+
+        if not hasattr(self.cls, 'get_key') or not obj.get_id():
+            return None
+
+        return self.cls.get_key(obj.get_id())
+
+    def updated(self, olds, objs):
+        # Called by update_all with the objects it changed, after they are stored, and copies of them from before.
+        pass
 
     def update_one(self, id, kv=None):
         keys = self.cls.query_by_id(id)
@@ -98,10 +426,18 @@ class GenericAdapter(object):
             logging.getLogger().error('object not read')
             return None
 
+        # The natural id is the key, so it cannot be changed; otherwise the object would be left under the old one.
+        before = obj.to_dict()
+        natural_key = self.get_natural_key(obj)
         self.cls.load(obj, kv)
+        if self.get_natural_key(obj) != natural_key:
+            logging.getLogger().error('cannot change id: %s' % (id))
+            obj.populate(**before)
+            return None
 
         obj.revision += 1
         obj.put()
+        ETag.bump(self.cls)
         return obj
 
     # Delete
@@ -114,6 +450,7 @@ class GenericAdapter(object):
             return None
 
         ndb.delete_multi(keys)
+        ETag.bump(self.cls)
         return keys
 
     def delete_one(self, id):
@@ -129,4 +466,5 @@ class GenericAdapter(object):
         obj = keys[0].get()
 
         keys[0].delete()
+        ETag.bump(self.cls)
         return obj
@@ -1,7 +1,51 @@
 import logging
+import urllib
 
 from webapp2 import RequestHandler
 
+from etag import ETag
+from fields import Fields
+
+def get_fields(handler):
+    # The properties selected by the fields parameter, or None for all of them.
+    fields = Fields.get_list(handler.request.GET, 'fields')
+    if not fields:
+        return None
+
+    unknown = [name for name in fields if name not in handler.adapter.cls._properties]
+    if unknown:
+        handler.abort(400, detail='Unknown fields: %s' % (', '.join(unknown)))
+
+    return fields
+
+def not_modified(handler, etag):
+    # Tag the response, and make it a 304 if the client already has this representation.
+    handler.response.etag = etag
+    if etag not in handler.request.if_none_match:
+        return False
+
+    handler.response.status_int = 304
+    return True
+
+def read_page(handler, fields=None):
+    # Read the page of the collection selected by the limit and cursor parameters.
+    # The cursor of the next page is returned in X-Next-Cursor, and its URL in a Link header.
+    limit = Fields.get_int(handler.request.GET, 'limit')
+    objs, cursor = handler.adapter.read_page(limit=limit, cursor=handler.request.get('cursor'), fields=fields)
+    if objs is None:
+        handler.abort(400, detail='Invalid cursor')
+
+    if not cursor:
+        return objs, None
+
+    params = dict(handler.request.GET.items())
+    params['cursor'] = cursor
+    next_url = handler.request.path_url + '?' + urllib.urlencode(params)
+
+    handler.response.headers['X-Next-Cursor'] = cursor
+    handler.response.headers['Link'] = '<%s>; rel="next"' % (next_url)
+    return objs, next_url
+
 class GenericParentHandlerJson(RequestHandler):
     def __init__(self, request, response, adapter, codec):
         super(GenericParentHandlerJson, self).__init__(request, response)
@@ -19,7 +63,15 @@ class GenericParentHandlerJson(RequestHandler):
         if not kv:
             self.abort(500, detail='Decoding error')
 
-        obj = self.adapter.create(kv=kv)
+        # A list creates every object in it, with one result per object (None for those not created).
+        if isinstance(kv, list):
+            if len(kv) > self.adapter.MAX_LIMIT:
+                self.abort(413, detail='Too many objects')
+
+            obj = self.adapter.create_multi(kvs=kv)
+        else:
+            obj = self.adapter.create(kv=kv)
+
         if not obj:
             self.abort(500, detail='Create error')
 
@@ -34,11 +86,29 @@ class GenericParentHandlerJson(RequestHandler):
     def get(self, *args, **kwargs):
         logging.getLogger().debug('get: args: %s, kwargs: %s' % (args, kwargs))
 
-        objs = self.adapter.read_all()
-        if not objs:
-            self.abort(500, detail='Read error')
-
-        result = self.codec.encode(self.request, objs)
+        fields = get_fields(self)
+
+        # Any write to the kind changes its generation, so an unchanged collection is not read again.
+        # Queries on kinds without a common parent may lag behind the generation, so their pages are tagged
+        # by what was read instead, and a stream of them is not tagged.
+        consistent = self.adapter.cls.ROOT_KEY is not None
+        if consistent:
+            etag = ETag.get(ETag.get_generation(self.adapter.cls), self.codec.content_type, self.request.query_string)
+            if not_modified(self, etag):
+                return
+
+        # With stream set, the whole collection is encoded and written a batch at a time. The chunks are
+        # the response's app_iter, so they are read and encoded as the server writes them, not buffered.
+        if Fields.get_int(self.request.GET, 'stream'):
+            self.response.headers['Content-Type'] = self.codec.content_type
+            self.response.app_iter = self.codec.encode_stream(self.request, self.adapter.iter_all(fields=fields), fields=fields)
+            return
+
+        objs, next_url = read_page(self, fields)
+        if not consistent and not_modified(self, ETag.get_page(objs, self.codec.content_type, self.request.query_string, next_url)):
+            return
+
+        result = self.codec.encode(self.request, objs, fields=fields)
         if not result:
             self.abort(500, detail='Encoding error')
 
@@ -49,9 +119,24 @@ class GenericParentHandlerJson(RequestHandler):
     def put(self, *args, **kwargs):
         logging.getLogger().debug('put: args: %s, kwargs: %s' % (args, kwargs))
 
-        objs = self.adapter.update_all()
-        if not objs:
-            self.abort(500, detail='Update error')
+        if not self.request.body:
+            self.abort(400)
+
+        kv = self.codec.decode(self.request)
+        if not kv:
+            self.abort(500, detail='Decoding error')
+
+        if isinstance(kv, list) and len(kv) > self.adapter.MAX_LIMIT:
+            self.abort(413, detail='Too many objects')
+
+        # A filter is applied a page at a time; the cursor of the next page is returned in X-Next-Cursor.
+        limit = Fields.get_int(self.request.GET, 'limit')
+        objs, cursor = self.adapter.update_all(kv=kv, limit=limit, cursor=self.request.get('cursor'))
+        if objs is None:
+            self.abort(400, detail='Update error')
+
+        if cursor:
+            self.response.headers['X-Next-Cursor'] = cursor
 
         result = self.codec.encode(self.request, objs)
         if not result:
@@ -115,12 +200,22 @@ class GenericHandlerJson(RequestHandler):
     def get(self, *args, **kwargs):
         logging.getLogger().debug('get: args: %s, kwargs: %s' % (args, kwargs))
 
+        fields = get_fields(self)
+
         id = self.get_id(kwargs, self.request)
-        obj = self.adapter.read_one(id)
-        if not obj:
+        version, obj = self.adapter.get_version(id)
+        if not version:
             self.abort(404)
 
-        result = self.codec.encode(self.request, obj)
+        if not_modified(self, ETag.get(version, self.codec.content_type, fields)):
+            return
+
+        if not obj:
+            obj = self.adapter.read_one(id)
+            if not obj:
+                self.abort(404)
+
+        result = self.codec.encode(self.request, obj, fields=fields)
         if not result:
             self.abort(500, detail='Encoding error')
 
@@ -202,10 +297,10 @@ class GenericParentHandlerHtml(RequestHandler):
     def get(self, *args, **kwargs):
         logging.getLogger().debug('get: args: %s, kwargs: %s' % (args, kwargs))
 
-        objs = self.adapter.read_all()
-        # objs may be None
+        fields = get_fields(self)
+        objs, next_url = read_page(self, fields)
 
-        results = self.codec.encode(self.request, objs, 'html/all.html')
+        results = self.codec.encode(self.request, objs, 'html/all.html', next_url=next_url, fields=fields)
         if not results:
             self.abort(500, detail='Encoding error')
 
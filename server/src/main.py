@@ -7,6 +7,11 @@ from google.appengine.api import users
 from google.appengine.ext import ndb
 
 from config import Config
+from digest import Digest
+from fanOut import FanOut
+from gcmHelpers import gcm
+from migration import Migration
+from outbox import Outbox
 from publication import Publication
 from subscription import Subscription
 from device import Device
@@ -14,6 +19,7 @@ from user import User
 from umessage import UMessage
 from dmessage import DMessage
 from pmessage import PMessage
+from pmessage import PMessageWindow
 
 class MainHandler(webapp2.RequestHandler):
     def get(self, *args, **kwargs):
@@ -34,5 +40,11 @@ routes.extend(User.get_routes())
 routes.extend(UMessage.get_routes())
 routes.extend(DMessage.get_routes())
 routes.extend(PMessage.get_routes())
+routes.extend(PMessageWindow.get_routes())
+routes.extend(FanOut.get_routes())
+routes.extend(Digest.get_routes())
+routes.extend(gcm.get_routes())
+routes.extend(Migration.get_routes())
+routes.extend(Outbox.get_routes())
 
 application = webapp2.WSGIApplication(routes, debug=True)
@@ -0,0 +1,96 @@
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from webapp2 import RequestHandler
+from webapp2 import Route
+
+from etag import ETag
+
+class Migration(ndb.Model):
+    # Moves the entities of a kind that is keyed by its natural id (see get_key and get_natural_key) off the
+    # numeric keys they were stored with. One entity per kind, keyed by kind name.
+    URL = '/task/migrate/'
+    QUEUE_NAME = 'default'
+    BATCH_SIZE = 100
+
+    done = ndb.BooleanProperty(default=False, required=True)
+    migrated = ndb.IntegerProperty(default=0, required=True)
+    modified = ndb.DateTimeProperty(auto_now=True, required=True)
+
+    # Kinds known to be migrated; once done, a kind stays done.
+    cache = set()
+
+    @classmethod
+    def is_done(cls, model):
+        kind = model._get_kind()
+        if kind in cls.cache:
+            return True
+
+        migration = ndb.Key(Migration, kind).get()
+        if migration and migration.done:
+            cls.cache.add(kind)
+            return True
+
+        return False
+
+    @staticmethod
+    def enqueue(kind, cursor=None):
+        logging.getLogger().debug('enqueue: kind: %s, cursor: %s' % (kind, cursor))
+
+        params = {'kind' : kind}
+        if cursor:
+            params['cursor'] = cursor
+        taskqueue.add(queue_name=Migration.QUEUE_NAME, url=Migration.URL, params=params)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def rekey(model, key):
+        old = key.get()
+        if not old:
+            return False
+
+        # If an object was stored under the natural key in the meantime, the newer one wins.
+        if hasattr(model, 'get_natural_key'):
+            new_key = model.get_natural_key(old)
+        else:
+            new_key = model.get_key(old.get_id())
+        current = new_key.get()
+        if not current or current.modified < old.modified:
+            model(key=new_key, **old.to_dict()).put()
+
+        key.delete()
+        return True
+
+    @staticmethod
+    def get_routes(base_url=''):
+        return [Route(template=str(base_url) + Migration.URL, handler=MigrationHandler, methods=('POST',))]
+
+class MigrationHandler(RequestHandler):
+    # Re-key one batch of a kind's entities that still have numeric ids, then queue the next batch.
+    def post(self, *args, **kwargs):
+        kind = self.request.get('kind')
+        model = ndb.Model._lookup_model(kind)
+
+        cursor = Cursor(urlsafe=self.request.get('cursor')) if self.request.get('cursor') else None
+        keys, cursor, more = model.query().fetch_page(Migration.BATCH_SIZE, start_cursor=cursor, keys_only=True)
+
+        migrated = 0
+        for key in keys:
+            if isinstance(key.id(), (int, long)) and Migration.rekey(model, key):
+                migrated += 1
+
+        if migrated:
+            ETag.bump(model)
+
+        migration = Migration.get_or_insert(kind)
+        migration.migrated += migrated
+        migration.done = not (more and cursor)
+        migration.put()
+
+        logging.getLogger().debug('migrate: kind: %s, migrated: %d, total: %d, done: %s' % (kind, migrated, migration.migrated, migration.done))
+
+        if not migration.done:
+            Migration.enqueue(kind, cursor.urlsafe())
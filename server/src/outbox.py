@@ -0,0 +1,114 @@
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from webapp2 import RequestHandler
+from webapp2 import Route
+
+class Outbox(ndb.Model):
+    # Fan-out progress of one part of a message: an index shard or the chain of subscription pages.
+    # Each part is its own entity group, so parts checkpoint without contending.
+    PART_PAGES = 'pages'
+
+    # A message's parts are deleted once all are done, after the tasks that could still run for them
+    # (fan-out reruns and scheduled retries, see task_age_limit in queue.yaml) have expired.
+    CLEANUP_URL = '/task/outbox/cleanup/'
+    CLEANUP_QUEUE_NAME = 'default'
+    CLEANUP_DELAY = 2 * 24 * 3600
+
+    STATE_SENDING = 'sending'
+    STATE_DONE = 'done'
+
+    message_key = ndb.StringProperty(required=True)
+    part = ndb.StringProperty(required=True)
+    state = ndb.StringProperty(default=STATE_SENDING, required=True)
+    # The urlsafe cursor of the next page of the shard or of the subscriptions.
+    cursor = ndb.StringProperty(indexed=False)
+    page = ndb.IntegerProperty(default=0, indexed=False)
+    sent = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+    # reg_ids waiting for a scheduled retry after an Unavailable error.
+    unavailable = ndb.JsonProperty(compressed=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, required=True)
+    modified = ndb.DateTimeProperty(auto_now=True, required=True)
+
+    @staticmethod
+    def get_part(message_key, part):
+        return Outbox.get_or_insert('%s-%s' % (message_key, part), message_key=message_key, part=part)
+
+    @staticmethod
+    @ndb.transactional
+    def checkpoint(key, reg_ids, response, **progress):
+        # Record the result of sending reg_ids (a response of None means the send failed),
+        # along with the progress to resume from.
+        outbox = key.get()
+        if not outbox:
+            return None
+
+        if response is None:
+            errors = {'Error' : reg_ids}
+        else:
+            errors = response.get('errors', {})
+
+        unavailable = set(errors.get('Unavailable', []))
+        failed = sum([len(ids) for error, ids in errors.items() if error != 'Unavailable'])
+
+        pending = set(outbox.unavailable or [])
+        pending.difference_update(reg_ids)
+        pending.update(unavailable)
+
+        outbox.unavailable = sorted(pending)
+        outbox.sent += len(reg_ids) - len(unavailable) - failed
+        outbox.failed += failed
+        for name, value in progress.items():
+            setattr(outbox, name, value)
+
+        outbox.put()
+
+        logging.getLogger().debug('checkpoint: %s, state: %s, sent: %d, failed: %d, unavailable (%d)' % \
+            (key.id(), outbox.state, outbox.sent, outbox.failed, len(outbox.unavailable)))
+
+        return outbox
+
+    @staticmethod
+    def enqueue_cleanup(message_key, countdown=CLEANUP_DELAY):
+        # The first part done adds the task; the others find it added.
+        logging.getLogger().debug('enqueue cleanup: %s' % (message_key))
+        try:
+            taskqueue.add(queue_name=Outbox.CLEANUP_QUEUE_NAME, url=Outbox.CLEANUP_URL,
+                params={'message_key' : message_key}, name='%s-outbox-cleanup' % (message_key), countdown=countdown)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.getLogger().debug('cleanup already added: %s' % (message_key))
+
+    @staticmethod
+    def get_routes(base_url=''):
+        return [Route(template=str(base_url) + Outbox.CLEANUP_URL, handler=OutboxCleanupHandler, methods=('POST',))]
+
+    @staticmethod
+    def get_progress(message_key):
+        # Totals over all parts of a message's fan-out.
+        parts = Outbox.query(Outbox.message_key == message_key).fetch()
+
+        return {
+            'parts' : len(parts),
+            'done' : len([part for part in parts if part.state == Outbox.STATE_DONE]),
+            'sent' : sum([part.sent for part in parts]),
+            'failed' : sum([part.failed for part in parts]),
+            'unavailable' : sum([len(part.unavailable or []) for part in parts]),
+        }
+
+class OutboxCleanupHandler(RequestHandler):
+    # Delete the parts of a message once every one is done; check again later if some are still sending.
+    def post(self, *args, **kwargs):
+        message_key = self.request.get('message_key')
+        parts = Outbox.query(Outbox.message_key == message_key).fetch()
+
+        sending = [part for part in parts if part.state != Outbox.STATE_DONE]
+        logging.getLogger().debug('cleanup: %s, parts (%d), sending (%d)' % (message_key, len(parts), len(sending)))
+        if sending:
+            taskqueue.add(queue_name=Outbox.CLEANUP_QUEUE_NAME, url=Outbox.CLEANUP_URL,
+                params={'message_key' : message_key}, countdown=Outbox.CLEANUP_DELAY)
+            return
+
+        ndb.delete_multi([part.key for part in parts])
@@ -1,16 +1,22 @@
+import calendar
+import datetime
 import hashlib
 import json
 import logging
 import re
 
+from google.appengine.api import taskqueue
 from google.appengine.api import users
 from google.appengine.ext import ndb
 
 from webapp2 import RequestHandler
+from webapp2 import Route
 
 from codecHtml import CodecHtml
 from codecJson import CodecJson
 from contentRoute import ContentRoute
+from digest import Digest
+from fanOut import FanOut
 from fields import Fields
 from gcmHelpers import gcm
 from genericHandlers import GenericParentHandlerJson
@@ -19,12 +25,15 @@ from genericHandlers import GenericParentHandlerHtml
 from genericHandlers import GenericHandlerHtml
 from genericAdapter import GenericAdapter
 from publication import Publication
-from subscription import Subscription
 
 PMESSAGE_KEYS = ('publication_key', 'message', 'user_id', 'created', 'modified', 'revision', 'key')
 
 class PMessage(ndb.Model):
-    ROOT_KEY = ndb.Key('PMessage', 'pmessages')
+    # No common parent, see GenericAdapter. Entities created under ndb.Key('PMessage', 'pmessages') are still found.
+    ROOT_KEY = None
+
+    # Delivery lane.
+    LANE = gcm.LANE_BROADCAST
 
     # HTML formatting.
     KEYS = PMESSAGE_KEYS
@@ -33,6 +42,9 @@ class PMessage(ndb.Model):
     ROWS = {}
     COLUMNS = {}
 
+    # Properties get_link needs, see GenericAdapter.get_projection.
+    LINK_KEYS = ('pub_id', )
+
     pub_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     message = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     user_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
@@ -51,33 +63,65 @@ class PMessage(ndb.Model):
 
         logging.getLogger().debug('obj=' + str(obj))
 
+    def get_window(self, coalesce):
+        # Index, start and end of the coalescing window the message was created in.
+        created = calendar.timegm(self.created.utctimetuple()) * 1000 + self.created.microsecond / 1000
+        index = created / coalesce
+        start = datetime.datetime.utcfromtimestamp(index * coalesce / 1000.0)
+        return index, start, start + datetime.timedelta(milliseconds=coalesce)
+
+    def get_window_name(self, coalesce):
+        index, start, end = self.get_window(coalesce)
+        return 'pmessage-%s-%d-%d' % (self.pub_id, coalesce, index)
+
+    def get_countdown(self, coalesce):
+        index, start, end = self.get_window(coalesce)
+        return max((end - datetime.datetime.utcnow()).total_seconds(), 0)
+
+    def get_latest(self, coalesce):
+        # The newest message in the window supersedes the others. Closes the window, see PMessageWindow.
+        closed = PMessageWindow.close(PMessageWindow.get_key(self, coalesce))
+        if not closed:
+            return self, 1
+
+        latest, count = closed
+        return latest.get() or self, max(count, 1)
+
+    def get_data(self, publication, count=1):
+        data = {'from-user-id' : self.user_id, 'type' : 'publish-message', 'context' : publication.topic, 'message' : self.message}
+        if count > 1:
+            data['coalesced'] = str(count)
+
+        return data
+
     def send(self):
         publication_key = ndb.Key(urlsafe=self.pub_id)
         publication = publication_key.get()
+        if not publication:
+            logging.getLogger().error('publication not read')
+            return
+
         logging.getLogger().debug('publication=' + str(publication))
         logging.getLogger().debug('topic=' + str(publication.topic))
 
-        subscription_keys = Subscription.query(Subscription.pub_id == self.pub_id, ancestor=Subscription.ROOT_KEY).fetch(keys_only=True)
-        logging.getLogger().debug('subscription_keys (' + str(len(subscription_keys)) + ')=' + str(subscription_keys))
-        if not subscription_keys:
-            return
-
-        dev_ids = [subscription_key.get().dev_id for subscription_key in subscription_keys]
-        logging.getLogger().debug('dev_ids (' + str(len(dev_ids)) + ')=' + str(dev_ids))
-        if not dev_ids:
-            return
+        message = self
+        count = 1
+        if publication.coalesce:
+            message, count = self.get_latest(publication.coalesce)
+            logging.getLogger().debug('coalesced (' + str(count) + ')')
 
-        data = {'from-user-id' : self.user_id, 'type' : 'publish-message', 'context' : publication.topic, 'message' : self.message}
+        data = message.get_data(publication, count)
         logging.getLogger().debug('data=' + str(data))
 
-        gcm.send(data=data, reg_ids=[], dev_ids=dev_ids, user_ids=[])
+        # Each shard or page of subscribers is sent by its own task.
+        FanOut.enqueue_publication(self, data)
 
     @staticmethod
     def query_by_id(id):
         return ( ndb.Key(urlsafe=id), )
 
     def get_id(self):
-        if not self.key.id():
+        if not self.key or not self.key.id():
             return None
 
         return self.key.urlsafe()
@@ -131,15 +175,111 @@ class PMessage(ndb.Model):
             methods=('POST',)),
         ]
 
+class PMessageWindow(ndb.Model):
+    # The newest message published to a coalescing publication in one window, and how many were, keyed by
+    # the window's name, so the fan-out reads them by key instead of by an eventually consistent query.
+    # The first message adds the window's fan-out task in the transaction that creates the window, so every
+    # window has one. The task closes the window when it runs; a message added after that is refused and
+    # sent on its own, and the window is deleted once no add or fan-out retry can still need it.
+    CLEANUP_URL = '/task/pmessage/window/cleanup/'
+    CLEANUP_QUEUE_NAME = 'default'
+    CLEANUP_DELAY = 2 * 24 * 3600
+
+    latest = ndb.StringProperty(required=True, indexed=False)
+    latest_created = ndb.DateTimeProperty(required=True, indexed=False)
+    count = ndb.IntegerProperty(default=0, required=True, indexed=False)
+    closed = ndb.BooleanProperty(default=False, required=True, indexed=False)
+
+    @staticmethod
+    def get_key(obj, coalesce):
+        return ndb.Key(PMessageWindow, obj.get_window_name(coalesce))
+
+    @staticmethod
+    @ndb.transactional
+    def add(obj, coalesce):
+        # Returns False if the window's fan-out has already started.
+        key = PMessageWindow.get_key(obj, coalesce)
+        window = key.get()
+        if window and window.closed:
+            logging.getLogger().debug('window closed: %s' % (key.id()))
+            return False
+
+        if not window:
+            window = PMessageWindow(key=key, latest=obj.key.urlsafe(), latest_created=obj.created)
+            FanOut.enqueue(obj, countdown=obj.get_countdown(coalesce), transactional=True)
+        elif obj.created >= window.latest_created:
+            window.latest = obj.key.urlsafe()
+            window.latest_created = obj.created
+
+        window.count += 1
+        window.put()
+        return True
+
+    @staticmethod
+    @ndb.transactional
+    def close(key):
+        # Returns the key of the newest message and the count, or None if there is no window. Once the window
+        # is closed they no longer change, so a rerun of the fan-out sends the same message.
+        window = key.get()
+        if not window:
+            return None
+
+        if not window.closed:
+            window.closed = True
+            window.put()
+            taskqueue.add(queue_name=PMessageWindow.CLEANUP_QUEUE_NAME, url=PMessageWindow.CLEANUP_URL,
+                params={'key' : key.urlsafe()}, countdown=PMessageWindow.CLEANUP_DELAY, transactional=True)
+
+        return ndb.Key(urlsafe=window.latest), window.count
+
+    @staticmethod
+    def get_routes(base_url=''):
+        return [Route(template=str(base_url) + PMessageWindow.CLEANUP_URL, handler=PMessageWindowCleanupHandler, methods=('POST',))]
+
+class PMessageWindowCleanupHandler(RequestHandler):
+    def post(self, *args, **kwargs):
+        key = ndb.Key(urlsafe=self.request.get('key'))
+        logging.getLogger().debug('cleanup: %s' % (key.id()))
+        key.delete()
+
 class PMessageAdapter(GenericAdapter):
     def create(self, kv, parent=None):
         logging.getLogger().debug('create: kv: %s, parent: %s' % (kv, parent))
         obj = super(PMessageAdapter, self).create(kv, parent)
-        if obj:
-            obj.send()
+        if not obj:
+            return obj
+
+        publication = ndb.Key(urlsafe=obj.pub_id).get()
+        if not self.publish(obj, publication):
+            FanOut.enqueue(obj)
 
         return obj
 
+    def create_multi(self, kvs, parent=None):
+        objs = super(PMessageAdapter, self).create_multi(kvs, parent)
+        if not objs:
+            return objs
+
+        pub_ids = list(set([obj.pub_id for obj in objs if obj]))
+        publications = dict(zip(pub_ids, ndb.get_multi([ndb.Key(urlsafe=pub_id) for pub_id in pub_ids])))
+
+        FanOut.enqueue_multi([obj for obj in objs if obj and not self.publish(obj, publications[obj.pub_id])])
+        return objs
+
+    def publish(self, obj, publication):
+        # Publishes to a digest topic wait for the digest; publishes to a coalescing topic share one fan-out per window.
+        # Returns False for a message that needs a fan-out of its own.
+        if publication and publication.digest:
+            Digest.add(obj, obj.get_data(publication))
+        elif publication and publication.coalesce:
+            if not PMessageWindow.add(obj, publication.coalesce):
+                # Too late for its window, whose fan-out would not include it.
+                FanOut.enqueue_publication(obj, obj.get_data(publication))
+        else:
+            return False
+
+        return True
+
 class PMessagesHandlerJson(GenericParentHandlerJson):
     def __init__(self, request, response):
         super(PMessagesHandlerJson, self).__init__(request, response, adapter=PMessageAdapter(PMessage), codec=CodecJson())
@@ -18,20 +18,26 @@ from genericHandlers import GenericParentHandlerHtml
 from genericHandlers import GenericHandlerHtml
 from genericAdapter import GenericAdapter
 
-PUBLICATION_KEYS = ('topic', 'description', 'user_id', 'created', 'modified', 'revision', 'key')
+PUBLICATION_KEYS = ('topic', 'description', 'coalesce', 'digest', 'user_id', 'created', 'modified', 'revision', 'key')
 
 class Publication(ndb.Model):
     ROOT_KEY = ndb.Key('Publication', 'publications')
 
     # HTML formatting.
     KEYS = PUBLICATION_KEYS
-    KEYS_WRITABLE = PUBLICATION_KEYS[:2]
-    KEYS_READONLY = PUBLICATION_KEYS[2:]
+    KEYS_WRITABLE = PUBLICATION_KEYS[:4]
+    KEYS_READONLY = PUBLICATION_KEYS[4:]
     ROWS = {}
     COLUMNS = {}
 
+    # Largest coalescing window (milliseconds).
+    MAX_COALESCE = 60000
+
     topic = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     description = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
+    coalesce = ndb.IntegerProperty(default=0, required=True)
+    # Messages are held and packed into per-device digests instead of being pushed one by one.
+    digest = ndb.BooleanProperty(default=False, required=True)
     user_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     created = ndb.DateTimeProperty(auto_now_add=True, required=True)
     modified = ndb.DateTimeProperty(auto_now=True, required=True)
@@ -43,6 +49,8 @@ class Publication(ndb.Model):
 
         obj.topic = Fields.get(kv, 'topic', 'debug-topic')
         obj.description = Fields.get(kv, 'description', 'debug-description')
+        obj.coalesce = min(max(Fields.get_int(kv, 'coalesce', 0), 0), Publication.MAX_COALESCE)
+        obj.digest = Fields.get(kv, 'digest', False) in (True, 'true', 'on', '1', 1)
         obj.user_id = Fields.sanitize_user_id(users.get_current_user().user_id())
 
         logging.getLogger().debug('obj=' + str(obj))
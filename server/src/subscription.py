@@ -11,18 +11,23 @@ from webapp2 import RequestHandler
 from codecHtml import CodecHtml
 from codecJson import CodecJson
 from contentRoute import ContentRoute
+from device import Device
 from fields import Fields
 from genericHandlers import GenericParentHandlerJson
 from genericHandlers import GenericHandlerJson
 from genericHandlers import GenericParentHandlerHtml
 from genericHandlers import GenericHandlerHtml
 from genericAdapter import GenericAdapter
+from migration import Migration
 from publication import Publication
+from topicIndex import TopicIndex
 
 SUBSCRIPTION_KEYS = ('topic', 'dev_id', 'pub_id', 'user_id', 'created', 'modified', 'revision', 'key')
 
 class Subscription(ndb.Model):
-    ROOT_KEY = ndb.Key('Subscription', 'subscriptions')
+    # No common parent, see GenericAdapter. Entities created under ndb.Key('Subscription', 'subscriptions') are still found.
+    # Keyed by publication and device (see get_natural_key), so whether a device is subscribed is read by key.
+    ROOT_KEY = None
 
     # HTML formatting.
     KEYS = SUBSCRIPTION_KEYS
@@ -31,6 +36,9 @@ class Subscription(ndb.Model):
     ROWS = {}
     COLUMNS = {}
 
+    # Subscriptions copied into the index per page, see index_page.
+    INDEX_PAGE_SIZE = 500
+
     topic = ndb.StringProperty(required=True, validator=Fields.validate_not_empty) # FIXME: remove after debugging.
     dev_id = ndb.StringProperty(required=True, validator=Fields.validate_dev_id)
     pub_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
@@ -62,12 +70,77 @@ class Subscription(ndb.Model):
 
         logging.getLogger().debug('obj=' + str(obj))
 
+    @staticmethod
+    def get_natural_key(obj):
+        if not obj.pub_id or not obj.dev_id:
+            return None
+
+        return ndb.Key(Subscription, '%s:%s' % (obj.pub_id, obj.dev_id))
+
     @staticmethod
     def query_by_id(id):
         return ( ndb.Key(urlsafe=id), )
 
+    @staticmethod
+    def get_reg_id(dev_id):
+        keys = Device.query_by_id(dev_id)
+        if not keys:
+            return None
+
+        device = keys[0].get()
+        if not device:
+            return None
+
+        return device.reg_id
+
+    @staticmethod
+    def get_reg_ids(dev_ids):
+        # dev_id -> reg_id, or None if there is no such device, read with one batched get.
+        dev_ids = sorted(set(dev_ids))
+        devices = GenericAdapter(Device).read_multi(dev_ids)
+        return dict([(dev_id, device.reg_id if device else None) for dev_id, device in zip(dev_ids, devices)])
+
+    @staticmethod
+    def index_page(pub_id, cursor=None, page_size=INDEX_PAGE_SIZE):
+        # Copy a page of a publication's subscriptions into its index. The query may lag behind deletes,
+        # so the subscriptions it finds are read again by key. Returns dev_id -> reg_id for the page,
+        # the cursor of the next page and whether there are more.
+        query = Subscription.query(Subscription.pub_id == pub_id, ancestor=Subscription.ROOT_KEY)
+        keys, cursor, more = query.fetch_page(page_size, start_cursor=cursor, keys_only=True)
+        dev_ids = [subscription.dev_id for subscription in ndb.get_multi(keys) if subscription]
+        logging.getLogger().debug('index page: dev_ids (' + str(len(dev_ids)) + ')')
+
+        entries = Subscription.get_reg_ids(dev_ids)
+        TopicIndex.insert_entries(pub_id, entries)
+        return entries, cursor, more
+
+    @staticmethod
+    def build_index(pub_id):
+        # Index a publication from its subscriptions, e.g. for subscriptions made before the index existed,
+        # and mark it built once all are copied.
+        cursor = None
+        while True:
+            entries, cursor, more = Subscription.index_page(pub_id, cursor)
+            if not more or not cursor:
+                break
+
+        TopicIndex.set_built(pub_id)
+
+    def is_subscribed(self):
+        # True if a subscription still ties this device to the publication.
+        if Subscription.get_natural_key(self).get():
+            return True
+
+        if Migration.is_done(Subscription):
+            return False
+
+        # Subscriptions stored before they were keyed by publication and device. The query may lag
+        # behind deletes, so the subscriptions it finds are read again by key.
+        query = Subscription.query(Subscription.pub_id == self.pub_id, Subscription.dev_id == self.dev_id, ancestor=Subscription.ROOT_KEY)
+        return any(ndb.get_multi(query.fetch(keys_only=True)))
+
     def get_id(self):
-        if not self.key.id():
+        if not self.key or not self.key.id():
             return None
 
         return self.key.urlsafe()
@@ -121,18 +194,70 @@ class Subscription(ndb.Model):
             methods=('POST',)),
         ]
 
+class SubscriptionAdapter(GenericAdapter):
+    # Keep the publication's fan-out index in step with its subscriptions.
+    def create(self, kv, parent=None):
+        obj = super(SubscriptionAdapter, self).create(kv, parent)
+        if obj:
+            TopicIndex.add(obj.pub_id, obj.dev_id, Subscription.get_reg_id(obj.dev_id))
+
+        return obj
+
+    def create_multi(self, kvs, parent=None):
+        objs = super(SubscriptionAdapter, self).create_multi(kvs, parent)
+        if objs:
+            reg_ids = Subscription.get_reg_ids([obj.dev_id for obj in objs if obj])
+            entries = {}
+            for obj in objs:
+                if obj:
+                    entries.setdefault(obj.pub_id, {})[obj.dev_id] = reg_ids[obj.dev_id]
+
+            for pub_id, pub_entries in entries.items():
+                TopicIndex.add_entries(pub_id, pub_entries)
+
+        return objs
+
+    # The publication and device are the key, so an update cannot move a subscription to another entry.
+    def update_one(self, id, kv=None):
+        obj = super(SubscriptionAdapter, self).update_one(id, kv)
+        if obj:
+            TopicIndex.add(obj.pub_id, obj.dev_id, Subscription.get_reg_id(obj.dev_id))
+
+        return obj
+
+    def updated(self, olds, objs):
+        reg_ids = Subscription.get_reg_ids([obj.dev_id for obj in objs])
+        entries = {}
+        for obj in objs:
+            entries.setdefault(obj.pub_id, {})[obj.dev_id] = reg_ids[obj.dev_id]
+
+        for pub_id, pub_entries in entries.items():
+            TopicIndex.add_entries(pub_id, pub_entries)
+
+    def delete_all(self, parent=None):
+        keys = super(SubscriptionAdapter, self).delete_all(parent)
+        TopicIndex.clear()
+        return keys
+
+    def delete_one(self, id):
+        obj = super(SubscriptionAdapter, self).delete_one(id)
+        if obj and not obj.is_subscribed():
+            TopicIndex.remove(obj.pub_id, obj.dev_id)
+
+        return obj
+
 class SubscriptionsHandlerJson(GenericParentHandlerJson):
     def __init__(self, request, response):
-        super(SubscriptionsHandlerJson, self).__init__(request, response, adapter=GenericAdapter(Subscription), codec=CodecJson())
+        super(SubscriptionsHandlerJson, self).__init__(request, response, adapter=SubscriptionAdapter(Subscription), codec=CodecJson())
 
 class SubscriptionHandlerJson(GenericHandlerJson):
     def __init__(self, request, response):
-        super(SubscriptionHandlerJson, self).__init__(request, response, adapter=GenericAdapter(Subscription), codec=CodecJson())
+        super(SubscriptionHandlerJson, self).__init__(request, response, adapter=SubscriptionAdapter(Subscription), codec=CodecJson())
 
 class SubscriptionsHandlerHtml(GenericParentHandlerHtml):
     def __init__(self, request, response):
-        super(SubscriptionsHandlerHtml, self).__init__(request, response, adapter=GenericAdapter(Subscription), codec=CodecHtml(Subscription))
+        super(SubscriptionsHandlerHtml, self).__init__(request, response, adapter=SubscriptionAdapter(Subscription), codec=CodecHtml(Subscription))
 
 class SubscriptionHandlerHtml(GenericHandlerHtml):
     def __init__(self, request, response):
-        super(SubscriptionHandlerHtml, self).__init__(request, response, adapter=GenericAdapter(Subscription), codec=CodecHtml(Subscription))
+        super(SubscriptionHandlerHtml, self).__init__(request, response, adapter=SubscriptionAdapter(Subscription), codec=CodecHtml(Subscription))
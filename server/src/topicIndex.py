@@ -0,0 +1,168 @@
+import hashlib
+import logging
+
+from google.appengine.ext import ndb
+
+class TopicIndexEntry(ndb.Model):
+    # One device in a shard of a publication's index, keyed by dev_id under the shard's key.
+    # Indexed so the entries for a device can be found when its reg_id changes.
+    dev_id = ndb.StringProperty(required=True)
+    # None if the device is not registered.
+    reg_id = ndb.StringProperty(indexed=False)
+
+class TopicIndexBuilt(ndb.Model):
+    # Marks a publication's index as complete, keyed by pub_id. Written only once every subscription of the
+    # publication has been copied into the index; subscribes and unsubscribes keep it complete after that.
+    pub_id = ndb.StringProperty(required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, required=True)
+
+class TopicIndex(ndb.Model):
+    # Each publication's subscribers are spread over SHARDS entity groups, so subscribing does not contend on one key.
+    # A shard is a small entity with each device as a TopicIndexEntry under it, so a shard has no size limit,
+    # a subscribe writes one small entity and a shard is read a page at a time. Subscribes write to the index
+    # whether or not it is built, so a shard existing does not mean the index holds every subscriber.
+    SHARDS = 16
+
+    # Maximum number of values in a single IN filter.
+    BATCH_SIZE = 30
+    # Entries written by one transaction.
+    WRITE_SIZE = 100
+
+    # How update_shard applies entries: add or replace them, add only those not there yet,
+    # or change only those already there.
+    MODE_ADD = 'add'
+    MODE_INSERT = 'insert'
+    MODE_UPDATE = 'update'
+
+    pub_id = ndb.StringProperty(required=True)
+    modified = ndb.DateTimeProperty(auto_now=True, required=True)
+
+    @staticmethod
+    def get_shard(dev_id):
+        return int(hashlib.md5(dev_id).hexdigest(), 16) % TopicIndex.SHARDS
+
+    @staticmethod
+    def get_key(pub_id, shard):
+        return ndb.Key(TopicIndex, '%s-%d' % (pub_id, shard))
+
+    @staticmethod
+    def get_keys(pub_id):
+        return [TopicIndex.get_key(pub_id, shard) for shard in range(TopicIndex.SHARDS)]
+
+    @staticmethod
+    def get_entry_key(key, dev_id):
+        return ndb.Key(TopicIndexEntry, dev_id, parent=key)
+
+    @staticmethod
+    def get_built_key(pub_id):
+        return ndb.Key(TopicIndexBuilt, pub_id)
+
+    @staticmethod
+    def is_indexed(pub_id):
+        # True once the index holds every subscriber of the publication, see Subscription.build_index.
+        return TopicIndex.get_built_key(pub_id).get() is not None
+
+    @staticmethod
+    def set_built(pub_id):
+        logging.getLogger().debug('built: pub_id: %s' % (pub_id))
+        TopicIndexBuilt(key=TopicIndex.get_built_key(pub_id), pub_id=pub_id).put()
+
+    @staticmethod
+    def query_entries(key):
+        # A shard's entries, in a strongly consistent order a fan-out can page through.
+        return TopicIndexEntry.query(ancestor=key)
+
+    @staticmethod
+    @ndb.transactional
+    def update_shard(key, pub_id, updates, mode):
+        # updates maps dev_id -> reg_id, at most WRITE_SIZE of them.
+        keys = [TopicIndex.get_entry_key(key, dev_id) for dev_id in updates.keys()]
+
+        puts = []
+        for entry_key, entry in zip(keys, ndb.get_multi(keys)):
+            if (entry and mode == TopicIndex.MODE_INSERT) or (not entry and mode == TopicIndex.MODE_UPDATE):
+                continue
+
+            puts.append(TopicIndexEntry(key=entry_key, dev_id=entry_key.id(), reg_id=updates[entry_key.id()]))
+
+        if puts and mode != TopicIndex.MODE_UPDATE:
+            puts.append(TopicIndex(key=key, pub_id=pub_id))
+
+        ndb.put_multi(puts)
+
+    @staticmethod
+    def update_entries(key, pub_id, updates, mode):
+        # Apply updates to one shard, WRITE_SIZE entries per transaction.
+        dev_ids = sorted(updates.keys())
+        for i in range(0, len(dev_ids), TopicIndex.WRITE_SIZE):
+            batch = dev_ids[i:i + TopicIndex.WRITE_SIZE]
+            TopicIndex.update_shard(key, pub_id, dict([(dev_id, updates[dev_id]) for dev_id in batch]), mode)
+
+    @staticmethod
+    def add(pub_id, dev_id, reg_id):
+        logging.getLogger().debug('add: pub_id: %s, dev_id: %s' % (pub_id, dev_id))
+
+        key = TopicIndex.get_key(pub_id, TopicIndex.get_shard(dev_id))
+        TopicIndex.update_shard(key, pub_id, {dev_id : reg_id}, TopicIndex.MODE_ADD)
+
+    @staticmethod
+    def add_entries(pub_id, entries, mode=MODE_ADD):
+        # entries maps dev_id -> reg_id; each shard is updated with all of its entries at once.
+        logging.getLogger().debug('add entries: pub_id: %s, entries (%d), mode: %s' % (pub_id, len(entries), mode))
+
+        shards = {}
+        for dev_id, reg_id in entries.items():
+            shards.setdefault(TopicIndex.get_shard(dev_id), {})[dev_id] = reg_id
+
+        for shard, updates in shards.items():
+            TopicIndex.update_entries(TopicIndex.get_key(pub_id, shard), pub_id, updates, mode)
+
+    @staticmethod
+    def remove(pub_id, dev_id):
+        logging.getLogger().debug('remove: pub_id: %s, dev_id: %s' % (pub_id, dev_id))
+
+        TopicIndex.get_entry_key(TopicIndex.get_key(pub_id, TopicIndex.get_shard(dev_id)), dev_id).delete()
+
+    @staticmethod
+    def update_devices(updates):
+        # updates maps dev_id -> new reg_id, or None when the device is gone.
+        dev_ids = sorted(updates.keys())
+        futures = []
+        for i in range(0, len(dev_ids), TopicIndex.BATCH_SIZE):
+            batch = dev_ids[i:i + TopicIndex.BATCH_SIZE]
+            futures.append(TopicIndexEntry.query(TopicIndexEntry.dev_id.IN(batch)).fetch_async(keys_only=True))
+
+        shards = {}
+        for future in futures:
+            for key in future.get_result():
+                shards.setdefault(key.parent(), {})[key.id()] = updates[key.id()]
+
+        logging.getLogger().debug('update: devices (%d), shards (%d)' % (len(updates), len(shards)))
+
+        # Each shard is updated in its own transactions with every change that applies to it.
+        for key, shard_updates in shards.items():
+            TopicIndex.update_entries(key, None, shard_updates, TopicIndex.MODE_UPDATE)
+
+    @staticmethod
+    def insert_entries(pub_id, entries):
+        # Add entries read from subscriptions to build the index. Entries already there were written by
+        # subscribes and reg_id changes since, and are newer than those read.
+        TopicIndex.add_entries(pub_id, entries, TopicIndex.MODE_INSERT)
+
+    @staticmethod
+    def clear(pub_id=None):
+        # A cleared index is no longer built; the next publish rebuilds it from the subscriptions.
+        if pub_id:
+            keys = [TopicIndex.get_built_key(pub_id)] + TopicIndex.get_keys(pub_id)
+            for key in TopicIndex.get_keys(pub_id):
+                keys.extend(TopicIndex.query_entries(key).fetch(keys_only=True))
+        else:
+            keys = TopicIndexBuilt.query().fetch(keys_only=True) + TopicIndex.query().fetch(keys_only=True) + \
+                TopicIndexEntry.query().fetch(keys_only=True)
+
+        ndb.delete_multi(keys)
+
+    @staticmethod
+    def get_shard_reg_ids(key):
+        # Every reg_id in one shard.
+        return [entry.reg_id for entry in TopicIndex.query_entries(key).iter(batch_size=TopicIndex.WRITE_SIZE) if entry.reg_id]
@@ -11,6 +11,7 @@ from webapp2 import RequestHandler
 from codecHtml import CodecHtml
 from codecJson import CodecJson
 from contentRoute import ContentRoute
+from fanOut import FanOut
 from fields import Fields
 from gcmHelpers import gcm
 from genericHandlers import GenericParentHandlerJson
@@ -22,7 +23,11 @@ from genericAdapter import GenericAdapter
 UMESSAGE_KEYS = ('to_user_id', 'message', 'user_id', 'created', 'modified', 'revision', 'key')
 
 class UMessage(ndb.Model):
-    ROOT_KEY = ndb.Key('UMessage', 'umessages')
+    # No common parent, see GenericAdapter. Entities created under ndb.Key('UMessage', 'umessages') are still found.
+    ROOT_KEY = None
+
+    # Delivery lane.
+    LANE = gcm.LANE_DIRECT
 
     # HTML formatting.
     KEYS = UMESSAGE_KEYS
@@ -31,6 +36,9 @@ class UMessage(ndb.Model):
     ROWS = {'message' : 80}
     COLUMNS = {'message' : 5}
 
+    # Properties get_link needs, see GenericAdapter.get_projection.
+    LINK_KEYS = ('user_id', )
+
     to_user_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     message = ndb.StringProperty(required=True)
     user_id = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
@@ -52,14 +60,14 @@ class UMessage(ndb.Model):
         data = {'from-user-id' : str(self.user_id), 'type' : 'user-message', 'context' : str(self.to_user_id), 'message' : self.message}
         logging.getLogger().debug('data=' + str(data))
 
-        gcm.send(data=data, reg_ids=[], dev_ids=[], user_ids=[self.to_user_id])
+        gcm.send(data=data, reg_ids=[], dev_ids=[], user_ids=[self.to_user_id], lane=self.LANE)
 
     @staticmethod
     def query_by_id(id):
         return ( ndb.Key(urlsafe=id), )
 
     def get_id(self):
-        if not self.key.id():
+        if not self.key or not self.key.id():
             return None
 
         return self.key.urlsafe()
@@ -118,10 +126,17 @@ class UMessageAdapter(GenericAdapter):
         logging.getLogger().debug('create: kv: %s, parent: %s' % (kv, parent))
         obj = super(UMessageAdapter, self).create(kv, parent)
         if obj:
-            obj.send()
+            FanOut.enqueue(obj)
 
         return obj
 
+    def create_multi(self, kvs, parent=None):
+        objs = super(UMessageAdapter, self).create_multi(kvs, parent)
+        if objs:
+            FanOut.enqueue_multi([obj for obj in objs if obj])
+
+        return objs
+
 class UMessagesHandlerJson(GenericParentHandlerJson):
     def __init__(self, request, response):
         super(UMessagesHandlerJson, self).__init__(request, response, adapter=UMessageAdapter(UMessage), codec=CodecJson())
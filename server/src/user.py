@@ -17,6 +17,7 @@ from genericHandlers import GenericHandlerJson
 from genericHandlers import GenericParentHandlerHtml
 from genericHandlers import GenericHandlerHtml
 from genericAdapter import GenericAdapter
+from migration import Migration
 
 USER_KEYS = ('name', 'description', 'groups', 'email', 'user_id', 'created', 'modified', 'revision', 'key')
 
@@ -30,6 +31,11 @@ class User(ndb.Model):
     ROWS = {'description' : 80}
     COLUMNS = {}
 
+    # Properties get_link needs, see GenericAdapter.get_projection.
+    LINK_KEYS = ('user_id', )
+    # The property holding the natural id, see get_key.
+    ID_KEY = 'user_id'
+
     name = ndb.StringProperty(required=True, validator=Fields.validate_not_empty)
     description = ndb.StringProperty(default='', required=True)
     groups = ndb.StringProperty(default='', required=True)
@@ -52,8 +58,20 @@ class User(ndb.Model):
 
         logging.getLogger().debug('obj=' + str(obj))
 
+    @staticmethod
+    def get_key(id):
+        return ndb.Key(User, id, parent=User.ROOT_KEY)
+
     @staticmethod
     def query_by_id(id):
+        # Fall back to a query for users stored with numeric ids, until they are migrated.
+        key = User.get_key(id)
+        if key.get():
+            return [key]
+
+        if Migration.is_done(User):
+            return []
+
         return User.query(User.user_id == id, ancestor=User.ROOT_KEY).order(-User.modified).fetch(keys_only=True)
 
     def get_id(self):
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+import optparse
+import os
+import sys
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+import webapp2
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'gcm'))
+
+from config import Config
+from device import Device
+from fanOut import FanOut
+from emulator import GcmEmulator
+from fields import Fields
+from gcmHelpers import gcm
+from outbox import Outbox
+from pmessage import PMessage
+from publication import Publication
+from subscription import Subscription
+
+class FanOutBenchmark(object):
+    """
+    Publishes through PMessage.send to N seeded devices in the testbed datastore,
+    runs the fan-out tasks it queues and delivers to a local GCM emulator.
+    """
+
+    def __init__(self, devices, latency=0.0, unavailable=0.0, not_registered=0.0, canonical=0.0):
+        self.devices = devices
+
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+        ndb.get_context().set_cache_policy(False)
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        self.app = webapp2.WSGIApplication(FanOut.get_routes())
+
+        self.rpcs = 0
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('benchmark', self.count_rpc, 'datastore_v3')
+
+        reg_ids = ['reg-%08d' % i for i in range(devices)]
+        dead = int(devices * not_registered)
+        moved = int(devices * canonical)
+        canonical_ids = dict((reg_id, 'canonical-' + reg_id) for reg_id in reg_ids[dead:dead + moved])
+        self.emulator = GcmEmulator(latency=latency, unavailable=unavailable,
+            not_registered=reg_ids[:dead], canonical=canonical_ids).start()
+        gcm.URL = self.emulator.url
+
+        self.seed(reg_ids)
+
+    def count_rpc(self, service, call, request, response):
+        self.rpcs += 1
+
+    def seed(self, reg_ids):
+        user_id = Fields.sanitize_user_id('benchmark')
+
+        Config(key=Config.get_key('active'), name='active', gcm_api_key='benchmark', user_id=user_id).put()
+
+        publication = Publication(parent=Publication.ROOT_KEY, topic='benchmark', description='benchmark', user_id=user_id)
+        self.pub_id = publication.put().urlsafe()
+
+        devices = []
+        subscriptions = []
+        for i, reg_id in enumerate(reg_ids):
+            dev_id = '%016x' % i
+            devices.append(Device(key=Device.get_key(dev_id), name='benchmark', dev_id=dev_id, reg_id=reg_id, user_id=user_id))
+            subscriptions.append(Subscription(parent=Subscription.ROOT_KEY, topic='benchmark', dev_id=dev_id, pub_id=self.pub_id, user_id=user_id))
+
+        ndb.put_multi(devices)
+        ndb.put_multi(subscriptions)
+
+    def run_tasks(self):
+        # Run fan-out tasks until none are left; scheduled GCM retries are dropped.
+        queue = gcm.LANES[gcm.LANE_BROADCAST]['queue']
+        while True:
+            tasks = self.taskqueue.get_filtered_tasks(queue_names=[queue])
+            if not tasks:
+                break
+
+            self.taskqueue.FlushQueue(queue)
+            for task in tasks:
+                if task.url.startswith(FanOut.URL):
+                    self.app.get_response(task.url, method='POST', body=task.payload, headers=task.headers)
+
+    def publish(self, i):
+        message = PMessage(parent=PMessage.ROOT_KEY, pub_id=self.pub_id, message='benchmark %d' % i, user_id='benchmark')
+        message.put()
+
+        self.rpcs = 0
+        self.emulator.reset()
+
+        start = time.time()
+        message.send()
+        self.run_tasks()
+        elapsed = time.time() - start
+
+        progress = Outbox.get_progress(message.key.urlsafe())
+        return elapsed, self.rpcs, self.emulator.requests, self.emulator.reg_ids, progress['sent']
+
+    def run(self, messages):
+        print '%8s %10s %8s %8s %8s %8s' % ('message', 'latency', 'rpcs', 'requests', 'reg_ids', 'sent')
+        results = []
+        for i in range(messages):
+            result = self.publish(i)
+            results.append(result)
+            print '%8d %9.1fms %8d %8d %8d %8d' % (i, result[0] * 1000, result[1], result[2], result[3], result[4])
+
+        latencies = sorted([result[0] for result in results])
+        print 'devices: %d, messages: %d' % (self.devices, messages)
+        print 'latency: min %.1fms, median %.1fms, max %.1fms' % (latencies[0] * 1000, latencies[len(latencies) / 2] * 1000, latencies[-1] * 1000)
+        print 'datastore rpcs per message: %.1f' % (float(sum([result[1] for result in results])) / messages)
+        print 'gcm requests per message: %.1f' % (float(sum([result[2] for result in results])) / messages)
+
+    def close(self):
+        self.emulator.stop()
+        self.testbed.deactivate()
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--devices', type='int', default=500)
+    parser.add_option('--messages', type='int', default=10)
+    parser.add_option('--latency', type='float', default=0.0, help='GCM seconds per request')
+    parser.add_option('--unavailable', type='float', default=0.0, help='fraction of Unavailable results')
+    parser.add_option('--not-registered', type='float', default=0.0, help='fraction of NotRegistered devices')
+    parser.add_option('--canonical', type='float', default=0.0, help='fraction of devices with a canonical id')
+    options, args = parser.parse_args()
+
+    benchmark = FanOutBenchmark(options.devices, latency=options.latency, unavailable=options.unavailable,
+        not_registered=options.not_registered, canonical=options.canonical)
+    try:
+        benchmark.run(options.messages)
+    finally:
+        benchmark.close()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+import BaseHTTPServer
+import SocketServer
+import json
+import optparse
+import random
+import threading
+import time
+
+class GcmEmulator(object):
+    """
+    Local stand-in for the GCM JSON endpoint.
+    Point GCM (or gcmHelpers.gcm.URL) at emulator.url instead of GCM_URL.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, unavailable=0.0,
+                    not_registered=(), canonical=None, status=200, retry_after=None,
+                    drop_idle=False, hang_up=False, garbled=()):
+        """ latency: seconds added to every request.
+            unavailable: fraction of reg_ids answered with Unavailable.
+            not_registered: reg_ids answered with NotRegistered.
+            canonical: dict mapping reg_ids to the canonical ids returned for them.
+            status: HTTP status returned for every request; results are only sent with 200.
+            retry_after: value of the Retry-After header sent with non-200 responses.
+            drop_idle: close each connection after its response, as a server
+                does with idle keep-alive connections.
+            hang_up: close each connection after reading its request, without
+                a response.
+            garbled: reg_ids whose requests are answered with a 200 that is not JSON.
+        """
+        self.latency = latency
+        self.unavailable = unavailable
+        self.not_registered = set(not_registered)
+        self.canonical = canonical or {}
+        self.status = status
+        self.retry_after = retry_after
+        self.drop_idle = drop_idle
+        self.hang_up = hang_up
+        self.garbled = set(garbled)
+
+        self.lock = threading.Lock()
+        self.reset()
+
+        self.server = ThreadingHTTPServer((host, port), GcmEmulatorHandler)
+        self.server.emulator = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d/gcm/send' % self.server.server_address
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.reg_ids = 0
+            self.connections = set()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def result(self, reg_id):
+        if reg_id in self.not_registered:
+            return {'error' : 'NotRegistered'}
+        if self.unavailable and random.random() < self.unavailable:
+            return {'error' : 'Unavailable'}
+
+        result = {'message_id' : '0:%d%%emulator' % random.randrange(1 << 31)}
+        if reg_id in self.canonical:
+            result['registration_id'] = self.canonical[reg_id]
+        return result
+
+    def handle(self, client_address, body):
+        with self.lock:
+            self.requests += 1
+            self.connections.add(client_address)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.status != 200:
+            return self.status, None
+
+        try:
+            registration_ids = json.loads(body)['registration_ids']
+        except (ValueError, KeyError, TypeError):
+            return 400, None
+
+        with self.lock:
+            self.reg_ids += len(registration_ids)
+
+        if self.garbled.intersection(registration_ids):
+            return 200, 'garbled'
+
+        results = [self.result(reg_id) for reg_id in registration_ids]
+        failure = len([result for result in results if 'error' in result])
+        canonical_ids = len([result for result in results if 'registration_id' in result])
+
+        return 200, {
+            'multicast_id' : random.randrange(1 << 31),
+            'success' : len(results) - failure,
+            'failure' : failure,
+            'canonical_ids' : canonical_ids,
+            'results' : results,
+        }
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class GcmEmulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections open like the real service.
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+        if not self.headers.get('Authorization', '').startswith('key='):
+            status, response = 401, None
+        else:
+            status, response = self.server.emulator.handle(self.client_address, body)
+
+        if self.server.emulator.hang_up:
+            self.close_connection = 1
+            return
+
+        body = json.dumps(response) if isinstance(response, dict) else (response or '')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if status != 200 and self.server.emulator.retry_after is not None:
+            self.send_header('Retry-After', str(self.server.emulator.retry_after))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if self.server.emulator.drop_idle:
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type='int', default=8081)
+    parser.add_option('--latency', type='float', default=0.0, help='seconds per request')
+    parser.add_option('--unavailable', type='float', default=0.0, help='fraction of Unavailable results')
+    parser.add_option('--status', type='int', default=200)
+    parser.add_option('--retry-after', type='int', default=None)
+    options, args = parser.parse_args()
+
+    emulator = GcmEmulator(port=options.port, latency=options.latency, unavailable=options.unavailable,
+        status=options.status, retry_after=options.retry_after)
+    print 'GCM emulator at ' + emulator.url
+    emulator.server.serve_forever()
@@ -0,0 +1,257 @@
+import json
+import math
+import threading
+import time
+import unittest2 as unittest
+
+from gcm import GCM
+from gcm import PreparedMessage
+from gcm.gcm import GCMCircuitOpenException
+from gcm.gcm import GCMMessageTooBigException
+from gcm.gcm import GCMResponseLostException
+from gcm.gcm import GCMUnavailableException
+from gcm.throttle import BatchTuner
+from gcm.throttle import CircuitBreaker
+from gcm.throttle import RateLimiter
+
+from emulator import GcmEmulator
+
+class MemoryStore(object):
+    # The parts of memcache the shared throttles use, for several senders standing in for instances.
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value, time=0):
+        self.values[key] = value
+        return True
+
+    def add(self, key, value, time=0):
+        with self.lock:
+            if key in self.values:
+                return False
+            self.values[key] = value
+            return True
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            if key not in self.values:
+                return None
+            self.values[key] += delta
+            return self.values[key]
+
+    def decr(self, key, delta=1):
+        with self.lock:
+            if key not in self.values:
+                return None
+            self.values[key] = max(0, self.values[key] - delta)
+            return self.values[key]
+
+    def delete(self, key):
+        self.values.pop(key, None)
+
+class GcmTest(unittest.TestCase):
+    def setUp(self):
+        self.emulator = GcmEmulator(not_registered=('dead',), canonical={'old' : 'new'}).start()
+        self.gcm = GCM('test-api-key', url=self.emulator.url)
+
+    def tearDown(self):
+        self.gcm.pool.close()
+        self.emulator.stop()
+
+    def testJsonRequest(self):
+        info = self.gcm.json_request(['dead', 'old', 'live'], data={'message' : 'hello'})
+        self.assertEqual(['dead'], info['errors']['NotRegistered'])
+        self.assertEqual({'old' : 'new'}, info['canonical'])
+        self.assertEqual(1, self.emulator.requests)
+
+    def testJsonMulticastChunks(self):
+        reg_ids = ['id%d' % i for i in range(2500)] + ['dead', 'old']
+        info = self.gcm.json_multicast(reg_ids, data={'message' : 'hello'}, max_workers=2)
+        self.assertEqual(['dead'], info['errors']['NotRegistered'])
+        self.assertEqual({'old' : 'new'}, info['canonical'])
+        self.assertEqual(3, self.emulator.requests)
+        self.assertEqual(len(reg_ids), self.emulator.reg_ids)
+
+    def testJsonMulticastChunkFails(self):
+        # A chunk answered with a 200 that is not JSON may have been sent; it is reported as Unknown,
+        # not retried, and the results of the other chunks are kept.
+        self.emulator.garbled = set(['garbled'])
+        scheduled = []
+        reg_ids = ['garbled'] + ['id%d' % i for i in range(1500)] + ['dead', 'old']
+        info = self.gcm.json_multicast(reg_ids, data={'message' : 'hello'}, max_workers=2,
+            retry_scheduler=lambda reg_ids, attempt, delay: scheduled.append(reg_ids))
+        self.assertEqual(reg_ids[:GCM.MAX_REG_IDS], info['errors']['Unknown'])
+        self.assertEqual(['dead'], info['errors']['NotRegistered'])
+        self.assertEqual({'old' : 'new'}, info['canonical'])
+        self.assertEqual([], scheduled)
+        self.assertEqual(2, self.emulator.requests)
+
+    def testJsonMulticastChunkUnavailable(self):
+        # A chunk GCM did not take is reported as Unavailable and scheduled.
+        self.emulator.status = 503
+        scheduled = []
+        reg_ids = ['id%d' % i for i in range(1500)]
+        info = self.gcm.json_multicast(reg_ids, data={'message' : 'hello'}, max_workers=1,
+            retry_scheduler=lambda reg_ids, attempt, delay: scheduled.append(reg_ids))
+        self.assertEqual(reg_ids, info['errors']['Unavailable'])
+        self.assertEqual([reg_ids[:GCM.MAX_REG_IDS], reg_ids[GCM.MAX_REG_IDS:]], scheduled)
+
+    def testPreparedMessage(self):
+        message = PreparedMessage(data={'message' : 'hello'}, collapse_key='topic', time_to_live=60)
+        self.assertEqual({'registration_ids' : ['a', 'b'], 'data' : {'message' : 'hello'}, 'collapse_key' : 'topic', 'time_to_live' : 60},
+            json.loads(message.payload(['a', 'b'])))
+        self.assertEqual({'registration_ids' : ['a']}, json.loads(PreparedMessage().payload(['a'])))
+
+    def testMessageTooBig(self):
+        data = {'message' : 'x' * PreparedMessage.MAX_DATA_SIZE}
+        self.assertRaises(GCMMessageTooBigException, self.gcm.json_multicast, ['id%d' % i for i in range(2500)], data=data)
+        self.assertEqual(0, self.emulator.requests)
+
+    def testConnectionsReused(self):
+        for i in range(5):
+            self.gcm.json_request(['live'], data={'message' : 'hello'})
+        self.assertEqual(5, self.emulator.requests)
+        self.assertEqual(1, len(self.emulator.connections))
+
+    def testDroppedConnectionsNotReused(self):
+        # Idle connections the server closed are replaced before a request is sent on them.
+        self.emulator.drop_idle = True
+        for i in range(3):
+            self.gcm.json_request(['live'], data={'message' : 'hello'})
+            time.sleep(0.05)
+        self.assertEqual(3, self.emulator.requests)
+        self.assertEqual(3, len(self.emulator.connections))
+
+    def testNoRetryAfterSent(self):
+        # Once GCM has the request it may have sent the message, so a lost response is not retried.
+        self.gcm.json_request(['live'], data={'message' : 'hello'})
+        self.emulator.hang_up = True
+        self.assertRaises(GCMResponseLostException, self.gcm.json_request, ['live'], data={'message' : 'hello'})
+        self.assertEqual(2, self.emulator.requests)
+
+    def testNoRetryAfterSentMulticast(self):
+        # Nor is it scheduled for a retry: the ids are reported as Unknown.
+        self.emulator.hang_up = True
+        scheduled = []
+        reg_ids = ['id%d' % i for i in range(1500)]
+        info = self.gcm.json_multicast(reg_ids, data={'message' : 'hello'}, max_workers=2,
+            retry_scheduler=lambda reg_ids, attempt, delay: scheduled.append(reg_ids))
+        self.assertEqual(sorted(reg_ids), sorted(info['errors']['Unknown']))
+        self.assertFalse('Unavailable' in info['errors'])
+        self.assertEqual([], scheduled)
+        self.assertEqual(2, self.emulator.requests)
+
+    def testUnavailableScheduled(self):
+        self.emulator.unavailable = 1.0
+        scheduled = []
+        info = self.gcm.json_request(['live'], data={'message' : 'hello'},
+            retry_scheduler=lambda reg_ids, attempt, delay: scheduled.append((reg_ids, attempt)))
+        self.assertEqual(['live'], info['errors']['Unavailable'])
+        self.assertEqual([(['live'], 1)], scheduled)
+        self.assertEqual(1, self.emulator.requests)
+
+    def testServiceUnavailable(self):
+        self.emulator.status = 503
+        self.assertRaises(GCMUnavailableException, self.gcm.make_request, '{}')
+
+    def testCircuitBreakerOpens(self):
+        self.gcm.circuit_breaker = CircuitBreaker(threshold=2, reset_timeout=60)
+        self.emulator.status = 503
+        self.assertRaises(GCMUnavailableException, self.gcm.make_request, '{}')
+        self.assertRaises(GCMUnavailableException, self.gcm.make_request, '{}')
+        self.assertRaises(GCMCircuitOpenException, self.gcm.make_request, '{}')
+        self.assertEqual(2, self.emulator.requests)
+
+    def testCircuitBreakerRetryAfter(self):
+        self.gcm.circuit_breaker = CircuitBreaker(threshold=5, reset_timeout=60)
+        self.emulator.status = 503
+        self.emulator.retry_after = 120
+        self.assertRaises(GCMUnavailableException, self.gcm.make_request, '{}')
+        self.assertRaises(GCMCircuitOpenException, self.gcm.make_request, '{}')
+        self.assertTrue(self.gcm.circuit_breaker.retry_after() > 60)
+
+    def testCircuitBreakerHalfOpen(self):
+        self.gcm.circuit_breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        self.emulator.status = 503
+        self.assertRaises(GCMUnavailableException, self.gcm.make_request, '{}')
+        self.emulator.status = 200
+        self.gcm.json_request(['live'], data={'message' : 'hello'})
+        self.assertEqual(CircuitBreaker.CLOSED, self.gcm.circuit_breaker.state)
+
+    def testRateLimited(self):
+        self.gcm.rate_limiter = RateLimiter(reg_ids_per_second=1000, max_wait=0)
+        reg_ids = ['id%d' % i for i in range(1000)]
+        self.gcm.json_request(reg_ids, data={'message' : 'hello'})
+        self.assertRaises(GCMUnavailableException, self.gcm.json_request, reg_ids, data={'message' : 'hello'})
+        self.assertEqual(1, self.emulator.requests)
+
+    def testSharedRateLimit(self):
+        # Two senders standing in for two instances share one limit.
+        store = MemoryStore()
+        self.gcm.rate_limiter = RateLimiter(reg_ids_per_second=1000, max_wait=0, store=store)
+        other = GCM('test-api-key', url=self.emulator.url, rate_limiter=RateLimiter(reg_ids_per_second=1000, max_wait=0, store=store))
+        reg_ids = ['id%d' % i for i in range(600)]
+
+        # Start at the beginning of a window, so both requests fall in it.
+        now = time.time()
+        time.sleep(math.ceil(now) - now)
+        self.gcm.json_request(reg_ids, data={'message' : 'hello'})
+        self.assertRaises(GCMUnavailableException, other.json_request, reg_ids, data={'message' : 'hello'})
+        self.assertEqual(1, self.emulator.requests)
+        other.pool.close()
+
+    def testSharedRateLimitWaits(self):
+        # A request that does not fit in this window waits for the next one.
+        store = MemoryStore()
+        limiters = [RateLimiter(reg_ids_per_second=1000, max_wait=1.0, store=store) for i in range(2)]
+
+        now = time.time()
+        time.sleep(math.ceil(now) - now)
+        start = time.time()
+        self.assertTrue(limiters[0].acquire(600))
+        self.assertTrue(limiters[1].acquire(600))
+        self.assertTrue(time.time() - start > 0.5)
+
+    def testSharedCircuitBreaker(self):
+        store = MemoryStore()
+        breakers = [CircuitBreaker(threshold=1, reset_timeout=0.1, store=store) for i in range(2)]
+
+        # One instance tripping stops the other.
+        breakers[0].failure()
+        self.assertFalse(breakers[1].allow())
+        self.assertEqual(CircuitBreaker.OPEN, breakers[1].state)
+
+        # Once the timeout passes, only one of them probes.
+        time.sleep(0.15)
+        self.assertTrue(breakers[0].allow())
+        self.assertFalse(breakers[1].allow())
+
+        # Its success closes the circuit for the other within SYNC_INTERVAL.
+        breakers[0].success()
+        self.assertTrue(breakers[1].retry_after() <= CircuitBreaker.SYNC_INTERVAL)
+        time.sleep(CircuitBreaker.SYNC_INTERVAL)
+        self.assertTrue(breakers[1].allow())
+
+    def testTunerBacksOff(self):
+        self.gcm.tuner = BatchTuner(min_batch_size=10, max_batch_size=100, max_workers=4, window=2)
+        self.emulator.unavailable = 1.0
+        self.gcm.json_multicast(['id%d' % i for i in range(200)], data={'message' : 'hello'}, retries=1)
+        settings = self.gcm.tuner.settings()
+        self.assertEqual(50, settings['batch_size'])
+        self.assertEqual(3, settings['workers'])
+        self.assertEqual(2, settings['backoff_scale'])
+        self.assertEqual(2, settings['history'][100]['requests'])
+
+        self.emulator.unavailable = 0.0
+        self.emulator.reset()
+        self.gcm.json_multicast(['id%d' % i for i in range(100)], data={'message' : 'hello'}, retries=1)
+        self.assertEqual(2, self.emulator.requests)
+        self.assertEqual(100, self.gcm.tuner.settings()['batch_size'])
+        self.assertEqual(4, self.gcm.tuner.settings()['workers'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import json
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.api import users
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from config import Config
+from config import ConfigHandlerJson
+from deploy import Deploy
+from fields import Fields
+from helpers import setCurrentUser
+
+class ConfigCacheTest(unittest.TestCase):
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([ \
+            webapp2.Route('/<id:.*>/', ConfigHandlerJson) \
+        ])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_user_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        Config.cache.clear()
+
+        setCurrentUser(email=Deploy.GAE_ADMIN, user_id='1234', is_admin=True)
+        user_id = Fields.sanitize_user_id(users.get_current_user().user_id())
+
+        self.config = Config(key=Config.get_key('active'), name='active', gcm_api_key='old-key', user_id=user_id)
+        self.config.put()
+        self.cache_ttl = Config.CACHE_TTL
+
+    def tearDown(self):
+        Config.CACHE_TTL = self.cache_ttl
+        Config.cache.clear()
+        self.testbed.deactivate()
+
+    def write_behind(self, gcm_api_key):
+        # Change the config without going through ConfigAdapter, so nothing is invalidated.
+        self.config.gcm_api_key = gcm_api_key
+        self.config.put()
+
+    def testCachedWithinTtl(self):
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+
+        self.write_behind('new-key')
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+
+    def testCachedAfterTtlWithoutWrite(self):
+        # Once the TTL expires, the config is kept if the generation has not changed.
+        Config.CACHE_TTL = 0
+        generation = Config.get_generation()
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+
+        self.write_behind('new-key')
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+        self.assertEqual(generation, Config.get_generation())
+
+    def testCachedInMemcache(self):
+        # Another instance, without the config in its process, reads it from memcache.
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+
+        self.write_behind('new-key')
+        Config.cache.clear()
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+
+    def testWriteInvalidates(self):
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+        generation = Config.get_generation()
+
+        response = self.testapp.put(url='/active/', content_type='application/json', params=json.dumps({'name' : 'active', 'gcm_api_key' : 'new-key'}))
+        self.assertEqual(response.status_int, 200)
+
+        self.assertNotEqual(generation, Config.get_generation())
+        self.assertEqual('new-key', Config.get_active().gcm_api_key)
+
+    def testWriteInvalidatesOtherInstances(self):
+        # An instance that cached the config before the write sees the new generation once its TTL expires.
+        self.assertEqual('old-key', Config.get_active().gcm_api_key)
+        entry = Config.cache['active']
+
+        self.testapp.put(url='/active/', content_type='application/json', params=json.dumps({'name' : 'active', 'gcm_api_key' : 'new-key'}))
+        Config.cache['active'] = (0, entry[1], entry[2])
+        self.assertEqual('new-key', Config.get_active().gcm_api_key)
@@ -60,6 +60,27 @@ class DeviceHandlerJsonTest(unittest.TestCase):
         self.assertEqual(self.device.type, d['type'])
         self.assertEqual(self.device.user_id, d['user_id'])
 
+    def testDeviceHandlerJsonGetNotModified304(self):
+        headers = {
+            'Accept' : 'application/json',
+        }
+
+        response = self.testapp.get(url='/' + self.device.dev_id + '/', headers=headers)
+        self.assertEqual(response.status_int, 200)
+        etag = response.headers['ETag']
+        self.assertTrue(etag)
+
+        headers['If-None-Match'] = etag
+        response = self.testapp.get(url='/' + self.device.dev_id + '/', headers=headers, status=304)
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertFalse(response.body)
+
+        # A write changes the tag.
+        self.testapp.put(url='/' + self.device.dev_id + '/', content_type='application/json', params=json.dumps({'name' : 'new name', 'dev_id' : self.device.dev_id}))
+        response = self.testapp.get(url='/' + self.device.dev_id + '/', headers=headers)
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
     def testDeviceHandlerJsonGetMissing404(self):
         headers = {
             'Accept' : 'application/json',
@@ -111,6 +132,18 @@ class DeviceHandlerJsonTest(unittest.TestCase):
         self.assertEqual(self.device.user_id, d['user_id'])
         self.assertEqual(self.device.revision, d['revision'])
 
+    def testDeviceHandlerJsonPutChangedId404(self):
+        # The dev_id is the key, so it cannot be changed.
+        response = self.testapp.put(url='/' + self.device.dev_id + '/',
+            content_type='application/json',
+            params=json.dumps({'dev_id' : 'ffffffffffffffff'}), status=404)
+        self.assertEqual(response.status_int, 404)
+
+        d = self.key.get()
+        self.assertEqual(self.device.dev_id, d.dev_id)
+        self.assertEqual(self.device.revision, d.revision)
+        self.assertEqual(None, Device.get_key('ffffffffffffffff').get())
+
     def testDeviceHandlerJsonDeleteExisting200(self):
         response = self.testapp.delete(url='/' + self.device.dev_id + '/')
         self.assertEqual(response.status_int, 200)
@@ -23,6 +23,7 @@ class DevicesHandlerHtmlTest(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_user_stub()
+        self.testbed.init_memcache_stub()
 
         setCurrentUser(email=Deploy.GAE_ADMIN, user_id='1234', is_admin=True)
         user_id=Fields.sanitize_user_id(users.get_current_user().user_id())
@@ -1,9 +1,12 @@
 import datetime
 import json
+import time
+import types
 import webapp2
 import webtest
 import unittest2 as unittest
 
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
@@ -13,6 +16,7 @@ from deploy import Deploy
 from device import Device
 from device import DevicesHandlerJson
 from fields import Fields
+from generation import Generation
 from helpers import setCurrentUser
 from testdata import TestData
 
@@ -27,6 +31,7 @@ class DevicesHandlerJsonTest(unittest.TestCase):
         self.testbed.activate()
         self.testbed.init_datastore_v3_stub()
         self.testbed.init_user_stub()
+        self.testbed.init_memcache_stub()
         ndb.get_context().clear_cache()
 
         setCurrentUser(email=Deploy.GAE_ADMIN, user_id='1234', is_admin=True)
@@ -57,6 +62,100 @@ class DevicesHandlerJsonTest(unittest.TestCase):
         self.assertEqual(str(self.device.modified), d['modified'])
         self.assertEqual(self.device.revision, d['revision'])
 
+    def testDevicesHandlerGetNotModified304(self):
+        response = self.testapp.get('/')
+        etag = response.headers['ETag']
+
+        response = self.testapp.get('/', headers={'If-None-Match' : etag}, status=304)
+        self.assertFalse(response.body)
+
+        # Other parameters are another representation.
+        response = self.testapp.get('/?limit=1', headers={'If-None-Match' : etag})
+        self.assertEqual(response.status_int, 200)
+
+        self.testapp.delete('/')
+        response = self.testapp.get('/', headers={'If-None-Match' : etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual([], json.loads(response.body))
+
+    def testDevicesHandlerGetNotModifiedPage(self):
+        # Devices have no common parent, so a page is tagged by the devices read, not by the generation.
+        response = self.testapp.get('/')
+        etag = response.headers['ETag']
+
+        memcache.flush_all()
+        response = self.testapp.get('/', headers={'If-None-Match' : etag}, status=304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        self.device.name = 'new name'
+        self.device.put()
+        response = self.testapp.get('/', headers={'If-None-Match' : etag})
+        self.assertEqual(response.status_int, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    def testGenerationAfterEviction(self):
+        generation = Generation.get('test-generation')
+        Generation.bump('test-generation')
+        self.assertEqual(generation + 1, Generation.get('test-generation'))
+
+        # A generation seeded again after an eviction is not one used before.
+        time.sleep(0.002)
+        memcache.flush_all()
+        self.assertTrue(Generation.get('test-generation') > generation + 1)
+
+    def testDevicesHandlerGetPage(self):
+        for test in TestData.TEST_DEVICES[1:]:
+            Device(key=Device.get_key(test['dev_id']), user_id=self.device.user_id, name=test['name'], reg_id=test['reg_id'], dev_id=test['dev_id'], resource=test['resource'], type=test['type']).put()
+
+        dev_ids = []
+        url = '/?limit=1'
+        while url:
+            response = self.testapp.get(url)
+            self.assertEqual(response.status_int, 200)
+            j = json.loads(response.body)
+            self.assertTrue(len(j) <= 1)
+            dev_ids.extend([d['dev_id'] for d in j])
+
+            cursor = response.headers.get('X-Next-Cursor')
+            url = '/?limit=1&cursor=' + cursor if cursor else None
+
+        self.assertEqual(len(TestData.TEST_DEVICES), len(dev_ids))
+        self.assertEqual(len(TestData.TEST_DEVICES), len(set(dev_ids)))
+
+    def testDevicesHandlerGetPage400(self):
+        # Cursor that was not returned by the server.
+        self.assertRaises(webtest.app.AppError, self.testapp.get, url='/?cursor=xxx')
+
+    def testDevicesHandlerGetStream(self):
+        response = self.testapp.get('/?stream=1')
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertFalse('X-Next-Cursor' in response.headers)
+        j = json.loads(response.body)
+        self.assertEqual(1, len(j))
+        self.assertEqual(self.device.dev_id, j[0]['dev_id'])
+
+    def testDevicesHandlerGetStreamLazy(self):
+        # The stream is not read until the response is written.
+        request = webapp2.Request.blank('/?stream=1')
+        response = webapp2.Response()
+        DevicesHandlerJson(request, response).get()
+        self.assertTrue(isinstance(response.app_iter, types.GeneratorType))
+
+        self.key.delete()
+        self.assertEqual([], json.loads(''.join(response.app_iter)))
+
+    def testDevicesHandlerGetFields(self):
+        response = self.testapp.get('/?fields=dev_id,reg_id')
+        self.assertEqual(response.status_int, 200)
+        j = json.loads(response.body)
+        self.assertEqual(1, len(j))
+        self.assertEqual({'dev_id' : self.device.dev_id, 'reg_id' : self.device.reg_id}, j[0])
+
+    def testDevicesHandlerGetFields400(self):
+        # Not a property of Device.
+        self.assertRaises(webtest.app.AppError, self.testapp.get, url='/?fields=dev_id,password')
+
     def testDevicesHandlerPost(self):
         params = json.dumps(obj=self.device, cls=NdbJsonEncoder)
         response = self.testapp.post('/', content_type='application/json', params=params)
@@ -75,14 +174,61 @@ class DevicesHandlerJsonTest(unittest.TestCase):
         self.assertTrue(str(self.device.modified), d['modified'])
         self.assertEqual(self.device.revision, d['revision'])
 
+    def testDevicesHandlerPostList(self):
+        # The first device is already stored, and the last one has an invalid dev_id.
+        devices = [dict(test) for test in TestData.TEST_DEVICES] + [{'dev_id' : 'not-a-dev-id'}]
+        response = self.testapp.post('/', content_type='application/json', params=json.dumps(devices))
+        self.assertEqual(response.status_int, 200)
+        j = json.loads(response.body)
+        self.assertEqual(len(devices), len(j))
+        self.assertEqual(self.device.dev_id, j[0]['dev_id'])
+        self.assertEqual(self.device.revision + 1, j[0]['revision'])
+        for test, d in zip(TestData.TEST_DEVICES[1:], j[1:]):
+            self.assertEqual(test['dev_id'], d['dev_id'])
+            self.assertEqual(0, d['revision'])
+        self.assertEqual(None, j[-1])
+
+        j = json.loads(self.testapp.get('/').body)
+        self.assertEqual(len(TestData.TEST_DEVICES), len(j))
+
     def testDevicesHandlerPost400(self):
         # POST with no data.
         self.assertRaises(webtest.app.AppError, self.testapp.post, url='/')
 
-    def testDevicesHandlerPut500(self):
-        # PUT not implemented.
+    def testDevicesHandlerPut400(self):
+        # PUT with no data.
         self.assertRaises(webtest.app.AppError, self.testapp.put, url='/')
 
+    def testDevicesHandlerPutList(self):
+        # The second patch is for a device that does not exist.
+        patches = [{'id' : self.device.dev_id, 'fields' : {'name' : 'renamed'}}, {'id' : 'abcdef', 'fields' : {'name' : 'renamed'}}]
+        response = self.testapp.put('/', content_type='application/json', params=json.dumps(patches))
+        self.assertEqual(response.status_int, 200)
+        j = json.loads(response.body)
+        self.assertEqual(2, len(j))
+        self.assertEqual('renamed', j[0]['name'])
+        self.assertEqual(self.device.reg_id, j[0]['reg_id'])
+        self.assertEqual(self.device.revision + 1, j[0]['revision'])
+        self.assertEqual(None, j[1])
+        self.assertEqual('renamed', self.key.get().name)
+
+    def testDevicesHandlerPutList400(self):
+        # An id that is not a string fails the request.
+        patches = [{'id' : self.device.dev_id, 'fields' : {'name' : 'renamed'}}, {'id' : [self.device.dev_id], 'fields' : {'name' : 'renamed'}}]
+        response = self.testapp.put('/', content_type='application/json', params=json.dumps(patches), status=400)
+        self.assertEqual(response.status_int, 400)
+        self.assertEqual(self.device.name, self.key.get().name)
+
+    def testDevicesHandlerPutFilter(self):
+        patch = {'filter' : {'type' : self.device.type}, 'fields' : {'resource' : 'patched'}}
+        response = self.testapp.put('/', content_type='application/json', params=json.dumps(patch))
+        self.assertEqual(response.status_int, 200)
+        self.assertFalse('X-Next-Cursor' in response.headers)
+        j = json.loads(response.body)
+        self.assertEqual(1, len(j))
+        self.assertEqual('patched', j[0]['resource'])
+        self.assertEqual('patched', self.key.get().resource)
+
     def testDevicesHandlerDelete(self):
         response = self.testapp.delete('/')
         self.assertEqual(response.status_int, 200)
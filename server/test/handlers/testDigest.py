@@ -0,0 +1,163 @@
+import datetime
+import json
+import os
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from digest import Digest
+from digest import DigestCleanupHandler
+from digest import DigestHandler
+from digest import DigestItem
+from gcm import PreparedMessage
+from gcmHelpers import gcm
+from topicIndex import TopicIndex
+
+class DigestTest(unittest.TestCase):
+    WINDOW = 1000
+    PUB_ID = 'digest'
+
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([(Digest.URL, DigestHandler), (Digest.CLEANUP_URL, DigestCleanupHandler)])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        # The lanes' queues are defined in queue.yaml.
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def get_size(self, data):
+        return len(json.dumps(data))
+
+    def get_item(self, message):
+        return {'type' : 'publish-message', 'context' : 'topic', 'message' : message}
+
+    def get_sized_item(self, size):
+        # An item whose digest of its own is size bytes.
+        return self.get_item('a' * (size - self.get_size(Digest.get_data(self.WINDOW, 0, [self.get_item('')]))))
+
+    def put_items(self, window, count):
+        created = datetime.datetime(2015, 1, 1)
+        ndb.put_multi([DigestItem(window=window, pub_id=self.PUB_ID, data=self.get_item(str(i)),
+            created=created + datetime.timedelta(seconds=i)) for i in range(count)])
+
+    def get_tasks(self, url, queue_name):
+        return self.taskqueue.get_filtered_tasks(url=url, queue_names=[queue_name])
+
+    def testPackEmpty(self):
+        self.assertEqual([], Digest.pack(self.WINDOW, []))
+
+    def testPack(self):
+        items = [self.get_item(str(i)) for i in range(3)]
+        digests = Digest.pack(self.WINDOW, items)
+
+        self.assertEqual(1, len(digests))
+        self.assertEqual('3', digests[0]['count'])
+        self.assertEqual('%d-0' % (self.WINDOW), digests[0]['context'])
+        self.assertEqual(items, json.loads(digests[0]['messages']))
+
+    def testPackSplit(self):
+        # Items that do not fit in one message are split over several, each with its own context, in order.
+        items = [self.get_sized_item(PreparedMessage.MAX_DATA_SIZE / 3) for i in range(10)]
+        digests = Digest.pack(self.WINDOW, items)
+
+        self.assertTrue(len(digests) > 1)
+        self.assertEqual(len(set([data['context'] for data in digests])), len(digests))
+        for data in digests:
+            self.assertTrue(self.get_size(data) <= PreparedMessage.MAX_DATA_SIZE)
+
+        messages = []
+        for data in digests:
+            messages.extend(json.loads(data['messages']))
+        self.assertEqual(items, messages)
+
+    def testFitBoundary(self):
+        # An item exactly the size of a message is sent whole, on its own.
+        item = self.get_sized_item(PreparedMessage.MAX_DATA_SIZE)
+        self.assertEqual(PreparedMessage.MAX_DATA_SIZE, self.get_size(Digest.get_data(self.WINDOW, 0, [item])))
+        self.assertEqual(item, Digest.fit(self.WINDOW, 0, item))
+
+        small = self.get_item('small')
+        digests = Digest.pack(self.WINDOW, [small, item, small])
+        self.assertEqual(3, len(digests))
+        self.assertEqual([item], json.loads(digests[1]['messages']))
+
+    def testFitOversized(self):
+        # An item over the size of a message has its message truncated to fit.
+        item = self.get_sized_item(PreparedMessage.MAX_DATA_SIZE + 100)
+        fitted = Digest.fit(self.WINDOW, 0, item)
+
+        self.assertEqual(item['context'], fitted['context'])
+        self.assertTrue(item['message'].startswith(fitted['message']))
+        self.assertTrue(self.get_size(Digest.get_data(self.WINDOW, 0, [fitted])) <= PreparedMessage.MAX_DATA_SIZE)
+
+        digests = Digest.pack(self.WINDOW, [self.get_item('small'), item])
+        self.assertEqual(2, len(digests))
+        self.assertEqual([fitted], json.loads(digests[1]['messages']))
+
+    def testFitDropped(self):
+        # An item too big even without its message is left out.
+        item = {'type' : 'publish-message', 'context' : 'c' * PreparedMessage.MAX_DATA_SIZE, 'message' : 'message'}
+        self.assertEqual(None, Digest.fit(self.WINDOW, 0, item))
+
+        small = self.get_item('small')
+        digests = Digest.pack(self.WINDOW, [item, small])
+        self.assertEqual(1, len(digests))
+        self.assertEqual([small], json.loads(digests[0]['messages']))
+
+    def testSavePartsEmpty(self):
+        self.assertEqual(0, Digest.save_parts(self.WINDOW))
+        self.assertEqual([], Digest.load_parts(self.WINDOW, 0))
+
+        # An empty window is not sent.
+        self.testapp.post(Digest.URL, {'window' : self.WINDOW})
+        self.assertEqual(0, len(self.get_tasks(Digest.SHARD_URL, gcm.LANES[Digest.LANE]['queue'])))
+
+    def testSavePartsBoundary(self):
+        self.put_items(self.WINDOW, Digest.PART_SIZE)
+        self.assertEqual(1, Digest.save_parts(self.WINDOW))
+
+        self.put_items(self.WINDOW + 1, Digest.PART_SIZE + 1)
+        self.assertEqual(2, Digest.save_parts(self.WINDOW + 1))
+
+        items = Digest.load_parts(self.WINDOW + 1, 2)
+        self.assertEqual([str(i) for i in range(Digest.PART_SIZE + 1)], [item['data']['message'] for item in items])
+
+        # A rerun uses the parts already stored.
+        self.put_items(self.WINDOW + 1, 1)
+        self.assertEqual(2, Digest.save_parts(self.WINDOW + 1))
+        self.assertEqual(Digest.PART_SIZE + 1, len(Digest.load_parts(self.WINDOW + 1, 2)))
+
+    def testCleanup(self):
+        self.put_items(self.WINDOW, Digest.PART_SIZE + 1)
+        self.put_items(self.WINDOW + 1, 1)
+
+        self.testapp.post(Digest.URL, {'window' : self.WINDOW})
+        self.assertEqual(TopicIndex.SHARDS, len(self.get_tasks(Digest.SHARD_URL, gcm.LANES[Digest.LANE]['queue'])))
+
+        tasks = self.get_tasks(Digest.CLEANUP_URL, Digest.CLEANUP_QUEUE_NAME)
+        self.assertEqual(1, len(tasks))
+
+        # A rerun of the flush finds the cleanup added.
+        self.testapp.post(Digest.URL, {'window' : self.WINDOW})
+        self.assertEqual(1, len(self.get_tasks(Digest.CLEANUP_URL, Digest.CLEANUP_QUEUE_NAME)))
+
+        self.testapp.post(Digest.CLEANUP_URL, tasks[0].extract_params())
+        self.assertEqual(0, DigestItem.query(DigestItem.window == self.WINDOW).count())
+        self.assertEqual([None, None], ndb.get_multi([Digest.get_part_key(self.WINDOW, part) for part in range(2)]))
+
+        # Other windows are kept.
+        self.assertEqual(1, DigestItem.query(DigestItem.window == self.WINDOW + 1).count())
@@ -0,0 +1,58 @@
+import unittest2 as unittest
+
+from google.appengine.ext import testbed
+
+from gcmHelpers import gcm
+
+class GcmLanesTest(unittest.TestCase):
+    API_KEY = 'api-key'
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_memcache_stub()
+        gcm.senders.clear()
+
+    def tearDown(self):
+        self.close_senders()
+        self.testbed.deactivate()
+
+    def close_senders(self):
+        for sender in gcm.senders.values():
+            sender.pool.close()
+        gcm.senders.clear()
+
+    def get_senders(self):
+        return gcm.get_sender(self.API_KEY, gcm.LANE_DIRECT), gcm.get_sender(self.API_KEY, gcm.LANE_BROADCAST)
+
+    def testOwnLimits(self):
+        direct, broadcast = self.get_senders()
+        self.assertIsNot(direct.rate_limiter, broadcast.rate_limiter)
+        self.assertIsNot(direct.circuit_breaker, broadcast.circuit_breaker)
+
+        # A broadcast using all of its lane's registration ids for this second leaves the direct lane's.
+        rate = gcm.LANES[gcm.LANE_BROADCAST]['reg_ids_per_second']
+        self.assertIsNotNone(broadcast.rate_limiter.reg_ids.reserve(rate, 0))
+        self.assertIsNone(broadcast.rate_limiter.reg_ids.reserve(1, 0))
+        self.assertIsNotNone(direct.rate_limiter.reg_ids.reserve(1, 0))
+
+    def testBroadcastTripped(self):
+        direct, broadcast = self.get_senders()
+        for i in range(gcm.BREAKER_THRESHOLD):
+            broadcast.circuit_breaker.failure()
+
+        self.assertFalse(broadcast.circuit_breaker.allow())
+        self.assertTrue(direct.circuit_breaker.allow())
+
+        # The other instances, sharing the circuits through memcache, see the same.
+        self.close_senders()
+        direct, broadcast = self.get_senders()
+        self.assertFalse(broadcast.circuit_breaker.allow())
+        self.assertTrue(direct.circuit_breaker.allow())
+
+    def testDirectTripped(self):
+        direct, broadcast = self.get_senders()
+        direct.circuit_breaker.hold(60)
+
+        self.assertFalse(direct.circuit_breaker.allow())
+        self.assertTrue(broadcast.circuit_breaker.allow())
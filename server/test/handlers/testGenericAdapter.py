@@ -0,0 +1,41 @@
+import unittest2 as unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from genericAdapter import GenericAdapter
+from subscription import Subscription
+
+class GenericAdapterTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        self.adapter = GenericAdapter(Subscription)
+        self.subscription = Subscription(topic='topic', pub_id='publication', dev_id='0123456789abcdef', user_id='1234')
+        self.subscription.put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def update(self, id):
+        return self.adapter.update_all([{'id' : self.subscription.key.urlsafe(), 'fields' : {'topic' : 'patched'}},
+            {'id' : id, 'fields' : {'topic' : 'patched'}}])
+
+    def testUpdateAllMissing(self):
+        # A well-formed id of an object that does not exist fails only its patch.
+        objs, cursor = self.update(ndb.Key(Subscription, 'missing').urlsafe())
+        self.assertEqual(2, len(objs))
+        self.assertEqual('patched', objs[0].topic)
+        self.assertEqual(None, objs[1])
+
+    def testUpdateAllMalformed(self):
+        # A malformed id, or the key of another app, fails the request and patches nothing.
+        for id in ('not-a-key', 'abcd', ndb.Key(Subscription, 'other', app='other-app').urlsafe(), 1234, {'id' : 'x'}):
+            self.assertEqual((None, None), self.update(id))
+
+        self.assertEqual('topic', self.subscription.key.get().topic)
@@ -0,0 +1,118 @@
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from deploy import Deploy
+from device import Device
+from fields import Fields
+from helpers import setCurrentUser
+from migration import Migration
+from migration import MigrationHandler
+from testdata import TestData
+
+class MigrationHandlerTest(unittest.TestCase):
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([('/', MigrationHandler)])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Queries see every write, so devices stored under numeric ids are found by query.
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_user_stub()
+        self.testbed.init_memcache_stub()
+        self.testbed.init_taskqueue_stub()
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+        Migration.cache.clear()
+
+        setCurrentUser(email=Deploy.GAE_ADMIN, user_id='1234', is_admin=True)
+        self.user_id = Fields.sanitize_user_id(users.get_current_user().user_id())
+
+        # Devices stored before they were keyed by dev_id.
+        self.devices = [self.create(test) for test in TestData.TEST_DEVICES]
+
+    def tearDown(self):
+        Migration.cache.clear()
+        self.testbed.deactivate()
+
+    def create(self, test, key=None):
+        device = Device(key=key, user_id=self.user_id, name=test['name'], reg_id=test['reg_id'], dev_id=test['dev_id'], resource=test['resource'], type=test['type'])
+        device.put()
+        return device
+
+    def testQueryByIdBeforeMigration(self):
+        device = self.devices[0]
+        self.assertTrue(isinstance(device.key.id(), (int, long)))
+        self.assertEqual([device.key], Device.query_by_id(device.dev_id))
+        self.assertFalse(Migration.is_done(Device))
+
+    def testRekey(self):
+        device = self.devices[0]
+        self.assertTrue(Migration.rekey(Device, device.key))
+
+        self.assertEqual(None, device.key.get())
+        moved = Device.get_key(device.dev_id).get()
+        self.assertEqual(device.name, moved.name)
+        self.assertEqual(device.reg_id, moved.reg_id)
+        self.assertEqual(device.revision, moved.revision)
+        self.assertEqual([moved.key], Device.query_by_id(device.dev_id))
+
+        # Already moved.
+        self.assertFalse(Migration.rekey(Device, device.key))
+
+    def testRekeyNewerWins(self):
+        device = self.devices[0]
+        test = dict(TestData.TEST_DEVICES[0], name='newer')
+        current = self.create(test, key=Device.get_key(device.dev_id))
+
+        self.assertTrue(Migration.rekey(Device, device.key))
+
+        self.assertEqual(None, device.key.get())
+        self.assertEqual('newer', current.key.get().name)
+
+    def testMigrationHandlerPost(self):
+        response = self.testapp.post('/', params={'kind' : 'Device'})
+        self.assertEqual(response.status_int, 200)
+
+        for device in self.devices:
+            self.assertEqual(None, device.key.get())
+            self.assertEqual([Device.get_key(device.dev_id)], Device.query_by_id(device.dev_id))
+
+        migration = ndb.Key(Migration, 'Device').get()
+        self.assertTrue(migration.done)
+        self.assertEqual(len(self.devices), migration.migrated)
+        self.assertTrue(Migration.is_done(Device))
+        self.assertEqual(0, len(self.taskqueue.get_filtered_tasks(queue_names=[Migration.QUEUE_NAME])))
+
+        # Once migrated, devices are only found under their natural key.
+        self.create(dict(TestData.TEST_DEVICES[0], dev_id='ffffffffffffffff'))
+        self.assertEqual([], Device.query_by_id('ffffffffffffffff'))
+
+    def testMigrationHandlerPostBatches(self):
+        batch_size = Migration.BATCH_SIZE
+        Migration.BATCH_SIZE = 1
+        try:
+            self.testapp.post('/', params={'kind' : 'Device'})
+        finally:
+            Migration.BATCH_SIZE = batch_size
+
+        migration = ndb.Key(Migration, 'Device').get()
+        self.assertFalse(migration.done)
+        self.assertEqual(1, migration.migrated)
+        self.assertFalse(Migration.is_done(Device))
+
+        tasks = self.taskqueue.get_filtered_tasks(queue_names=[Migration.QUEUE_NAME])
+        self.assertEqual(1, len(tasks))
+        self.assertEqual(Migration.URL, tasks[0].url)
+
+        # Devices not yet migrated are still found by query.
+        for device in self.devices:
+            self.assertEqual(1, len(Device.query_by_id(device.dev_id)))
@@ -0,0 +1,125 @@
+import json
+import os
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from fanOut import FanOut
+from fanOut import FanOutShardHandler
+from gcmHelpers import gcm
+from outbox import Outbox
+from outbox import OutboxCleanupHandler
+from topicIndex import TopicIndex
+
+class OutboxTest(unittest.TestCase):
+    MESSAGE_KEY = 'message'
+    PUB_ID = 'outbox'
+
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([(FanOut.SHARD_URL, FanOutShardHandler), (Outbox.CLEANUP_URL, OutboxCleanupHandler)])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        # The lanes' queues are defined in queue.yaml.
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+        # Record the sends instead of making them.
+        self.sent = []
+        self.send = gcm.__dict__['send']
+        gcm.send = staticmethod(lambda data, reg_ids, lane, outbox: self.sent.append(reg_ids) or {})
+        self.checkpoint_size = FanOut.CHECKPOINT_SIZE
+        FanOut.CHECKPOINT_SIZE = 2
+
+    def tearDown(self):
+        gcm.send = self.send
+        FanOut.CHECKPOINT_SIZE = self.checkpoint_size
+        self.testbed.deactivate()
+
+    def post_shard(self, key, page):
+        payload = json.dumps({'id' : self.MESSAGE_KEY, 'data' : {}, 'lane' : gcm.LANE_BROADCAST,
+            'shard' : key.urlsafe(), 'part' : 'shard-0', 'page' : page})
+        return self.testapp.post(FanOut.SHARD_URL, payload)
+
+    def get_tasks(self, queue_name, url):
+        return [task for task in self.taskqueue.get_filtered_tasks(queue_names=[queue_name]) if task.url == url]
+
+    def testCheckpoint(self):
+        key = Outbox.get_part(self.MESSAGE_KEY, 'shard-0').key
+
+        outbox = Outbox.checkpoint(key, ['a', 'b', 'c', 'd'], {'errors' : {'Unavailable' : ['b'], 'NotRegistered' : ['c']}}, page=1)
+        self.assertEqual(2, outbox.sent)
+        self.assertEqual(1, outbox.failed)
+        self.assertEqual(['b'], outbox.unavailable)
+        self.assertEqual(1, outbox.page)
+
+        # A failed send counts every reg_id as failed.
+        outbox = Outbox.checkpoint(key, ['e'], None)
+        self.assertEqual(2, outbox.sent)
+        self.assertEqual(2, outbox.failed)
+
+        # A retry that went through is no longer pending.
+        outbox = Outbox.checkpoint(key, ['b'], {})
+        self.assertEqual(3, outbox.sent)
+        self.assertEqual([], outbox.unavailable)
+
+        self.assertEqual({'parts' : 1, 'done' : 0, 'sent' : 3, 'failed' : 2, 'unavailable' : 0}, Outbox.get_progress(self.MESSAGE_KEY))
+
+    def testCheckpointMissing(self):
+        self.assertEqual(None, Outbox.checkpoint(ndb.Key(Outbox, 'missing'), ['a'], {}))
+
+    def testResume(self):
+        key = TopicIndex.get_key(self.PUB_ID, 0)
+        TopicIndex.update_entries(key, self.PUB_ID, {'0001' : 'a', '0002' : 'b', '0003' : 'c'}, TopicIndex.MODE_ADD)
+
+        self.post_shard(key, 0)
+        self.assertEqual([['a', 'b']], self.sent)
+        outbox = Outbox.get_part(self.MESSAGE_KEY, 'shard-0')
+        self.assertEqual(1, outbox.page)
+        self.assertTrue(outbox.cursor)
+        self.assertEqual(Outbox.STATE_SENDING, outbox.state)
+        self.assertEqual(1, len(self.get_tasks(gcm.LANES[gcm.LANE_BROADCAST]['queue'], FanOut.SHARD_URL)))
+
+        # A rerun of a page already sent does not send it again.
+        self.post_shard(key, 0)
+        self.assertEqual([['a', 'b']], self.sent)
+
+        # The next page resumes from the checkpointed cursor.
+        self.post_shard(key, 1)
+        self.assertEqual([['a', 'b'], ['c']], self.sent)
+        outbox = Outbox.get_part(self.MESSAGE_KEY, 'shard-0')
+        self.assertEqual(Outbox.STATE_DONE, outbox.state)
+        self.assertEqual(3, outbox.sent)
+        self.assertEqual(None, outbox.cursor)
+
+        # A done part is not sent again.
+        self.post_shard(key, 1)
+        self.assertEqual([['a', 'b'], ['c']], self.sent)
+
+        self.assertEqual(1, len(self.get_tasks(Outbox.CLEANUP_QUEUE_NAME, Outbox.CLEANUP_URL)))
+
+    def testCleanup(self):
+        done = Outbox.get_part(self.MESSAGE_KEY, 'shard-0')
+        Outbox.checkpoint(done.key, [], {}, state=Outbox.STATE_DONE)
+        sending = Outbox.get_part(self.MESSAGE_KEY, 'shard-1')
+        other = Outbox.get_part('other', 'shard-0')
+
+        # Parts still sending are checked again later.
+        self.testapp.post(Outbox.CLEANUP_URL, {'message_key' : self.MESSAGE_KEY})
+        self.assertTrue(done.key.get())
+        self.assertEqual(1, len(self.get_tasks(Outbox.CLEANUP_QUEUE_NAME, Outbox.CLEANUP_URL)))
+
+        Outbox.checkpoint(sending.key, [], {}, state=Outbox.STATE_DONE)
+        self.testapp.post(Outbox.CLEANUP_URL, {'message_key' : self.MESSAGE_KEY})
+        self.assertEqual([None, None], ndb.get_multi([done.key, sending.key]))
+        self.assertTrue(other.key.get())
@@ -0,0 +1,118 @@
+import datetime
+import os
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from fanOut import FanOut
+from gcmHelpers import gcm
+from pmessage import PMessage
+from pmessage import PMessageAdapter
+from pmessage import PMessageWindow
+from pmessage import PMessageWindowCleanupHandler
+from publication import Publication
+
+class PMessageCoalesceTest(unittest.TestCase):
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([(PMessageWindow.CLEANUP_URL, PMessageWindowCleanupHandler)])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        # The lanes' queues are defined in queue.yaml.
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+        self.publication = Publication(topic='topic', description='description', coalesce=Publication.MAX_COALESCE, user_id='1234')
+        self.publication.put()
+        self.adapter = PMessageAdapter(PMessage)
+
+        # Record the fan-outs instead of adding their tasks.
+        self.published = []
+        self.enqueue_publication = FanOut.__dict__['enqueue_publication']
+        FanOut.enqueue_publication = staticmethod(lambda obj, data: self.published.append((obj.key, data)))
+
+        # Every message is created in the window that starts here.
+        self.created = datetime.datetime(2015, 1, 1)
+
+    def tearDown(self):
+        FanOut.enqueue_publication = self.enqueue_publication
+        self.testbed.deactivate()
+
+    def create(self, message, offset=0):
+        obj = PMessage(pub_id=self.publication.key.urlsafe(), message=message, user_id='1234',
+            created=self.created + datetime.timedelta(milliseconds=offset))
+        obj.put()
+        self.assertTrue(self.adapter.publish(obj, self.publication))
+        return obj
+
+    def get_tasks(self):
+        return self.taskqueue.get_filtered_tasks(url=FanOut.URL, queue_names=[gcm.LANES[gcm.LANE_BROADCAST]['queue']])
+
+    def get_window(self, obj):
+        return PMessageWindow.get_key(obj, self.publication.coalesce).get()
+
+    def testCoalesced(self):
+        first = self.create('first', 1)
+        newest = self.create('newest', 3)
+        self.create('older', 2)
+
+        # One fan-out for the window, added by its first message.
+        tasks = self.get_tasks()
+        self.assertEqual(1, len(tasks))
+        self.assertEqual(first.key.urlsafe(), tasks[0].extract_params()['key'])
+        self.assertEqual([], self.published)
+
+        window = self.get_window(first)
+        self.assertEqual(3, window.count)
+        self.assertEqual(newest.key.urlsafe(), window.latest)
+        self.assertFalse(window.closed)
+
+        # The fan-out sends the newest message, with the number of messages it stands for.
+        first.send()
+        self.assertEqual(1, len(self.published))
+        key, data = self.published[0]
+        self.assertEqual(first.key, key)
+        self.assertEqual('newest', data['message'])
+        self.assertEqual('3', data['coalesced'])
+        self.assertTrue(self.get_window(first).closed)
+
+        # A rerun of the fan-out sends the same message.
+        first.send()
+        self.assertEqual(self.published[0], self.published[1])
+
+    def testAfterFanOut(self):
+        # A message whose window's fan-out has started is sent on its own, not lost.
+        first = self.create('first', 1)
+        first.send()
+
+        late = self.create('late', 2)
+        self.assertEqual(2, len(self.published))
+        key, data = self.published[1]
+        self.assertEqual(late.key, key)
+        self.assertEqual('late', data['message'])
+        self.assertFalse('coalesced' in data)
+
+        # The closed window does not change, and no other fan-out task is added.
+        window = self.get_window(first)
+        self.assertEqual(1, window.count)
+        self.assertEqual(first.key.urlsafe(), window.latest)
+        self.assertEqual(1, len(self.get_tasks()))
+
+    def testCleanup(self):
+        first = self.create('first')
+        first.send()
+
+        tasks = self.taskqueue.get_filtered_tasks(url=PMessageWindow.CLEANUP_URL, queue_names=[PMessageWindow.CLEANUP_QUEUE_NAME])
+        self.assertEqual(1, len(tasks))
+
+        self.testapp.post(PMessageWindow.CLEANUP_URL, tasks[0].extract_params())
+        self.assertEqual(None, self.get_window(first))
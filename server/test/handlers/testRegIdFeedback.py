@@ -0,0 +1,73 @@
+import unittest2 as unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from device import Device
+from gcmHelpers import RegIdFeedback
+from testdata import TestData
+from topicIndex import TopicIndex
+
+class RegIdFeedbackTest(unittest.TestCase):
+    PUB_ID = 'feedback'
+    CANONICAL_REG_ID = 'canonical_reg_id'
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Queries see every write, so devices are found by reg_id as soon as they are stored.
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+
+        self.devices = []
+        for test in TestData.TEST_DEVICES[:2]:
+            device = Device(key=Device.get_key(test['dev_id']), user_id='1234', name=test['name'], reg_id=test['reg_id'], dev_id=test['dev_id'], resource=test['resource'], type=test['type'])
+            device.put()
+            TopicIndex.add(self.PUB_ID, device.dev_id, device.reg_id)
+            self.devices.append(device)
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def get_entry(self, dev_id):
+        return TopicIndex.get_entry_key(TopicIndex.get_key(self.PUB_ID, TopicIndex.get_shard(dev_id)), dev_id).get()
+
+    def testNotRegistered(self):
+        dead, replaced = self.devices
+        dead_keys, devices = RegIdFeedback().apply({'errors' : {'NotRegistered' : [dead.reg_id]}})
+
+        self.assertEqual([dead.key], dead_keys)
+        self.assertEqual([], devices)
+        self.assertEqual(None, dead.key.get())
+        self.assertEqual(replaced.reg_id, replaced.key.get().reg_id)
+
+        # The index keeps the entry, without a reg_id to send to.
+        self.assertEqual(None, self.get_entry(dead.dev_id).reg_id)
+        self.assertEqual(replaced.reg_id, self.get_entry(replaced.dev_id).reg_id)
+
+    def testCanonical(self):
+        kept, replaced = self.devices
+        dead_keys, devices = RegIdFeedback().apply({'canonical' : {replaced.reg_id : self.CANONICAL_REG_ID}})
+
+        self.assertEqual([], dead_keys)
+        self.assertEqual([replaced.key], [device.key for device in devices])
+
+        device = replaced.key.get()
+        self.assertEqual(self.CANONICAL_REG_ID, device.reg_id)
+        self.assertEqual(replaced.revision + 1, device.revision)
+        self.assertEqual(kept.reg_id, kept.key.get().reg_id)
+
+        self.assertEqual(self.CANONICAL_REG_ID, self.get_entry(replaced.dev_id).reg_id)
+        self.assertEqual(kept.reg_id, self.get_entry(kept.dev_id).reg_id)
+
+    def testNotRegisteredAndCanonical(self):
+        # A device that is gone is not rewritten.
+        device = self.devices[0]
+        dead_keys, devices = RegIdFeedback().apply({'errors' : {'NotRegistered' : [device.reg_id]}, 'canonical' : {device.reg_id : self.CANONICAL_REG_ID}})
+
+        self.assertEqual([device.key], dead_keys)
+        self.assertEqual([], devices)
+        self.assertEqual(None, device.key.get())
+        self.assertEqual(None, self.get_entry(device.dev_id).reg_id)
@@ -0,0 +1,116 @@
+import json
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.api import users
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from deploy import Deploy
+from device import Device
+from device import DevicesHandlerJson
+from fields import Fields
+from genericAdapter import GenericAdapter
+from helpers import setCurrentUser
+from migration import Migration
+from subscription import Subscription
+from testdata import TestData
+
+class RootEntitiesTest(unittest.TestCase):
+    # Parents of the kinds that had a common parent before they were made ancestor-free.
+    LEGACY_DEVICE_ROOT = ndb.Key('Device', 'devices')
+    LEGACY_SUBSCRIPTION_ROOT = ndb.Key('Subscription', 'subscriptions')
+
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([('/', DevicesHandlerJson)])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_user_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        Migration.cache.clear()
+
+        setCurrentUser(email=Deploy.GAE_ADMIN, user_id='1234', is_admin=True)
+        self.user_id = Fields.sanitize_user_id(users.get_current_user().user_id())
+
+    def tearDown(self):
+        Migration.cache.clear()
+        self.testbed.deactivate()
+
+    def create_device(self, test, parent=None):
+        device = Device(parent=parent, user_id=self.user_id, name=test['name'], reg_id=test['reg_id'], dev_id=test['dev_id'], resource=test['resource'], type=test['type'])
+        device.put()
+        return device
+
+    def create_subscription(self, dev_id, key=None, parent=None):
+        subscription = Subscription(key=key, parent=parent, topic='topic', pub_id='publication', dev_id=dev_id, user_id=self.user_id)
+        subscription.put()
+        return subscription
+
+    def set_migrated(self, model):
+        Migration(id=model._get_kind(), done=True).put()
+
+    def testDeviceCreate(self):
+        # A new device is its own entity group, keyed by its dev_id.
+        test = TestData.TEST_DEVICES[0]
+        response = self.testapp.post('/', content_type='application/json', params=json.dumps(dict(test)))
+        self.assertEqual(response.status_int, 200)
+
+        key = Device.get_key(test['dev_id'])
+        self.assertEqual(None, key.parent())
+        self.assertEqual(test['dev_id'], key.get().dev_id)
+
+    def testDeviceLegacy(self):
+        # A device stored under the old parent is still found, by id and in lists, until the kind is migrated.
+        legacy = self.create_device(TestData.TEST_DEVICES[0], parent=self.LEGACY_DEVICE_ROOT)
+        self.create_device(TestData.TEST_DEVICES[1])
+
+        self.assertEqual([legacy.key], Device.query_by_id(legacy.dev_id))
+        self.assertEqual(legacy.key, GenericAdapter(Device).read_multi([legacy.dev_id])[0].key)
+
+        j = json.loads(self.testapp.get('/').body)
+        self.assertEqual(sorted([test['dev_id'] for test in TestData.TEST_DEVICES[:2]]), sorted([d['dev_id'] for d in j]))
+
+        self.set_migrated(Device)
+        self.assertEqual([], Device.query_by_id(legacy.dev_id))
+
+    def testSubscriptionNaturalKey(self):
+        subscription = Subscription(pub_id='publication', dev_id='0123456789abcdef')
+        key = Subscription.get_natural_key(subscription)
+        self.assertEqual(None, key.parent())
+        self.assertEqual('publication:0123456789abcdef', key.id())
+
+        self.assertEqual(None, Subscription.get_natural_key(Subscription(pub_id='publication')))
+
+    def testIsSubscribed(self):
+        dev_id = TestData.TEST_DEVICES[0]['dev_id']
+        subscription = Subscription(pub_id='publication', dev_id=dev_id)
+        self.assertFalse(subscription.is_subscribed())
+
+        stored = self.create_subscription(dev_id, key=Subscription.get_natural_key(subscription))
+        self.assertTrue(subscription.is_subscribed())
+
+        stored.key.delete()
+        self.assertFalse(subscription.is_subscribed())
+
+    def testIsSubscribedLegacy(self):
+        # A subscription stored under the old parent counts until the kind is migrated.
+        dev_id = TestData.TEST_DEVICES[0]['dev_id']
+        legacy = self.create_subscription(dev_id, parent=self.LEGACY_SUBSCRIPTION_ROOT)
+        subscription = Subscription(pub_id='publication', dev_id=dev_id)
+        self.assertTrue(subscription.is_subscribed())
+
+        # Nor once it is deleted.
+        legacy.key.delete()
+        self.assertFalse(subscription.is_subscribed())
+
+        self.create_subscription(dev_id, parent=self.LEGACY_SUBSCRIPTION_ROOT)
+        self.set_migrated(Subscription)
+        self.assertFalse(subscription.is_subscribed())
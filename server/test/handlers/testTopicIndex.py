@@ -0,0 +1,187 @@
+import json
+import os
+import webapp2
+import webtest
+import unittest2 as unittest
+
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+from device import Device
+from device import DeviceAdapter
+from fanOut import FanOut
+from fanOut import FanOutPageHandler
+from gcmHelpers import gcm
+from subscription import Subscription
+from topicIndex import TopicIndex
+
+class TopicIndexTest(unittest.TestCase):
+    PUB_ID = 'index'
+
+    def setUp(self):
+        # Create a WSGI application.
+        app = webapp2.WSGIApplication([(FanOut.PAGE_URL, FanOutPageHandler)])
+
+        # Wrap the app with WebTest's TestApp.
+        self.testapp = webtest.TestApp(app)
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        # Queries see every write, so update_devices finds entries as soon as they are stored.
+        self.testbed.init_datastore_v3_stub(consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1))
+        self.testbed.init_memcache_stub()
+        # The lanes' queues are defined in queue.yaml.
+        self.testbed.init_taskqueue_stub(root_path=os.path.join(os.path.dirname(__file__), '..', '..', 'src'))
+        self.taskqueue = self.testbed.get_stub(testbed.TASKQUEUE_SERVICE_NAME)
+        ndb.get_context().clear_cache()
+
+        self.entries = dict([('%04x' % (i), 'reg_id_%d' % (i)) for i in range(40)])
+
+        # Record the sends instead of making them.
+        self.sent = []
+        self.send = gcm.__dict__['send']
+        gcm.send = staticmethod(lambda data, reg_ids, lane, outbox: self.sent.extend(reg_ids) or {})
+
+    def tearDown(self):
+        gcm.send = self.send
+        self.testbed.deactivate()
+
+    def get_reg_ids(self, pub_id=PUB_ID):
+        reg_ids = []
+        for key in TopicIndex.get_keys(pub_id):
+            reg_ids.extend(TopicIndex.get_shard_reg_ids(key))
+
+        return sorted(reg_ids)
+
+    def get_entry(self, dev_id, pub_id=PUB_ID):
+        return TopicIndex.get_entry_key(TopicIndex.get_key(pub_id, TopicIndex.get_shard(dev_id)), dev_id).get()
+
+    def subscribe(self, dev_id, reg_id):
+        # Store a device and its subscription without going through the adapters, as before the index existed.
+        Device(key=Device.get_key(dev_id), user_id='1234', name='device', dev_id=dev_id, reg_id=reg_id).put()
+        Subscription(topic='topic', dev_id=dev_id, pub_id=self.PUB_ID, user_id='1234').put()
+
+    def publish(self, page=0):
+        payload = json.dumps({'id' : 'message', 'pub_id' : self.PUB_ID, 'data' : {}, 'lane' : gcm.LANE_BROADCAST, 'page' : page})
+        return self.testapp.post(FanOut.PAGE_URL, payload)
+
+    def get_tasks(self, url):
+        return [task for task in self.taskqueue.get_filtered_tasks(queue_names=[gcm.LANES[gcm.LANE_BROADCAST]['queue']]) if task.url == url]
+
+    def testAddRemove(self):
+        TopicIndex.add(self.PUB_ID, '00aa', 'reg_id_a')
+        TopicIndex.add(self.PUB_ID, '00bb', 'reg_id_b')
+        self.assertEqual(['reg_id_a', 'reg_id_b'], self.get_reg_ids())
+
+        # Adding a device again replaces its reg_id.
+        TopicIndex.add(self.PUB_ID, '00aa', 'reg_id_c')
+        self.assertEqual(['reg_id_b', 'reg_id_c'], self.get_reg_ids())
+
+        TopicIndex.remove(self.PUB_ID, '00aa')
+        self.assertEqual(None, self.get_entry('00aa'))
+        self.assertEqual(['reg_id_b'], self.get_reg_ids())
+
+        # Removing a device not in the index does nothing.
+        TopicIndex.remove(self.PUB_ID, '00cc')
+        self.assertEqual(['reg_id_b'], self.get_reg_ids())
+
+        # Adding devices does not make the index complete.
+        self.assertFalse(TopicIndex.is_indexed(self.PUB_ID))
+
+    def testUpdateDevices(self):
+        TopicIndex.add_entries(self.PUB_ID, self.entries)
+        TopicIndex.add_entries('other', {'0000' : 'reg_id_0'})
+
+        # More devices than fit in one IN filter, across every shard and publication.
+        updates = dict([(dev_id, 'new_' + reg_id) for dev_id, reg_id in self.entries.items()])
+        updates['0001'] = None
+        updates['ffff'] = 'reg_id_unknown'
+        TopicIndex.update_devices(updates)
+
+        self.assertEqual(None, self.get_entry('0001').reg_id)
+        self.assertEqual('new_reg_id_0', self.get_entry('0000').reg_id)
+        self.assertEqual('new_reg_id_0', self.get_entry('0000', 'other').reg_id)
+        self.assertEqual(len(self.entries) - 1, len(self.get_reg_ids()))
+
+        # Devices not in an index are not added to it.
+        self.assertEqual(None, self.get_entry('ffff'))
+
+    def testInsertEntries(self):
+        # Entries written since the build's read are newer and are kept.
+        TopicIndex.add(self.PUB_ID, '0000', 'reg_id_newer')
+        TopicIndex.insert_entries(self.PUB_ID, self.entries)
+
+        self.assertEqual('reg_id_newer', self.get_entry('0000').reg_id)
+        self.assertEqual(len(self.entries), len(self.get_reg_ids()))
+
+    def testBuildIndex(self):
+        for dev_id, reg_id in self.entries.items():
+            self.subscribe(dev_id, reg_id)
+        TopicIndex.add(self.PUB_ID, '0000', 'reg_id_newer')
+
+        page_size = Subscription.INDEX_PAGE_SIZE
+        Subscription.INDEX_PAGE_SIZE = 7
+        try:
+            Subscription.build_index(self.PUB_ID)
+        finally:
+            Subscription.INDEX_PAGE_SIZE = page_size
+
+        self.assertTrue(TopicIndex.is_indexed(self.PUB_ID))
+        self.assertEqual('reg_id_newer', self.get_entry('0000').reg_id)
+        self.assertEqual(len(self.entries), len(self.get_reg_ids()))
+
+    def testBuildIndexEmpty(self):
+        # A publication without subscribers is still built, so its fan-out uses the shards.
+        Subscription.build_index(self.PUB_ID)
+        self.assertTrue(TopicIndex.is_indexed(self.PUB_ID))
+        self.assertEqual([], self.get_reg_ids())
+
+    def testSubscriptionsBeforeIndex(self):
+        # Subscriptions stored before the index existed, then one subscribe that writes to the index.
+        self.subscribe('00aa', 'reg_id_a')
+        self.subscribe('00bb', 'reg_id_b')
+        TopicIndex.add(self.PUB_ID, '00cc', 'reg_id_c')
+        Subscription(topic='topic', dev_id='00cc', pub_id=self.PUB_ID, user_id='1234').put()
+        self.assertFalse(TopicIndex.is_indexed(self.PUB_ID))
+
+        # Until the index is built, a publish reads the subscriptions and reaches every subscriber.
+        page_size = FanOut.PAGE_SIZE
+        FanOut.PAGE_SIZE = 2
+        try:
+            self.publish(0)
+            self.assertFalse(TopicIndex.is_indexed(self.PUB_ID))
+            self.assertEqual(1, len(self.get_tasks(FanOut.PAGE_URL)))
+            self.publish(1)
+        finally:
+            FanOut.PAGE_SIZE = page_size
+
+        self.assertEqual(['reg_id_a', 'reg_id_b', 'reg_id_c'], sorted(self.sent))
+
+        # The pages copied every subscriber into the index and marked it built.
+        self.assertTrue(TopicIndex.is_indexed(self.PUB_ID))
+        self.assertEqual(['reg_id_a', 'reg_id_b', 'reg_id_c'], self.get_reg_ids())
+
+    def testDeleteDevicesRebuilds(self):
+        self.subscribe('00aa', 'reg_id_a')
+        Subscription.build_index(self.PUB_ID)
+
+        # Deleting every device clears the index; the subscriptions are still there.
+        DeviceAdapter(Device).delete_all()
+        self.assertFalse(TopicIndex.is_indexed(self.PUB_ID))
+
+        # A device registered again is found by the next publish, which rebuilds the index.
+        Device(key=Device.get_key('00aa'), user_id='1234', name='device', dev_id='00aa', reg_id='reg_id_new').put()
+        self.publish(0)
+        self.assertEqual(['reg_id_new'], self.sent)
+        self.assertTrue(TopicIndex.is_indexed(self.PUB_ID))
+        self.assertEqual(['reg_id_new'], self.get_reg_ids())
+
+    def testClear(self):
+        TopicIndex.add_entries(self.PUB_ID, self.entries)
+        TopicIndex.set_built(self.PUB_ID)
+        TopicIndex.add('other', '0000', 'reg_id_0')
+
+        TopicIndex.clear(self.PUB_ID)
+        self.assertFalse(TopicIndex.is_indexed(self.PUB_ID))
+        self.assertEqual([], self.get_reg_ids())
+        self.assertEqual(['reg_id_0'], self.get_reg_ids('other'))